@@ -1,161 +1,4660 @@
 """ Built-in modules """
+import argparse
+import bz2
+import ctypes
+import ctypes.util
+import cProfile
+import errno
+import gzip
+import hashlib
+import heapq
+import json
 import logging
+import lzma
 import os
+import queue
 import re
+import select
 import shutil
+import sqlite3
+import struct
 import sys
+import tarfile
+import threading
 import time
+import tracemalloc
+import zlib
+from collections import Counter, deque
+from itertools import repeat
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, \
+                               TimeoutError as FutureTimeout
+from multiprocessing import get_context
+from contextlib import nullcontext
+from functools import lru_cache
 from datetime import datetime
 from pathlib import Path
 from shlex import quote
 from sys import stderr
+from typing import NamedTuple
+# If the OS is Windows, the reflink ioctl is unavailable #
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# If the optional zstandard package is not installed, zst archives are unavailable #
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# If Python is older than 3.11, TOML job files are unavailable #
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
 
 
-def time_check(file: Path):
+# Global variables #
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+MANIFEST_NAME = '.backup_buddy.db'
+JOURNAL_NAME = '.backup_buddy.journal'
+DIGEST_CACHE_NAME = '.backup_buddy.digests'
+HASH_ALGORITHMS = ('blake2b', 'sha256')
+# Max seconds between durable journal checkpoints #
+CHECKPOINT_INTERVAL = 10.0
+BUFFER_SIZE = 1024 * 1024
+DELTA_BLOCK_SIZE = 128 * 1024
+DELTA_HASH_SIZE = 16
+DEFAULT_DELTA_MIN_SIZE = 64 * 1024 * 1024
+DEFAULT_RANGE_MIN_SIZE = 256 * 1024 * 1024
+DEFAULT_RANGE_SIZE = 64 * 1024 * 1024
+DEFAULT_RANGE_WORKERS = 4
+DEFAULT_SMALL_FILE_SIZE = 64 * 1024
+SMALL_BATCH_FILES = 32
+DURABILITY_LEVELS = ('none', 'run', 'batch', 'file')
+DEFAULT_DEBOUNCE = 1.0
+OUTPUT_MODES = ('verbose', 'progress', 'quiet')
+STATUS_INTERVAL = 0.5
+METRIC_PHASES = ('walk', 'dest_scan', 'queue_wait', 'stat', 'mkdir', 'copy')
+# Upper bounds in seconds of the phase latency histogram buckets #
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+SLOWEST_FILES = 10
+# Archive format -> file extension #
+ARCHIVE_FORMATS = {'tar': '.tar', 'gz': '.tar.gz', 'bz2': '.tar.bz2', 'xz': '.tar.xz',
+                   'zst': '.tar.zst'}
+ARCHIVE_CHUNK_SIZE = 4 * 1024 * 1024
+# Errors the compressors raise, zstandard has its own when installed #
+COMPRESS_ERRORS = (zlib.error, lzma.LZMAError, ValueError, MemoryError) \
+                  + ((zstandard.ZstdError,) if zstandard is not None else ())
+PIPELINE_DEPTH = 8
+# FIEMAP ioctl request and structs, used to order copies by physical offset on Linux #
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+PLAN_ORDERS = ('inode', 'extent')
+# Names of the completed snapshot generations, in progress ones have a .partial suffix #
+GENERATION_FORMAT = '%Y%m%d_%H%M%S_%f'
+GENERATION_RE = re.compile(r'\d{8}_\d{6}_\d{6}')
+# Adaptive concurrency: seconds between adjustments, latency smoothing factor, latency increase #
+# over the baseline that halves the concurrency, and the per-interval drift of the baseline #
+ADAPT_INTERVAL = 1.0
+ADAPT_ALPHA = 0.2
+ADAPT_BACKOFF = 2.0
+ADAPT_DRIFT = 1.1
+# Linux I/O priority classes and the ioprio_set syscall number per architecture #
+IOPRIO_CLASSES = {'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'aarch64': 30, 'i386': 289, 'i686': 289, 'armv7l': 314,
+                       'ppc64le': 273, 's390x': 282, 'riscv64': 30}
+# Options bound to a single destination or its copy backend, which cannot be changed from #
+# their defaults when fanning out to several #
+FANOUT_CONFLICTS = ('archive', 'store', 'store_restore', 'restore', 'snapshot', 'plan', 'dry_run',
+                    'journal', 'mirror', 'manifest', 'rebuild_manifest', 'delta', 'watch',
+                    'verify', 'checksum', 'bwlimit', 'iops_limit', 'adaptive', 'drop_cache',
+                    'durability', 'small_file_size', 'range_workers', 'range_min_size',
+                    'range_size', 'metrics', 'profile', 'tracemalloc')
+# Entries in the destination root starting with the prefix belong to Backup Buddy #
+TOOL_PREFIX = '.backup_buddy'
+QUARANTINE_NAME = '.backup_buddy_quarantine'
+# Content defined chunking sizes, the mask bits set the average distance past the minimum #
+CHUNK_MIN = 128 * 1024
+CHUNK_MAX = 1024 * 1024
+CHUNK_MASK = ((1 << 17) - 1) << 15
+# Bytes the rolling hash of a position covers, and positions hashed per vectorized block #
+CHUNK_WINDOW = 32
+CHUNK_SCAN_BLOCK = 16 * 1024
+# Gear hash table of pseudo random 32-bit values, one per byte value #
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([value]), digest_size=4).digest(), 'little')
+        for value in range(256)]
+# The gear table split into byte translation tables, one per byte of the 32-bit values #
+GEAR_TABLES = [bytes((value >> shift) & 0xFF for value in GEAR) for shift in (0, 8, 16, 24)]
+# Inotify flags and event masks from sys/inotify.h #
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+INOTIFY_EVENT = struct.Struct('iIII')
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+FICLONE = 0x40049409
+# Errors meaning a copy tier is unsupported between the file systems, not that the copy failed #
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EBADF,
+                      errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)}
+
+
+class CopyEngine:
+    """
+    Concurrent copy engine where the walker submits copy jobs into a bounded queue that is drained
+    by a pool of worker threads. Results are reported in the order the jobs were submitted, so the
+    output of a run is deterministic regardless of which worker finishes first.
+
+    :param workers:  The number of worker threads, one runs every job on the calling thread.
+    :param queue_size:  The max number of jobs in flight before the walker blocks, zero for auto.
+    :param backend:  The copy backend used by the workers, None for a default backend.
+    :param reporter:  The progress reporter results are passed to, None for verbose output.
+    :param metrics:  The phase metrics of the run, None to disable them.
+    :param executor:  A worker pool shared with other engines, None to create one.
+    """
+    def __init__(self, workers: int = DEFAULT_WORKERS, queue_size: int = 0,
+                 backend: 'CopyBackend' = None, reporter: 'ProgressReporter' = None,
+                 metrics: 'Metrics' = None, executor: ThreadPoolExecutor = None):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size if queue_size > 0 else self.workers * 4
+        self.pending = deque()
+        self.listeners = []
+        self.checkpoints = []
+        self.backend = backend if backend is not None else CopyBackend()
+        self.reporter = reporter if reporter is not None else ProgressReporter()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.executor = executor
+        self.shared = executor is not None
+
+        # If more than a single worker was requested and no pool is shared #
+        if self.executor is None and self.workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='copy_worker')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+
+    def submit(self, func, *args):
+        """
+        Queues the function to be ran by the worker pool, blocking while the queue is full.
+
+        :param func:  The function to execute, its return value is passed to report().
+        :param args:  The arguments to pass into the function.
+        :return:  Nothing
+        """
+        # If running without a worker pool #
+        if self.executor is None:
+            self.report(func(*args))
+            return
+
+        # If the queue is at capacity, wait on the oldest jobs #
+        if len(self.pending) >= self.queue_size:
+            start = time.perf_counter()
+
+            while len(self.pending) >= self.queue_size:
+                self.drain_one()
+
+            self.metrics.record('queue_wait', time.perf_counter() - start)
+
+        self.pending.append(self.executor.submit(func, *args))
+
+    def notify(self, result):
+        """
+        Queues an already computed result so it is reported in order with the pending jobs.
+
+        :param result:  The message to be reported, None if there is nothing to report.
+        :return:  Nothing
+        """
+        # If there is nothing to report #
+        if result is None:
+            return
+
+        # If there are no jobs in flight #
+        if not self.pending:
+            self.report(result)
+            return
+
+        future = Future()
+        future.set_result(result)
+        self.pending.append(future)
+
+    def drain_one(self):
+        """
+        Waits on the oldest queued job and reports its result.
+
+        :return:  Nothing
+        """
+        future = self.pending.popleft()
+
+        while True:
+            try:
+                result = future.result(timeout=STATUS_INTERVAL)
+                break
+
+            # If the job is slow, keep the status line moving while waiting #
+            except FutureTimeout:
+                self.reporter.refresh()
+
+        self.report(result)
+
+    def report(self, result):
+        """
+        Reports the result of a finished job, passing copy results to the registered listeners.
+
+        :param result:  The message or copy result returned by the job, None if the file was \
+                        unchanged.
+        :return:  Nothing
+        """
+        # If the job copied a batch of files, report each of them #
+        if isinstance(result, list):
+            for item in result:
+                self.report(item)
+            return
+
+        # If every job of a subtree was reported, pass the checkpoint to the journal #
+        if isinstance(result, Checkpoint):
+            for listener in self.checkpoints:
+                listener(result)
+            return
+
+        # If the job copied a file #
+        if isinstance(result, CopyResult):
+            # Pass the result to the listeners on the reporting thread #
+            for listener in self.listeners:
+                listener(result)
+
+        self.reporter.report(result)
+
+    def wait(self):
+        """
+        Waits on and reports every queued job.
+
+        :return:  Nothing
+        """
+        while self.pending:
+            self.drain_one()
+
+    def close(self, cancel: bool = False):
+        """
+        Drains the remaining queued jobs and shuts down the worker pool.
+
+        :param cancel:  Toggle to discard the queued jobs instead of waiting on them.
+        :return:  Nothing
+        """
+        try:
+            # Report the remaining jobs unless cancelling #
+            if not cancel:
+                self.wait()
+        finally:
+            # If the worker pool is shared, only cancel the jobs of this engine #
+            if self.shared:
+                for future in self.pending:
+                    future.cancel()
+            # If a worker pool was created #
+            elif self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+
+            self.executor = None
+
+            self.pending.clear()
+            self.backend.close()
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a run without letting the console become the bottleneck. Verbose mode
+    prints every copied file like before, progress mode keeps a single status line refreshed at
+    most every half second, and quiet mode only prints the summary. Per-file messages can also be
+    written to a log file by a background thread, off the reporting thread.
+
+    :param mode:  The output mode, one of verbose, progress or quiet.
+    :param log_path:  The path of the per-file log, None to disable it.
+    """
+    def __init__(self, mode: str = 'verbose', log_path: Path = None):
+        self.mode = mode
+        self.start = time.monotonic()
+        self.last_refresh = 0.0
+        self.checked = 0
+        self.copied = 0
+        self.copied_bytes = 0
+        self.total_files = 0
+        self.total_bytes = 0
+        self.status_len = 0
+        self.log_queue = None
+        self.log_thread = None
+
+        # If the per-file log is enabled #
+        if log_path is not None:
+            self.log_queue = queue.SimpleQueue()
+            self.log_thread = threading.Thread(target=self.log_writer, args=(log_path,),
+                                               name='file_log', daemon=True)
+            self.log_thread.start()
+
+    def log_writer(self, log_path: Path):
+        """
+        Writes the queued messages to the per-file log through a large buffer until a None \
+        sentinel is queued.
+
+        :param log_path:  The path of the per-file log.
+        :return:  Nothing
+        """
+        with open(log_path, 'a', encoding='utf-8', buffering=BUFFER_SIZE) as log:
+            while True:
+                message = self.log_queue.get()
+                # If the reporter is finished #
+                if message is None:
+                    break
+
+                log.write(f'{message}\n')
+
+    def set_total(self, files: int, total_bytes: int):
+        """
+        Sets the amount of work of the run when it is known up front, enabling the ETA.
+
+        :param files:  The number of files to copy.
+        :param total_bytes:  The number of bytes to copy.
+        :return:  Nothing
+        """
+        self.total_files = files
+        self.total_bytes = total_bytes
+
+    def report(self, result):
+        """
+        Tallies the result of a copy job or prints a message, depending on the output mode.
+
+        :param result:  The message or copy result, None if the checked file was unchanged.
+        :return:  Nothing
+        """
+        # If a message like a directory banner was reported #
+        if isinstance(result, str):
+            # If printing every message #
+            if self.mode == 'verbose':
+                print(result)
+            # If the message is not a directory banner, log it #
+            if self.log_queue is not None and not result.startswith('\n'):
+                self.log_queue.put(result)
+            return
+
+        self.checked += 1
+
+        # If the job copied a file #
+        if result is not None:
+            self.copied += 1
+            self.copied_bytes += result.meta.size
+
+            # If printing every message #
+            if self.mode == 'verbose':
+                print(result.message)
+            # If the per-file log is enabled #
+            if self.log_queue is not None:
+                self.log_queue.put(result.message)
+
+        # If the status line is enabled #
+        if self.mode == 'progress':
+            self.refresh()
+
+    def status(self) -> str:
+        """
+        Formats the current throughput of the run.
+
+        :return:  The formatted status.
+        """
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        byte_rate = self.copied_bytes / elapsed
+        status = (f'Checked {self.checked} files, copied {self.copied} '
+                  f'({self.copied_bytes / 1024 ** 2:.1f} MB) | {self.checked / elapsed:.0f} '
+                  f'files/s, {byte_rate / 1024 ** 2:.1f} MB/s')
+
+        # If the amount of work is known and throughput was measured #
+        if self.total_bytes and byte_rate:
+            remaining = max(self.total_bytes - self.copied_bytes, 0) / byte_rate
+            status += f' | ETA {int(remaining // 60)}m{int(remaining % 60):02d}s'
+        elif self.total_files and self.copied:
+            remaining = max(self.total_files - self.copied, 0) / (self.copied / elapsed)
+            status += f' | ETA {int(remaining // 60)}m{int(remaining % 60):02d}s'
+
+        return status
+
+    def refresh(self, force: bool = False):
+        """
+        Redraws the status line in progress mode, at most once per status interval.
+
+        :param force:  Toggle to redraw regardless of the interval.
+        :return:  Nothing
+        """
+        now = time.monotonic()
+        # If not in progress mode or the line was redrawn recently #
+        if self.mode != 'progress' or (not force and now - self.last_refresh < STATUS_INTERVAL):
+            return
+
+        self.last_refresh = now
+        status = self.status()
+        # Pad with spaces to overwrite a longer previous line #
+        sys.stdout.write(f'\r{status}{" " * max(self.status_len - len(status), 0)}')
+        sys.stdout.flush()
+        self.status_len = len(status)
+
+    def finish(self):
+        """
+        Prints the run summary and flushes the per-file log.
+
+        :return:  Nothing
+        """
+        # If the status line is in use, clear it for the summary #
+        if self.mode == 'progress' and self.status_len:
+            sys.stdout.write(f'\r{" " * self.status_len}\r')
+
+        print(f'\n{self.status()} in {time.monotonic() - self.start:.1f}s')
+
+        # If the per-file log is enabled, flush it #
+        if self.log_queue is not None:
+            self.log_queue.put(None)
+            self.log_thread.join()
+            self.log_queue = None
+
+
+class Metrics:
+    """
+    Collects per-phase counters and latency histograms of a run, along with the slowest copied
+    files, and exports them as JSON or a Prometheus textfile. Recording is a no-op when disabled.
+
+    :param enabled:  Toggle to collect the metrics.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.phases = {phase: {'count': 0, 'seconds': 0.0, 'max': 0.0,
+                               'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+                       for phase in METRIC_PHASES}
+        self.slowest = []
+
+    def record(self, phase: str, seconds: float, file_path: Path = None, size: int = None):
+        """
+        Records the latency of a single operation of the phase.
+
+        :param phase:  The name of the phase.
+        :param seconds:  The duration of the operation.
+        :param file_path:  The file the operation was on, tracked for the slowest files.
+        :param size:  The size of the file.
+        :return:  Nothing
+        """
+        # If metrics are disabled #
+        if not self.enabled:
+            return
+
+        # Find the first bucket the latency fits in, the last bucket is unbounded #
+        bucket = next((index for index, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound),
+                      len(LATENCY_BUCKETS))
+
+        with self.lock:
+            stats = self.phases[phase]
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['buckets'][bucket] += 1
+
+            # If the operation was on a file, keep it if it is one of the slowest #
+            if file_path is not None:
+                item = (seconds, str(file_path), size)
+                # If the slowest list is not full yet #
+                if len(self.slowest) < SLOWEST_FILES:
+                    heapq.heappush(self.slowest, item)
+                elif item > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, item)
+
+    def report(self, counters: dict) -> dict:
+        """
+        Builds the metrics report.
+
+        :param counters:  Additional run counters to include.
+        :return:  The metrics report.
+        """
+        with self.lock:
+            phases = {phase: {'count': stats['count'], 'seconds': round(stats['seconds'], 6),
+                              'max_seconds': round(stats['max'], 6),
+                              'histogram': dict(zip([*map(str, LATENCY_BUCKETS), '+Inf'],
+                                                    stats['buckets']))}
+                      for phase, stats in self.phases.items()}
+            slowest = [{'path': path, 'size': size, 'seconds': round(seconds, 6)}
+                       for seconds, path, size in sorted(self.slowest, reverse=True)]
+
+        return {'duration_seconds': round(time.monotonic() - self.start, 6),
+                'counters': counters, 'phases': phases, 'slowest_files': slowest}
+
+    def prometheus(self, report: dict) -> str:
+        """
+        Formats the metrics report in the Prometheus text exposition format.
+
+        :param report:  The metrics report.
+        :return:  The formatted metrics.
+        """
+        lines = ['# HELP backup_buddy_duration_seconds Wall time of the run.',
+                 '# TYPE backup_buddy_duration_seconds gauge',
+                 f'backup_buddy_duration_seconds {report["duration_seconds"]}']
+
+        for name, value in report['counters'].items():
+            # If the counter is not numeric #
+            if not isinstance(value, (int, float)):
+                continue
+
+            lines += [f'# TYPE backup_buddy_{name} gauge', f'backup_buddy_{name} {value}']
+
+        lines += ['# HELP backup_buddy_phase_seconds Latency of the operations per run phase.',
+                  '# TYPE backup_buddy_phase_seconds histogram']
+
+        for phase, stats in report['phases'].items():
+            cumulative = 0
+            # Prometheus histogram buckets are cumulative #
+            for bound, count in stats['histogram'].items():
+                cumulative += count
+                lines.append(f'backup_buddy_phase_seconds_bucket{{phase="{phase}",le="{bound}"}}'
+                             f' {cumulative}')
+
+            lines += [f'backup_buddy_phase_seconds_sum{{phase="{phase}"}} {stats["seconds"]}',
+                      f'backup_buddy_phase_seconds_count{{phase="{phase}"}} {stats["count"]}']
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, report_path: Path, fmt: str, counters: dict):
+        """
+        Writes the metrics report, replacing the file atomically so collectors never read a \
+        partial report.
+
+        :param report_path:  The path of the metrics file.
+        :param fmt:  The format of the report, json or prometheus.
+        :param counters:  Additional run counters to include.
+        :return:  Nothing
+        """
+        report = self.report(counters)
+        # If the Prometheus textfile format is selected #
+        if fmt == 'prometheus':
+            content = self.prometheus(report)
+        else:
+            content = json.dumps(report, indent=2) + '\n'
+
+        temp_path = report_path.with_name(f'.{report_path.name}.tmp')
+        temp_path.write_text(content, encoding='utf-8')
+        os.replace(temp_path, report_path)
+
+
+class FileMeta(NamedTuple):
+    """
+    The file metadata compared to detect whether a file changed since it was last copied.
+    """
+    size: int
+    mtime_ns: int
+
+
+class PlanOp(NamedTuple):
+    """
+    Create or update operation of a copy plan, with the key the plan is executed in order of.
+    """
+    src_entry: os.DirEntry
+    dest_file: Path
+    dest_entry: os.DirEntry
+    size: int
+    key: tuple
+
+
+class CopyPlan(NamedTuple):
+    """
+    Copy plan built from the full scan, the directories to create and the file operations.
+    """
+    dirs: list
+    ops: list
+    unchanged: int
+
+
+class Checkpoint(NamedTuple):
+    """
+    Marker queued after the last job of a walked subtree, reported once the whole subtree is done.
+    """
+    rel_dir: str
+
+
+class CopyResult(NamedTuple):
+    """
+    The outcome of a file copy passed from the workers back to the reporting thread.
+    """
+    message: str
+    dest_file: Path
+    meta: FileMeta
+    signature: bytes = None
+
+
+class BackupJob(NamedTuple):
+    """
+    A source and destination pair of a job file with its own parsed options.
+    """
+    name: str
+    args: argparse.Namespace
+    src_path: Path
+    dest_paths: list
+    recursive: bool
+
+
+def entry_meta(entry: os.DirEntry) -> FileMeta:
+    """
+    Gets the change detection metadata of a directory entry, reusing the stat result cached in the \
+    entry by os.scandir. Metadata already loaded from the manifest is passed through.
+
+    :param entry:  The directory entry or manifest metadata to get the metadata of.
+    :return:  The size and last modification time of the entry.
+    """
+    # If the metadata came from the manifest #
+    if isinstance(entry, FileMeta):
+        return entry
+
+    stat = entry.stat()
+    return FileMeta(stat.st_size, stat.st_mtime_ns)
+
+
+def file_changed(src_meta: FileMeta, dest_meta: FileMeta) -> bool:
+    """
+    Checks whether the source file needs to be copied. Copies keep the source modification time, \
+    so a file is unchanged when both the size and the nanosecond modification time match.
+
+    :param src_meta:  The metadata of the source file.
+    :param dest_meta:  The metadata of the destination file, None if it does not exist.
+    :return:  True if the file needs to be copied, False otherwise.
+    """
+    return dest_meta is None or src_meta != dest_meta
+
+
+class PathFilter:
+    """
+    Include and exclude rules compiled once into a single matcher. Rules are gitignore style \
+    globs, a pattern without a slash matches the name at any depth, a pattern with one is \
+    anchored to the source root, a trailing slash only matches directories and a leading ! \
+    includes back what an earlier rule excluded. The last matching rule wins, which the compiled \
+    regex gets by trying the rules in reverse order. Excluded directories are pruned from the walk \
+    so their subtrees are never scanned, and files can also be limited by size and age.
+
+    :param root:  The path to the source directory the rules are relative to.
+    :param rules:  The ordered glob rules, prefixed with ! to include.
+    :param min_size:  The minimum size of the files to copy, None for no limit.
+    :param max_size:  The maximum size of the files to copy, None for no limit.
+    :param min_age:  The minimum age in days of the files to copy, None for no limit.
+    :param max_age:  The maximum age in days of the files to copy, None for no limit.
+    """
+    def __init__(self, root: Path, rules: list = (), min_size: int = None, max_size: int = None,
+                 min_age: float = None, max_age: float = None):
+        self.prefix = os.path.join(str(root), '')
+        self.min_size = min_size
+        self.max_size = max_size
+        now = time.time_ns()
+        # Convert the ages into modification time bounds once #
+        self.newest = now - int(min_age * 86400e9) if min_age is not None else None
+        self.oldest = now - int(max_age * 86400e9) if max_age is not None else None
+        self.negated = []
+        dir_patterns = []
+        file_patterns = []
+
+        for rule in rules:
+            negated = rule.startswith('!')
+            regex, dir_only = self.glob_regex(rule[1:] if negated else rule)
+            group = f'(?P<r{len(self.negated)}>{regex})'
+            self.negated.append(negated)
+            dir_patterns.append(group)
+            # If the rule matches files too #
+            if not dir_only:
+                file_patterns.append(group)
+
+        # Try the rules last first, so the first matching alternative is the last matching rule #
+        self.dir_regex = re.compile('|'.join(reversed(dir_patterns))) if dir_patterns else None
+        self.file_regex = re.compile('|'.join(reversed(file_patterns))) if file_patterns else None
+        self.pruned_dirs = 0
+        self.skipped_files = 0
+
+    @staticmethod
+    def glob_regex(pattern: str) -> tuple:
+        """
+        Translates the gitignore style glob into a regex matched against relative posix paths.
+
+        :param pattern:  The glob pattern to translate.
+        :return:  The regex and whether the pattern only matches directories.
+        """
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # A slash anywhere but the end anchors the pattern to the root #
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        parts = [] if anchored else ['(?:.*/)?']
+        index = 0
+
+        while index < len(pattern):
+            char = pattern[index]
+            # If the pattern matches any number of leading directories #
+            if pattern.startswith('**/', index):
+                parts.append('(?:.*/)?')
+                index += 3
+                continue
+            # If the pattern matches everything, across directories #
+            if pattern.startswith('**', index):
+                parts.append('.*')
+                index += 2
+                continue
+
+            # If the pattern has a character class #
+            if char == '[' and pattern.find(']', index + 2) != -1:
+                end = pattern.find(']', index + 2)
+                body = pattern[index + 1:end].replace('\\', '\\\\')
+                parts.append(f'[^{body[1:]}]' if body.startswith('!') else f'[{body}]')
+                index = end + 1
+                continue
+
+            # If the next character is escaped, match it literally #
+            if char == '\\' and index + 1 < len(pattern):
+                parts.append(re.escape(pattern[index + 1]))
+                index += 2
+                continue
+
+            parts.append({'*': '[^/]*', '?': '[^/]'}.get(char) or re.escape(char))
+            index += 1
+
+        return ''.join(parts), dir_only
+
+    def excluded(self, rel_path: str, is_dir: bool) -> bool:
+        """
+        Checks whether the glob rules exclude the path.
+
+        :param rel_path:  The posix path relative to the root.
+        :param is_dir:  Toggle to match the path as a directory.
+        :return:  True if the path is excluded, False otherwise.
+        """
+        regex = self.dir_regex if is_dir else self.file_regex
+        # If there are no rules for this type of entry #
+        if regex is None:
+            return False
+
+        match = regex.fullmatch(rel_path)
+        return match is not None and not self.negated[int(match.lastgroup[1:])]
+
+    def relative(self, entry_path: str) -> str:
+        """
+        Gets the posix path relative to the root of an entry found under the root.
+
+        :param entry_path:  The full path of the entry.
+        :return:  The relative posix path.
+        """
+        rel_path = entry_path[len(self.prefix):]
+        return rel_path if os.sep == '/' else rel_path.replace(os.sep, '/')
+
+    def keep_dir(self, dir_path: str) -> bool:
+        """
+        Checks whether the directory under the root is walked.
+
+        :param dir_path:  The full path of the directory.
+        :return:  True if the directory is kept, False if it is excluded.
+        """
+        return not self.excluded(self.relative(dir_path), True)
+
+    def keep_file(self, entry: os.DirEntry, rel_path: str = None) -> bool:
+        """
+        Checks whether the file is copied, by the glob rules and the size and age limits.
+
+        :param entry:  The directory entry of the file.
+        :param rel_path:  The posix path relative to the root, None to derive it from the entry.
+        :return:  True if the file is kept, False if it is excluded.
+        """
+        # If the glob rules exclude the file #
+        if self.excluded(rel_path or self.relative(entry.path), False):
+            return False
+
+        # If there are no size or age limits, skip the stat #
+        if self.min_size is None and self.max_size is None and self.newest is None \
+        and self.oldest is None:
+            return True
+
+        size, mtime = entry_meta(entry)
+        return (self.min_size is None or size >= self.min_size) and \
+               (self.max_size is None or size <= self.max_size) and \
+               (self.newest is None or mtime <= self.newest) and \
+               (self.oldest is None or mtime >= self.oldest)
+
+    def apply(self, dir_entries: list, file_entries: list):
+        """
+        Removes the excluded entries of a scanned directory in place.
+
+        :param dir_entries:  The directory entries, excluded directories are pruned.
+        :param file_entries:  The file entries, excluded files are skipped.
+        :return:  Nothing
+        """
+        dir_count = len(dir_entries)
+        file_count = len(file_entries)
+        dir_entries[:] = [entry for entry in dir_entries if self.keep_dir(entry.path)]
+        file_entries[:] = [entry for entry in file_entries if self.keep_file(entry)]
+        self.pruned_dirs += dir_count - len(dir_entries)
+        self.skipped_files += file_count - len(file_entries)
+
+
+def scan_files(dir_path: Path) -> dict:
+    """
+    Scans the directory once and maps the names of its files to their directory entries.
+
+    :param dir_path:  The path to the directory to scan.
+    :return:  The file name to directory entry dict, empty if the directory does not exist.
+    """
+    try:
+        with os.scandir(dir_path) as entries:
+            return {entry.name: entry for entry in entries if entry.is_file()}
+
+    # If the directory does not exist yet #
+    except FileNotFoundError:
+        return {}
+
+
+def scan_tree_dir(dir_path: str) -> tuple:
+    """
+    Scans the directory once, splitting its entries into subdirectories and files. Directories \
+    which cannot be scanned are logged and treated as empty, like os.walk does.
+
+    :param dir_path:  The path to the directory to scan.
+    :return:  The list of directory entries and the list of file entries.
+    """
+    dir_entries = []
+    file_entries = []
+
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                # If the entry is a directory #
+                if entry.is_dir():
+                    dir_entries.append(entry)
+                # If the entry is a regular file #
+                elif entry.is_file():
+                    file_entries.append(entry)
+
+    # If the directory was removed or access was denied #
+    except OSError as scan_err:
+        logging.warning('Unable to scan directory %s: %s', dir_path, scan_err)
+
+    return dir_entries, file_entries
+
+
+def walk_tree(root: Path, scan_workers: int = 1, path_filter: PathFilter = None):
+    """
+    Walks the tree top-down with os.scandir, carrying the relative path of each directory along \
+    instead of deriving it from the full path. Like os.walk, the yielded directory entry list can \
+    be pruned in place to skip subtrees, and symlinked directories are not descended into. With \
+    more than one scan worker, the subdirectories of each directory are scanned concurrently \
+    while the yield order stays the same. With a path filter the excluded entries are removed \
+    before the yield, so excluded subtrees are never scanned.
+
+    :param root:  The path to the root directory of the tree.
+    :param scan_workers:  The number of threads scanning directories.
+    :param path_filter:  The include and exclude rules, None to walk every entry.
+    :return:  Generator of (relative dir, directory entries, file entries) tuples.
+    """
+    executor = None
+    # If the subtrees are scanned in parallel #
+    if scan_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=scan_workers, thread_name_prefix='scan_worker')
+
+    # Stack of relative dirs, their paths, and the pending scan when scanning in parallel #
+    stack = [(Path('.'), root, None)]
+
+    try:
+        while stack:
+            rel_dir, dir_path, future = stack.pop()
+            # If the directory is scanned in the pool, wait on it, otherwise scan it now #
+            dir_entries, file_entries = future.result() if future else scan_tree_dir(dir_path)
+
+            # If a path filter is in use, prune the excluded entries before they are walked #
+            if path_filter is not None:
+                path_filter.apply(dir_entries, file_entries)
+
+            yield rel_dir, dir_entries, file_entries
+
+            # Queue the remaining subdirectories, in reverse so they are walked in scan order #
+            for entry in reversed(dir_entries):
+                # If the directory is a symlink, do not descend into it #
+                if entry.is_symlink():
+                    continue
+
+                future = executor.submit(scan_tree_dir, entry.path) if executor else None
+                stack.append((rel_dir / entry.name, entry.path, future))
+    finally:
+        # If a scan pool was created #
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def source_tree(src_path: Path, recursive: bool, scan_workers: int = 1,
+                path_filter: PathFilter = None):
+    """
+    Gets the walk of the source path, the whole tree or only its top directory.
+
+    :param src_path:  The path to the source directory containing data.
+    :param recursive:  Toggle to walk recursively instead of a single directory.
+    :param scan_workers:  The number of threads scanning subdirectories ahead of the walk.
+    :param path_filter:  The include and exclude rules, None to walk every entry.
+    :return:  Iterable of (relative dir, directory entries, file entries) tuples.
+    """
+    # If recursive copying is selected #
+    if recursive:
+        return walk_tree(src_path, scan_workers, path_filter)
+
+    file_entries = list(scan_files(src_path).values())
+    # If a path filter is in use #
+    if path_filter is not None:
+        path_filter.apply([], file_entries)
+
+    return [(Path('.'), [], file_entries)]
+
+
+class Manifest:
+    """
+    SQLite index stored in the destination root recording the size and modification time of every
+    file written by Backup Buddy. Once a run has completed with the index, later runs diff the
+    source scan against it instead of scanning the destination tree. The index also stores the
+    block signatures of delta updated files, which the copy workers read through a shared lock.
+
+    :param dest_path:  The path to the destination directory where the index is stored.
+    :param rebuild:  Toggle to discard the index and rebuild it from a destination scan.
+    """
+    def __init__(self, dest_path: Path, rebuild: bool = False):
+        self.root = dest_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dest_path / MANIFEST_NAME, check_same_thread=False)
+        self.conn.executescript('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY,'
+                                ' value TEXT);'
+                                'CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY);'
+                                'CREATE TABLE IF NOT EXISTS files (dir TEXT, name TEXT,'
+                                ' size INTEGER, mtime_ns INTEGER, digest TEXT,'
+                                ' PRIMARY KEY (dir, name));'
+                                'CREATE TABLE IF NOT EXISTS signatures (dir TEXT, name TEXT,'
+                                ' block_size INTEGER, hashes BLOB, PRIMARY KEY (dir, name));')
+        row = self.conn.execute('SELECT value FROM meta WHERE key = \'complete\'').fetchone()
+        # The index is only trusted if the last run using it finished #
+        self.trusted = not rebuild and row is not None and row[0] == '1'
+
+        # If the index is not trusted, it is rebuilt from the destination scan #
+        if not self.trusted:
+            self.conn.execute('DELETE FROM dirs')
+            self.conn.execute('DELETE FROM files')
+            self.conn.execute('DELETE FROM signatures')
+
+        # Mark the index as incomplete until this run finishes #
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (\'complete\', \'0\')')
+        self.conn.commit()
+        self.dirs = {row[0] for row in self.conn.execute('SELECT path FROM dirs')}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+    def rel_path(self, file_path: Path) -> tuple:
+        """
+        Splits the path relative to the destination root into the directory and name keys it is \
+        stored under in the index.
+
+        :param file_path:  The path inside the destination directory.
+        :return:  The relative posix directory ('.' for the destination root) and the name.
+        """
+        rel_dir, _, name = file_path.relative_to(self.root).as_posix().rpartition('/')
+        return rel_dir or '.', name
+
+    def dir_files(self, dir_path: Path) -> dict:
+        """
+        Gets the files of the destination directory from the index. If the index is not trusted \
+        the directory is scanned instead and the scan is recorded into the index.
+
+        :param dir_path:  The path to the destination directory.
+        :return:  The file name to file metadata dict.
+        """
+        rel_dir = dir_path.relative_to(self.root).as_posix()
+
+        # If the index is being rebuilt #
+        if not self.trusted:
+            files = {name: entry_meta(entry) for name, entry in scan_files(dir_path).items()}
+            with self.lock:
+                self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL)',
+                                      [(rel_dir, name, meta.size, meta.mtime_ns)
+                                       for name, meta in files.items()])
+            return files
+
+        with self.lock:
+            rows = self.conn.execute('SELECT name, size, mtime_ns FROM files WHERE dir = ?',
+                                     (rel_dir,)).fetchall()
+
+        return {name: FileMeta(size, mtime_ns) for name, size, mtime_ns in rows}
+
+    def has_dir(self, dir_path: Path) -> bool:
+        """
+        Checks whether the index recorded the destination directory as created.
+
+        :param dir_path:  The path to the destination directory.
+        :return:  True if the directory is recorded, False otherwise.
+        """
+        return dir_path.relative_to(self.root).as_posix() in self.dirs
+
+    def record_dir(self, dir_path: Path):
+        """
+        Records the destination directory as created.
+
+        :param dir_path:  The path to the destination directory.
+        :return:  Nothing
+        """
+        rel_dir = dir_path.relative_to(self.root).as_posix()
+        self.dirs.add(rel_dir)
+
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO dirs VALUES (?)', (rel_dir,))
+
+    def signature(self, dest_file: Path, block_size: int) -> bytes:
+        """
+        Gets the stored block signature of the destination file, called from the copy workers.
+
+        :param dest_file:  The path to the destination file.
+        :param block_size:  The block size the signature has to be computed with.
+        :return:  The concatenated block hashes, None if no matching signature is stored.
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT hashes FROM signatures WHERE dir = ? AND name = ?'
+                                    ' AND block_size = ?',
+                                    (*self.rel_path(dest_file), block_size)).fetchone()
+
+        return row[0] if row else None
+
+    def record(self, result: CopyResult):
+        """
+        Records the copied file, registered as a copy engine listener.
+
+        :param result:  The result of the file copy.
+        :return:  Nothing
+        """
+        rel_dir, name = self.rel_path(result.dest_file)
+
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL)',
+                              (rel_dir, name, result.meta.size, result.meta.mtime_ns))
+            # If the copy produced a block signature #
+            if result.signature:
+                self.conn.execute('INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?)',
+                                  (rel_dir, name, DELTA_BLOCK_SIZE, result.signature))
+            # If the file was fully copied, any stored signature is stale #
+            else:
+                self.conn.execute('DELETE FROM signatures WHERE dir = ? AND name = ?',
+                                  (rel_dir, name))
+
+    def commit(self):
+        """
+        Commits the recorded changes, used by long running watch mode between batches.
+
+        :return:  Nothing
+        """
+        with self.lock:
+            self.conn.commit()
+
+    def close(self, complete: bool = False):
+        """
+        Commits the index and closes the database connection.
+
+        :param complete:  Toggle to mark the index as trusted for the next run.
+        :return:  Nothing
+        """
+        with self.lock:
+            # If the run finished without errors #
+            if complete:
+                self.conn.execute('INSERT OR REPLACE INTO meta VALUES (\'complete\', \'1\')')
+
+            self.conn.commit()
+            self.conn.close()
+
+
+def dest_files(dir_path: Path, manifest: Manifest) -> dict:
+    """
+    Gets the files of the destination directory from the manifest if in use, otherwise by scanning.
+
+    :param dir_path:  The path to the destination directory.
+    :param manifest:  The destination manifest, None if not in use.
+    :return:  The file name to directory entry or file metadata dict.
+    """
+    # If the manifest is in use #
+    if manifest is not None:
+        return manifest.dir_files(dir_path)
+
+    return scan_files(dir_path)
+
+
+class Journal:
+    """
+    Write-ahead checkpoint journal stored in the destination root so an interrupted recursive run
+    resumes where it stopped. A subtree is checkpointed once every file in it was copied, and the
+    checkpoints are only written after the copied data was synced to disk. A restarted run of the
+    same source skips the checkpointed subtrees, and the journal is deleted once a run completes.
+
+    :param dest_path:  The path to the destination directory where the journal is stored.
+    :param src_path:  The path to the source directory, a journal of another source is discarded.
+    """
+    def __init__(self, dest_path: Path, src_path: Path):
+        self.path = dest_path / JOURNAL_NAME
+        self.done = set()
+        self.pending = []
+        self.last_sync = time.monotonic()
+        header = json.dumps({'source': str(src_path.resolve())})
+
+        try:
+            with open(self.path, encoding='utf-8') as journal:
+                lines = journal.read().splitlines()
+
+            # If the journal belongs to an interrupted run of the same source #
+            if lines and lines[0] == header:
+                self.done = {json.loads(line) for line in lines[1:] if line}
+
+        # If there is no journal to resume #
+        except FileNotFoundError:
+            pass
+
+        # Start a new journal unless resuming #
+        self.file = open(self.path, 'a' if self.done else 'w', encoding='utf-8')
+
+        # If not resuming, write the header of the new journal #
+        if not self.done:
+            self.file.write(f'{header}\n')
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+    def is_done(self, rel_dir: Path) -> bool:
+        """
+        Checks whether the subtree was checkpointed by an interrupted run.
+
+        :param rel_dir:  The path of the subtree relative to the base path.
+        :return:  True if the subtree can be skipped, False otherwise.
+        """
+        return rel_dir.as_posix() in self.done
+
+    def checkpoint(self, checkpoint: Checkpoint):
+        """
+        Queues the completed subtree, registered as a copy engine checkpoint listener.
+
+        :param checkpoint:  The checkpoint of the completed subtree.
+        :return:  Nothing
+        """
+        self.pending.append(checkpoint.rel_dir)
+
+        # If the checkpoint interval elapsed #
+        if time.monotonic() - self.last_sync >= CHECKPOINT_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        """
+        Syncs the copied data to disk, then appends the queued checkpoints to the journal.
+
+        :return:  Nothing
+        """
+        self.last_sync = time.monotonic()
+        # If there are no queued checkpoints #
+        if not self.pending:
+            return
+
+        # The copied data has to be durable before the journal claims it, only the destination #
+        # file system is flushed so other file systems on a busy host are not stalled #
+        sync_fs(self.path.parent)
+
+        self.file.write(''.join(f'{json.dumps(rel_dir)}\n' for rel_dir in self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending.clear()
+
+    def close(self, complete: bool = False):
+        """
+        Closes the journal, deleting it if the run completed.
+
+        :param complete:  Toggle set when the run finished without errors.
+        :return:  Nothing
+        """
+        # If the run completed, there is nothing left to resume #
+        if complete:
+            self.file.close()
+            self.path.unlink(missing_ok=True)
+            return
+
+        self.sync()
+        self.file.close()
+
+
+# Read buffer of each hashing thread, reused across files #
+HASH_BUFFERS = threading.local()
+
+
+def file_digest(file_path: Path, algorithm: str) -> str:
+    """
+    Hashes the file in a streaming manner through a fixed-size buffer reused by the thread.
+
+    :param file_path:  The path of the file to hash.
+    :param algorithm:  The hash algorithm, blake2b or sha256.
+    :return:  The hex digest of the file.
+    """
+    buffer = getattr(HASH_BUFFERS, 'buffer', None)
+    # If the thread has no buffer yet #
+    if buffer is None:
+        buffer = HASH_BUFFERS.buffer = bytearray(BUFFER_SIZE)
+
+    view = memoryview(buffer)
+    hasher = hashlib.new(algorithm)
+
+    with open(file_path, 'rb', buffering=0) as file:
+        while size := file.readinto(buffer):
+            # The hash update releases the GIL, so several threads hash in parallel #
+            hasher.update(view[:size])
+
+    return hasher.hexdigest()
+
+
+class DigestCache:
+    """
+    SQLite cache of file digests stored in the destination root, keyed on the path, size and
+    modification time of the file, so files unchanged since they were last hashed are not read
+    again. The cache trusts those keys, so it only holds the source digests of the verification
+    pass. The cache is shared by the hashing threads through a lock.
+
+    :param dest_path:  The path to the destination directory where the cache is stored.
+    """
+    def __init__(self, dest_path: Path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dest_path / DIGEST_CACHE_NAME, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT, algorithm TEXT,'
+                          ' size INTEGER, mtime_ns INTEGER, digest TEXT,'
+                          ' PRIMARY KEY (path, algorithm))')
+        self.hits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def digest(self, file_path: Path, algorithm: str) -> str:
+        """
+        Gets the digest of the file from the cache, hashing the file if it changed since.
+
+        :param file_path:  The path of the file.
+        :param algorithm:  The hash algorithm, blake2b or sha256.
+        :return:  The hex digest of the file.
+        """
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), algorithm)
+
+        with self.lock:
+            row = self.conn.execute('SELECT digest FROM digests WHERE path = ? AND algorithm = ?'
+                                    ' AND size = ? AND mtime_ns = ?',
+                                    (*key, stat.st_size, stat.st_mtime_ns)).fetchone()
+            # If the file is unchanged since it was last hashed #
+            if row is not None:
+                self.hits += 1
+                return row[0]
+
+        digest = file_digest(file_path, algorithm)
+
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)',
+                              (*key, stat.st_size, stat.st_mtime_ns, digest))
+
+        return digest
+
+    def close(self):
+        """
+        Commits the cached digests and closes the database connection.
+
+        :return:  Nothing
+        """
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class Mirror:
+    """
+    Propagates the deletions and renames of the source to the destination. Each directory is
+    diffed with a set difference of one scan per side, the extra destination files are kept as
+    rename candidates keyed by their size and modification time until the walk ends, and the ones
+    not claimed by a new source file with the same content are then deleted or moved to a
+    quarantine directory.
+
+    :param dest_path:  The path to the destination directory.
+    :param quarantine:  Toggle to move the extra entries into the quarantine instead of deleting.
+    :param path_filter:  The include and exclude rules, the excluded entries are left alone.
+    """
+    def __init__(self, dest_path: Path, quarantine: bool = False, path_filter: PathFilter = None):
+        self.root = dest_path
+        self.path_filter = path_filter
+        self.quarantine = None
+        self.candidates = {}
+        self.extra_files = []
+        self.extra_dirs = []
+        self.renamed = 0
+        self.removed = 0
+
+        # If the extra entries are kept in a quarantine directory for this run #
+        if quarantine:
+            self.quarantine = dest_path / QUARANTINE_NAME / \
+                              datetime.now().strftime(GENERATION_FORMAT)
+
+    def add_candidate(self, entry: os.DirEntry):
+        """
+        Adds the extra destination file as a rename candidate.
+
+        :param entry:  The directory entry of the extra file.
+        :return:  Nothing
+        """
+        # If the entry is a symlink, it is never renamed into place of a regular file #
+        if entry.is_symlink():
+            return
+
+        self.candidates.setdefault(entry_meta(entry), []).append(Path(entry.path))
+
+    def diff(self, rel_dir: Path, dir_entries: list, file_entries: list,
+             engine: CopyEngine) -> dict:
+        """
+        Scans the destination directory once and diffs it against the source directory. Extra \
+        entries clashing with a source entry of the other type are removed right away, the rest \
+        are deferred as rename candidates.
+
+        :param rel_dir:  The path of the directory relative to the base path.
+        :param dir_entries:  The source directory entries, None to leave directories alone.
+        :param file_entries:  The source file entries.
+        :param engine:  The copy engine the removals are reported through.
+        :return:  The file name to directory entry dict of the destination files to compare.
+        """
+        dest_dirs, dest_file_entries = scan_tree_dir(self.root / rel_dir)
+        src_dirs = {entry.name for entry in dir_entries} if dir_entries is not None else None
+        src_files = {entry.name for entry in file_entries}
+        dest_entries = {}
+
+        # If the directories are diffed too #
+        if src_dirs is not None:
+            for entry in dest_dirs:
+                # If the directory is in the source or is left alone #
+                if entry.name in src_dirs or self.protected(rel_dir, entry, True):
+                    continue
+
+                # If a source file replaces the directory, remove it before the copy #
+                if entry.name in src_files or entry.is_symlink():
+                    engine.notify(self.remove(Path(entry.path)))
+                    continue
+
+                # The files of the extra subtree may have been moved elsewhere in the source #
+                for _, _, extra_files in walk_tree(Path(entry.path)):
+                    for extra_file in extra_files:
+                        self.add_candidate(extra_file)
+
+                self.extra_dirs.append(Path(entry.path))
+
+        for entry in dest_file_entries:
+            # If the file is in the source, it is compared for changes #
+            if entry.name in src_files:
+                dest_entries[entry.name] = entry
+            # If the file is left alone #
+            elif self.protected(rel_dir, entry, False):
+                continue
+            # If a source directory replaces the file, remove it before the directory is created #
+            elif src_dirs is not None and entry.name in src_dirs:
+                engine.notify(self.remove(Path(entry.path)))
+            else:
+                self.add_candidate(entry)
+                self.extra_files.append(Path(entry.path))
+
+        return dest_entries
+
+    def protected(self, rel_dir: Path, entry: os.DirEntry, is_dir: bool) -> bool:
+        """
+        Checks whether the destination entry belongs to Backup Buddy or is excluded from the copy \
+        by the path filter, like rsync the excluded entries are not deleted.
+
+        :param rel_dir:  The path of the entry's directory relative to the base path.
+        :param entry:  The directory entry of the destination entry.
+        :param is_dir:  Toggle to check the entry as a directory.
+        :return:  True if the entry is never removed, False otherwise.
+        """
+        # If the entry belongs to Backup Buddy #
+        if rel_dir == Path('.') and entry.name.startswith(TOOL_PREFIX):
+            return True
+        # If every entry is copied #
+        if self.path_filter is None:
+            return False
+
+        rel_path = (rel_dir / entry.name).as_posix()
+        # If the entry is a directory, only the glob rules apply #
+        if is_dir:
+            return self.path_filter.excluded(rel_path, True)
+
+        return not self.path_filter.keep_file(entry, rel_path)
+
+    def rename(self, src_entry: os.DirEntry, dest_file: Path) -> str:
+        """
+        Moves an extra destination file into place of the new source file if it is the single \
+        candidate with the same size and modification time and the same content, instead of \
+        copying the file again. Unrelated files can share the size and modification time, so \
+        the content is compared before the move and a mismatch falls back to a normal copy.
+
+        :param src_entry:  The directory entry of the new source file.
+        :param dest_file:  The dest file where the source file would be copied to.
+        :return:  The message to report if the file was renamed, otherwise None.
+        """
+        candidates = self.candidates.get(entry_meta(src_entry))
+
+        # If there is no candidate, or several and the match is ambiguous #
+        if not candidates or len(candidates) > 1:
+            return None
+
+        # If the candidate holds different data, it is not the renamed file #
+        if file_digest(Path(src_entry.path), 'blake2b') != file_digest(candidates[0], 'blake2b'):
+            return None
+
+        old_file = candidates.pop()
+        os.replace(old_file, dest_file)
+        self.renamed += 1
+        return f'File Renamed: {old_file} -> {dest_file}'
+
+    def remove(self, extra_path: Path) -> str:
+        """
+        Deletes the extra destination entry, or moves it into the quarantine directory.
+
+        :param extra_path:  The path of the extra entry.
+        :return:  The message to report.
+        """
+        kind = 'Directory' if extra_path.is_dir() and not extra_path.is_symlink() else 'File'
+        self.removed += 1
+
+        # If the extra entries are quarantined #
+        if self.quarantine is not None:
+            target = self.quarantine / extra_path.relative_to(self.root)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(extra_path, target)
+            return f'{kind} Quarantined: {extra_path}'
+
+        # If the entry is a directory #
+        if kind == 'Directory':
+            shutil.rmtree(extra_path)
+        else:
+            extra_path.unlink()
+
+        return f'{kind} Removed: {extra_path}'
+
+    def finish(self, engine: CopyEngine):
+        """
+        Removes the extra entries which were not renamed into place once the walk is done.
+
+        :param engine:  The copy engine the removals are reported through.
+        :return:  Nothing
+        """
+        for extra_path in self.extra_files:
+            # If the file was not renamed into place #
+            if extra_path.exists():
+                engine.notify(self.remove(extra_path))
+
+        for extra_path in self.extra_dirs:
+            engine.notify(self.remove(extra_path))
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket refilled at a fixed rate and holding at most a burst of tokens. Takes
+    larger than the available tokens go into debt, making the next takers wait it off.
+
+    :param rate:  The tokens added per second.
+    :param burst:  The max number of tokens the bucket holds.
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount: float):
+        """
+        Takes the tokens from the bucket, sleeping until they are paid off.
+
+        :param amount:  The number of tokens to take.
+        :return:  Nothing
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        # If the bucket is in debt, wait until it is paid off #
+        if wait:
+            time.sleep(wait)
+
+
+class Throttle:
+    """
+    Limits the copies so a backup does not starve production I/O. Every I/O call of the copy path
+    takes from a bandwidth and an IOPS token bucket. In adaptive mode the latency of the calls is
+    smoothed and compared against a slowly drifting baseline, the number of concurrent copies is
+    halved when the latency rises past the backoff factor and grows back one at a time otherwise.
+    Used as a context manager, the throttle holds a concurrent copy slot.
+
+    :param bandwidth:  The max bytes per second, None for no limit.
+    :param iops:  The max I/O calls per second, None for no limit.
+    :param workers:  The max number of concurrent copies in adaptive mode, zero to disable it.
+    """
+    def __init__(self, bandwidth: int = None, iops: int = None, workers: int = 0):
+        # Both buckets hold up to a second of their rate #
+        self.bandwidth = TokenBucket(bandwidth, bandwidth) if bandwidth else None
+        self.iops = TokenBucket(iops, iops) if iops else None
+        self.adaptive = workers > 0
+        self.limit = self.max_limit = max(1, workers)
+        self.active = 0
+        self.cond = threading.Condition()
+        self.latency = None
+        self.baseline = None
+        self.last_adjust = time.monotonic()
+
+    def __enter__(self):
+        with self.cond:
+            # If adaptive mode backed off, wait for a free copy slot #
+            while self.adaptive and self.active >= self.limit:
+                self.cond.wait()
+
+            self.active += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def acquire(self, size: int):
+        """
+        Takes the tokens of a single I/O call, sleeping while over the limits.
+
+        :param size:  The number of bytes the call transfers.
+        :return:  Nothing
+        """
+        # If the IOPS are limited #
+        if self.iops is not None:
+            self.iops.take(1)
+        # If the bandwidth is limited #
+        if self.bandwidth is not None and size:
+            self.bandwidth.take(size)
+
+    def record(self, seconds: float):
+        """
+        Records the latency of an I/O call, adjusting the concurrency limit once per interval.
+
+        :param seconds:  The latency of the call.
+        :return:  Nothing
+        """
+        # If adaptive mode is disabled #
+        if not self.adaptive:
+            return
+
+        with self.cond:
+            self.latency = seconds if self.latency is None else \
+                           self.latency + ADAPT_ALPHA * (seconds - self.latency)
+            now = time.monotonic()
+
+            # If the concurrency was adjusted recently #
+            if now - self.last_adjust < ADAPT_INTERVAL:
+                return
+
+            self.last_adjust = now
+            # The baseline follows drops right away and rises slowly, so a lasting change in #
+            # load is eventually accepted as the new normal #
+            self.baseline = self.latency if self.baseline is None else \
+                            min(self.latency, self.baseline * ADAPT_DRIFT)
+
+            # If the device latency went up, back off #
+            if self.latency > self.baseline * ADAPT_BACKOFF:
+                self.limit = max(1, self.limit // 2)
+            # If the latency is normal, let one more copy run #
+            elif self.limit < self.max_limit:
+                self.limit += 1
+                self.cond.notify()
+
+
+def set_io_priority(io_class: str, level: int = 7) -> bool:
+    """
+    Sets the I/O scheduling class of the process with the Linux ioprio_set syscall, inherited by \
+    the threads created afterwards.
+
+    :param io_class:  The I/O class, idle or best-effort.
+    :param level:  The priority level within the best-effort class, 0 highest to 7 lowest.
+    :return:  True if the priority was set, False if unsupported.
+    """
+    syscall_number = IOPRIO_SET_SYSCALLS.get(os.uname().machine) \
+                     if sys.platform.startswith('linux') else None
+    # If the platform does not support ioprio_set #
+    if syscall_number is None:
+        return False
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    priority = IOPRIO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT | \
+               (level if io_class == 'best-effort' else 0)
+
+    # If the syscall failed #
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, priority) < 0:
+        logging.warning('ioprio_set failed: %s', os.strerror(ctypes.get_errno()))
+        return False
+
+    return True
+
+
+# Whole file buffer of each thread copying small files, reused across files #
+SMALL_BUFFERS = threading.local()
+
+
+class CopyBackend:
+    """
+    Tiered copy backend which tries a reflink clone, then os.copy_file_range, then os.sendfile and \
+    falls back to a buffered copy. A tier that is unsupported between a pair of file systems is
+    skipped for the rest of the run, and the tier used for each file is tallied for the run report.
+    Large files which already exist in the destination can instead be delta updated, rewriting
+    only the blocks that changed, and small new files can be copied whole in batches. Files past
+    the range size threshold which cannot be cloned are preallocated and copied as byte ranges in
+    parallel by a pool of range workers, so striped and NVMe devices see several outstanding I/Os
+    instead of one sequential stream.
+
+    :param delta_min_size:  The minimum size of files to delta update, zero disables delta updates.
+    :param signatures:  The manifest storing the block signatures, None to compare the blocks
+                        against the destination file contents.
+    :param metrics:  The phase metrics of the run, None to disable them.
+    :param checksum:  The hash algorithm comparing the contents of same sized files instead of
+                      their modification times, None to compare the modification times.
+    :param throttle:  The bandwidth, IOPS and concurrency limits of the copies, None to disable.
+    :param drop_cache:  Toggle to drop the copied files from the page cache.
+    :param range_workers:  The number of threads copying the ranges of a large file, one disables
+                           the ranged copies.
+    :param range_min_size:  The minimum size of files to copy as parallel ranges.
+    :param range_size:  The size of the ranges a large file is split into.
+    :param small_size:  The size below which new files are copied whole through a reused buffer
+                        in batches, zero disables the batches.
+    :param durability:  When the copied data is synced to disk, one of DURABILITY_LEVELS.
+    """
+    TIERS = ('reflink', 'ranged', 'copy_file_range', 'sendfile', 'buffered')
+
+    def __init__(self, delta_min_size: int = 0, signatures: 'Manifest' = None,
+                 metrics: Metrics = None, checksum: str = None, throttle: 'Throttle' = None,
+                 drop_cache: bool = False, range_workers: int = 1,
+                 range_min_size: int = DEFAULT_RANGE_MIN_SIZE,
+                 range_size: int = DEFAULT_RANGE_SIZE, small_size: int = 0,
+                 durability: str = 'none'):
+        self.delta_min_size = delta_min_size
+        self.signatures = signatures
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.checksum = checksum
+        self.throttle = throttle
+        self.drop_cache = drop_cache
+        self.range_min_size = range_min_size
+        self.range_size = range_size
+        self.small_size = small_size
+        self.durability = durability
+        self.range_pool = None
+        # If large files are copied as parallel ranges #
+        if range_workers > 1:
+            self.range_pool = ThreadPoolExecutor(max_workers=range_workers,
+                                                 thread_name_prefix='range_worker')
+        self.lock = threading.Lock()
+        self.disabled = set()
+        self.counts = Counter()
+        self.delta_written = 0
+
+    def available(self, tier: str, devices: tuple, size: int) -> bool:
+        """
+        Checks whether the copy tier can be attempted between the pair of devices.
+
+        :param tier:  The name of the copy tier.
+        :param devices:  The source and destination device ids.
+        :param size:  The size of the source file.
+        :return:  True if the tier can be attempted, False otherwise.
+        """
+        # If the tier already failed as unsupported between the devices #
+        if (tier, devices) in self.disabled:
+            return False
+
+        # Ensure the platform supports the tier #
+        if tier == 'reflink':
+            return fcntl is not None and os.name != 'nt'
+        if tier == 'copy_file_range':
+            return hasattr(os, 'copy_file_range')
+        if tier == 'sendfile':
+            return hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+        # Only files spanning several ranges are split #
+        if tier == 'ranged':
+            return self.range_pool is not None and hasattr(os, 'pwrite') and \
+                   size >= max(self.range_min_size, self.range_size + 1)
+
+        return True
+
+    def copy(self, src_file: Path, dest_file: Path) -> str:
+        """
+        Copies the source file to the destination with the fastest tier available.
+
+        :param src_file:  The source file to be copied.
+        :param dest_file:  The dest file where the source file will be copied to.
+        :return:  The name of the tier which copied the file.
+        """
+        with open(src_file, 'rb') as src:
+            dest_fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0),
+                              0o666)
+            with open(dest_fd, 'wb') as dest:
+                src_stat = os.fstat(src.fileno())
+                dest_stat = os.fstat(dest_fd)
+
+                # If the source and destination are the same file #
+                if (src_stat.st_dev, src_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino):
+                    raise shutil.SameFileError(f'{src_file} and {dest_file} are the same file')
+
+                devices = (src_stat.st_dev, dest_stat.st_dev)
+
+                for tier in self.TIERS:
+                    # If the tier is not supported #
+                    if not self.available(tier, devices, src_stat.st_size):
+                        continue
+
+                    # Discard any partial data from a previous tier #
+                    os.ftruncate(dest_fd, 0)
+
+                    try:
+                        getattr(self, f'{tier}_copy')(src, dest, src_stat.st_size)
+
+                    # If the tier is unsupported for this pair of file systems #
+                    except OSError as copy_err:
+                        if copy_err.errno not in UNSUPPORTED_ERRNOS or tier == 'buffered':
+                            raise
+
+                        with self.lock:
+                            self.disabled.add((tier, devices))
+                        continue
+
+                    break
+
+                # If every file is synced on its own, sync before the caller renames it #
+                if self.durability == 'file':
+                    os.fsync(dest_fd)
+
+                self.drop_pages(src, dest)
+
+        # Copy the permission bits like shutil.copy #
+        shutil.copymode(src_file, dest_file)
+
+        with self.lock:
+            self.counts[tier] += 1
+
+        return tier
+
+    def copy_small(self, src_file: Path, dest_file: Path) -> bool:
+        """
+        Copies a small file by reading it whole into a buffer reused by the thread and writing it \
+        with a single call, without the tier probing and temporary file of the regular copy. The \
+        metadata is left to the deferred pass of the batch.
+
+        :param src_file:  The source file to be copied.
+        :param dest_file:  The new dest file where the source file will be copied to.
+        :return:  True if the file was copied, False if it grew past the small file size.
+        """
+        buffer = getattr(SMALL_BUFFERS, 'buffer', None)
+        # If the thread has no buffer yet, one byte larger to detect grown files #
+        if buffer is None or len(buffer) != self.small_size + 1:
+            buffer = SMALL_BUFFERS.buffer = bytearray(self.small_size + 1)
+
+        view = memoryview(buffer)
+        size = 0
+
+        with open(src_file, 'rb', buffering=0) as src:
+            while size < len(buffer):
+                count = self.io(len(buffer) - size, src.readinto, view[size:])
+                # If the end of the source file was reached #
+                if not count:
+                    break
+
+                size += count
+
+        # If the file grew past the small file size since it was scanned #
+        if size > self.small_size:
+            return False
+
+        dest_fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                          getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            written = 0
+            while written < size:
+                written += self.io(0, os.write, dest_fd, view[written:size])
+
+            # If every file is synced on its own #
+            if self.durability == 'file':
+                os.fsync(dest_fd)
+        finally:
+            os.close(dest_fd)
+
+        with self.lock:
+            self.counts['small'] += 1
+
+        return True
+
+    def io(self, size: int, func, *args):
+        """
+        Runs a single I/O call through the throttle, recording its latency for adaptive mode.
+
+        :param size:  The number of bytes the call transfers, counted against the bandwidth limit.
+        :param func:  The I/O function to call.
+        :param args:  The arguments to pass into the function.
+        :return:  The return value of the function.
+        """
+        # If the copies are not throttled #
+        if self.throttle is None:
+            return func(*args)
+
+        self.throttle.acquire(size)
+        start = time.perf_counter()
+        result = func(*args)
+        self.throttle.record(time.perf_counter() - start)
+        return result
+
+    def chunk_size(self) -> int:
+        """
+        Gets the max bytes per kernel copy call, small enough to throttle and sample if throttled.
+
+        :return:  The chunk size in bytes.
+        """
+        return 1 << 30 if self.throttle is None else BUFFER_SIZE
+
+    def reflink_copy(self, src, dest, _):
+        """
+        Clones the source extents into the destination on copy-on-write file systems.
+
+        :param src:  The open source file.
+        :param dest:  The open destination file.
+        :return:  Nothing
+        """
+        self.io(0, fcntl.ioctl, dest.fileno(), FICLONE, src.fileno())
+
+    def copy_file_range_copy(self, src, dest, size: int):
+        """
+        Copies the source into the destination inside the kernel with copy_file_range.
+
+        :param src:  The open source file.
+        :param dest:  The open destination file.
+        :param size:  The size of the source file.
+        :return:  Nothing
+        """
+        chunk = self.chunk_size()
+        offset = 0
+
+        while True:
+            copied = self.io(min(chunk, max(size - offset, 0)), os.copy_file_range,
+                             src.fileno(), dest.fileno(), chunk, offset, offset)
+            # If the end of the source file was reached #
+            if not copied:
+                break
+
+            offset += copied
+
+        # If nothing was copied from a non-empty file the file system does not support it #
+        if size and not offset:
+            raise OSError(errno.EOPNOTSUPP, 'copy_file_range copied no data')
+
+    def ranged_copy(self, src, dest, size: int):
+        """
+        Preallocates the destination and copies the byte ranges of the source in parallel across \
+        the range workers. The copy is only complete once every range is, the caller renames the \
+        temporary file into place afterwards.
+
+        :param src:  The open source file.
+        :param dest:  The open destination file.
+        :param size:  The size of the source file.
+        :return:  Nothing
+        """
+        os.ftruncate(dest.fileno(), size)
+
+        # If the OS supports preallocation, reserve the blocks so the ranges do not fragment #
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(dest.fileno(), 0, size)
+
+            # If the file system does not support preallocation, the file is left sparse #
+            except OSError as alloc_err:
+                if alloc_err.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+
+        futures = [self.range_pool.submit(self.copy_range, src.fileno(), dest.fileno(), offset,
+                                          min(offset + self.range_size, size))
+                   for offset in range(0, size, self.range_size)]
+
+        # Wait on every range before raising, so no worker writes into a removed file #
+        for future in futures:
+            future.exception()
+        for future in futures:
+            future.result()
+
+    def copy_range(self, src_fd: int, dest_fd: int, offset: int, end: int):
+        """
+        Copies a byte range of the source into the same range of the destination, inside the \
+        kernel with copy_file_range when supported, otherwise with pread and pwrite.
+
+        :param src_fd:  The file descriptor of the open source file.
+        :param dest_fd:  The file descriptor of the open destination file.
+        :param offset:  The offset of the start of the range.
+        :param end:  The offset of the end of the range.
+        :return:  Nothing
+        """
+        chunk = self.chunk_size()
+
+        # If copy_file_range is available #
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while offset < end:
+                    copied = self.io(min(chunk, end - offset), os.copy_file_range, src_fd,
+                                     dest_fd, min(chunk, end - offset), offset, offset)
+                    # If the source file was truncated during the copy #
+                    if not copied:
+                        return
+
+                    offset += copied
+                return
+
+            # If copy_file_range is unsupported, copy the rest of the range in user space #
+            except OSError as copy_err:
+                if copy_err.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+
+        while offset < end:
+            data = self.io(min(BUFFER_SIZE, end - offset), os.pread, src_fd,
+                           min(BUFFER_SIZE, end - offset), offset)
+            # If the source file was truncated during the copy #
+            if not data:
+                return
+
+            view = memoryview(data)
+            while view:
+                written = self.io(0, os.pwrite, dest_fd, view, offset)
+                view = view[written:]
+                offset += written
+
+    def sendfile_copy(self, src, dest, size: int):
+        """
+        Copies the source into the destination inside the kernel with sendfile.
+
+        :param src:  The open source file.
+        :param dest:  The open destination file.
+        :param size:  The size of the source file.
+        :return:  Nothing
+        """
+        chunk = self.chunk_size()
+        offset = 0
+        os.lseek(dest.fileno(), 0, os.SEEK_SET)
+
+        while True:
+            sent = self.io(min(chunk, max(size - offset, 0)), os.sendfile, dest.fileno(),
+                           src.fileno(), offset, chunk)
+            # If the end of the source file was reached #
+            if not sent:
+                break
+
+            offset += sent
+
+        # If nothing was copied from a non-empty file the file system does not support it #
+        if size and not offset:
+            raise OSError(errno.EOPNOTSUPP, 'sendfile copied no data')
+
+    def buffered_copy(self, src, dest, _):
+        """
+        Copies the source into the destination through a user space buffer.
+
+        :param src:  The open source file.
+        :param dest:  The open destination file.
+        :return:  Nothing
+        """
+        src.seek(0)
+        dest.seek(0)
+
+        # If the copies are not throttled #
+        if self.throttle is None:
+            shutil.copyfileobj(src, dest, BUFFER_SIZE)
+            return
+
+        # The bandwidth is counted on the writes, the last read returns no data #
+        while data := self.io(0, src.read, BUFFER_SIZE):
+            self.io(len(data), dest.write, data)
+
+    def drop_pages(self, *files):
+        """
+        Advises the kernel to drop the cached pages of the copied files, so a backup does not \
+        evict the hot page cache. Dirty destination pages are only dropped after writeback.
+
+        :param files:  The open files.
+        :return:  Nothing
+        """
+        # If the page cache is kept or the OS does not support fadvise #
+        if not self.drop_cache or not hasattr(os, 'posix_fadvise'):
+            return
+
+        for file in files:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def use_delta(self, size: int) -> bool:
+        """
+        Checks whether an existing destination file of the passed in size is delta updated.
+
+        :param size:  The size of the source file.
+        :return:  True if the file should be delta updated, False otherwise.
+        """
+        return 0 < self.delta_min_size <= size
+
+    def delta_update(self, src_file: Path, dest_file: Path) -> bytes:
+        """
+        Rewrites in place only the blocks of the destination file that differ from the source. \
+        Blocks are compared against the signature stored in the manifest when available, \
+        otherwise against the destination file contents.
+
+        :param src_file:  The source file to be copied.
+        :param dest_file:  The existing dest file to be updated.
+        :return:  The block signature of the updated file.
+        """
+        old_signature = None
+        # If the manifest stores block signatures #
+        if self.signatures is not None:
+            old_signature = self.signatures.signature(dest_file, DELTA_BLOCK_SIZE)
+
+        src_buffer = bytearray(DELTA_BLOCK_SIZE)
+        dest_buffer = bytearray(DELTA_BLOCK_SIZE)
+        hashes = []
+        offset = written = 0
+
+        with open(src_file, 'rb') as src, open(dest_file, 'r+b') as dest:
+            while True:
+                count = self.io(DELTA_BLOCK_SIZE, src.readinto, src_buffer)
+                # If the end of the source file was reached #
+                if not count:
+                    break
+
+                block = memoryview(src_buffer)[:count]
+                digest = hashlib.blake2b(block, digest_size=DELTA_HASH_SIZE).digest()
+                start = len(hashes) * DELTA_HASH_SIZE
+                hashes.append(digest)
+
+                # If the stored signature is available compare the hashes #
+                if old_signature is not None:
+                    unchanged = old_signature[start:start + DELTA_HASH_SIZE] == digest
+                # Otherwise compare against the destination block #
+                else:
+                    dest.seek(offset)
+                    unchanged = self.io(0, dest.readinto, dest_buffer) == count and \
+                                memoryview(dest_buffer)[:count] == block
+
+                # If the block changed, rewrite it in place #
+                if not unchanged:
+                    dest.seek(offset)
+                    self.io(0, dest.write, block)
+                    written += count
+
+                offset += count
+
+            # Drop any data past the end of the source file #
+            dest.truncate(offset)
+            dest.flush()
+
+            # If every file is synced on its own #
+            if self.durability == 'file':
+                os.fsync(dest.fileno())
+
+            self.drop_pages(src, dest)
+
+        with self.lock:
+            self.counts['delta'] += 1
+            self.delta_written += written
+
+        return b''.join(hashes)
+
+    def summary(self) -> str:
+        """
+        Formats the number of files copied per tier during the run.
+
+        :return:  The formatted copy tier tally.
+        """
+        with self.lock:
+            tally = [f'{tier}={self.counts[tier]}' for tier in self.TIERS if self.counts[tier]]
+
+            # If any small files were copied in batches #
+            if self.counts['small']:
+                tally.append(f'small={self.counts["small"]}')
+            # If any files were delta updated #
+            if self.counts['delta']:
+                tally.append(f'delta={self.counts["delta"]} ({self.delta_written} bytes'
+                             ' rewritten)')
+
+        return ', '.join(tally)
+
+    def close(self):
+        """
+        Shuts down the range worker pool.
+
+        :return:  Nothing
+        """
+        # If a range worker pool was created #
+        if self.range_pool is not None:
+            self.range_pool.shutdown(wait=True)
+            self.range_pool = None
+
+
+def part_path(dest_file: Path) -> Path:
+    """
+    Formats the hidden temporary path a file is written to before it is renamed into place.
+
+    :param dest_file:  The final path of the file.
+    :return:  The temporary path next to the file.
+    """
+    return dest_file.with_name(f'.{dest_file.name}.part')
+
+
+def copy_file(src_file: Path, dest_file: Path, src_meta: FileMeta, backend: CopyBackend,
+              update: bool = False) -> bytes:
+    """
+    Copies file in error validated wrapper, keeping the modification time of the source file. \
+    Full copies are written to a temporary file which is renamed over the dest file once complete, \
+    so an interrupted copy never leaves a truncated file that looks up to date.
+
+    :param src_file:  The source file to be copied.
+    :param dest_file:  The dest file where the source file will be copied to.
+    :param src_meta:  The metadata of the source file.
+    :param backend:  The tiered copy backend used for the run.
+    :param update:  Toggle set when the dest file already exists and may be delta updated.
+    :return:  The block signature if the file was delta updated, otherwise None.
+    """
+    signature = None
+    start = time.perf_counter()
+
+    # If the copies are throttled, hold one of the concurrent copy slots #
+    with backend.throttle if backend.throttle is not None else nullcontext():
+        # If the existing dest file is large enough to be delta updated #
+        if update and backend.use_delta(src_meta.size):
+            # The modification time is set last, so an interrupted update is redone next run #
+            signature = backend.delta_update(src_file, dest_file)
+            os.utime(dest_file, ns=(time.time_ns(), src_meta.mtime_ns))
+        else:
+            temp_file = part_path(dest_file)
+
+            try:
+                # Copy file from source to the temporary file #
+                backend.copy(src_file, temp_file)
+                # Keep the source modification time so unchanged files are detected later #
+                os.utime(temp_file, ns=(time.time_ns(), src_meta.mtime_ns))
+                os.replace(temp_file, dest_file)
+
+            # If unexpected same file error occurs #
+            except shutil.SameFileError:
+                return None
+
+            # If the copy failed or was interrupted, do not leave the temporary file behind #
+            except BaseException:
+                temp_file.unlink(missing_ok=True)
+                raise
+
+    backend.metrics.record('copy', time.perf_counter() - start, src_file, src_meta.size)
+    return signature
+
+
+def copy_handler(src_entry: os.DirEntry, dest_file: Path, dest_entry: os.DirEntry,
+                 backend: CopyBackend, deferred: list = None) -> CopyResult:
+    """
+    If file exists check if the source file size or modification time differs from the \
+    destination file, if so copy the file. If the file does not exist, simply copy the file.
+
+    :param src_entry:  The directory entry of the source file to be copied.
+    :param dest_file:  The dest file where the source file will be copied to.
+    :param dest_entry:  The directory entry or manifest metadata of the dest file, None if it \
+                        does not exist.
+    :param backend:  The tiered copy backend used for the run.
+    :param deferred:  The metadata list of a batch, new small files are copied whole and their \
+                      metadata appended to it, None to copy every file on its own.
+    :return:  The result to report if the file was copied, otherwise None.
+    """
+    start = time.perf_counter()
+    src_meta = entry_meta(src_entry)
+    dest_meta = entry_meta(dest_entry) if dest_entry is not None else None
+    backend.metrics.record('stat', time.perf_counter() - start)
+
+    # If the contents of same sized files are compared, as their mtimes cannot be trusted #
+    if backend.checksum and dest_meta is not None and src_meta.size == dest_meta.size:
+        # If the contents are identical #
+        if file_digest(Path(src_entry.path), backend.checksum) == \
+        file_digest(dest_file, backend.checksum):
+            return None
+    # If the source file is unchanged since the last copy #
+    elif not file_changed(src_meta, dest_meta):
+        return None
+
+    signature = None
+    start = time.perf_counter()
+
+    # If the file is new and small, copy it whole and leave its metadata to the batch. Existing #
+    # files are replaced atomically instead so an interrupted batch never loses the old copy #
+    if deferred is not None and dest_meta is None and src_meta.size <= backend.small_size:
+        with backend.throttle if backend.throttle is not None else nullcontext():
+            copied = backend.copy_small(Path(src_entry.path), dest_file)
+    else:
+        copied = False
+
+    # If the file was copied whole #
+    if copied:
+        deferred.append((dest_file, src_meta, src_entry.stat().st_mode))
+        backend.metrics.record('copy', time.perf_counter() - start, Path(src_entry.path),
+                               src_meta.size)
+    else:
+        # Copy the source file to the destination #
+        signature = copy_file(Path(src_entry.path), dest_file, src_meta, backend,
+                              update=dest_meta is not None)
+
+    # If the file already existed #
+    if dest_meta is not None:
+        return CopyResult(f'File Updated: {dest_file}', dest_file, src_meta, signature)
+
+    return CopyResult(f'File Copied: {src_entry.path}', dest_file, src_meta)
+
+
+def batch_handler(jobs: list, backend: CopyBackend) -> list:
+    """
+    Copies a batch of files of a directory in a single job. New small files are written whole, \
+    then their permissions and modification times are applied in a deferred pass once the data \
+    is written. An interrupted batch leaves the small files without the source modification \
+    time, so they are copied again by the next run. With batch durability the file system is \
+    synced once before the batch is reported.
+
+    :param jobs:  The list of (source entry, dest file, dest entry) tuples.
+    :param backend:  The tiered copy backend used for the run.
+    :return:  The list of results to report.
+    """
+    deferred = []
+    results = [copy_handler(src_entry, dest_file, dest_entry, backend, deferred)
+               for src_entry, dest_file, dest_entry in jobs]
+    now = time.time_ns()
+
+    # Apply the metadata of the small files after their data was written #
+    for dest_file, src_meta, mode in deferred:
+        os.chmod(dest_file, mode & 0o7777)
+        os.utime(dest_file, ns=(now, src_meta.mtime_ns))
+
+    # If the batch is synced before it is reported #
+    if backend.durability == 'batch' and any(results):
+        sync_fs(jobs[0][1].parent)
+
+    return results
+
+
+def sync_fs(sync_path: Path):
+    """
+    Flushes the file system holding the path to disk with the Linux syncfs syscall, falling back \
+    to syncing every file system where unavailable.
+
+    :param sync_path:  A path on the file system to sync.
+    :return:  Nothing
+    """
+    # If the OS is Linux, only sync the destination file system #
+    if sys.platform.startswith('linux'):
+        dir_fd = os.open(sync_path, os.O_RDONLY)
+        try:
+            # If the syncfs call succeeded #
+            if ctypes.CDLL(None, use_errno=True).syncfs(dir_fd) == 0:
+                return
+        finally:
+            os.close(dir_fd)
+
+    # If the OS supports sync #
+    if hasattr(os, 'sync'):
+        os.sync()
+
+
+def link_handler(src_entry: os.DirEntry, dest_file: Path, prev_entry: os.DirEntry,
+                 backend: CopyBackend) -> CopyResult:
+    """
+    Fills a snapshot generation like rsync --link-dest, if the source file is unchanged since \
+    the previous generation the file is hardlinked to it instead of copied.
+
+    :param src_entry:  The directory entry of the source file.
+    :param dest_file:  The path of the file in the new generation.
+    :param prev_entry:  The directory entry of the file in the previous generation, None if it \
+                        does not exist.
+    :param backend:  The tiered copy backend used for the run.
+    :return:  The result to report if the file was copied, otherwise None.
+    """
+    # If the source file is unchanged since the previous generation #
+    if prev_entry is not None and not file_changed(entry_meta(src_entry), entry_meta(prev_entry)):
+        try:
+            os.link(prev_entry.path, dest_file)
+            return None
+
+        # If the file system does not support hardlinks or the link count is maxed out #
+        except OSError as link_err:
+            logging.warning('Unable to hardlink %s, copying instead: %s', dest_file, link_err)
+
+    return copy_handler(src_entry, dest_file, None, backend)
+
+
+def dir_copy(dir_path: Path) -> str:
+    """
+    Confirms the directory of the destination path exists. If not, the directory is created to \
+    prevent errors.
+
+    :param dir_path:  The path to the directory to check.
+    :return:  The message to report if the directory was created, otherwise None.
+    """
+    # If the directory does not exist #
+    if not dir_path.exists():
+        # Create the missing directory #
+        dir_path.mkdir()
+        return f'Directory Copied: {dir_path}'
+
+    return None
+
+
+def print_err(msg: str, seconds: int):
+    """
+   Prints time controlled error message via stderr.
+
+    :param msg:  The message to be displayed.
+    :param seconds:  The time interval in seconds the message will be displayed.
+    :return:  Nothing
+    """
+    print(f'\n* [ERROR]: {msg} *\n', file=stderr)
+    # If sleep time is passed in #
+    if seconds:
+        time.sleep(seconds)
+
+
+def file_handler(rel_dir: Path, src_entries: list, dst_path: Path, dest_entries: dict,
+                 engine: CopyEngine, handler=copy_handler):
+    """
+    Handles the file copies of a directory whether it is the base path or a folder in the \
+    recursive path.
+
+    :param rel_dir:  The path of the files' directory relative to the base path.
+    :param src_entries:  The directory entries of the source files to be copied.
+    :param dst_path:  The destination path where the directory is to be created.
+    :param dest_entries:  The scanned files of the destination directory.
+    :param engine:  The copy engine the file copies are queued into.
+    :param handler:  The copy job ran in the worker pool.
+    :return:  Nothing
+    """
+    # Set the destination paths, relative dir is '.' for the base path #
+    jobs = [(src_entry, dst_path / rel_dir / src_entry.name, dest_entries.get(src_entry.name))
+            for src_entry in src_entries]
+
+    queue_copies(jobs, engine, handler)
+
+
+def queue_copies(jobs: list, engine: CopyEngine, handler=copy_handler):
+    """
+    Queues the file copies into the worker pool in order. If the backend batches small files, the \
+    small files missing from the destination are queued in batches of SMALL_BATCH_FILES files per \
+    job, while every other file keeps its own job so larger copies still run concurrently.
+
+    :param jobs:  The list of (source entry, dest file, dest entry) tuples.
+    :param engine:  The copy engine the file copies are queued into.
+    :param handler:  The copy job ran in the worker pool.
+    :return:  Nothing
+    """
+    small_size = engine.backend.small_size if handler is copy_handler else 0
+    batch = []
+
+    for job in jobs:
+        src_entry, _, dest_entry = job
+
+        # If the file is a new small file, it is copied in a batch #
+        if dest_entry is None and small_size and src_entry.stat().st_size <= small_size:
+            batch.append(job)
+
+            # If the batch is full #
+            if len(batch) == SMALL_BATCH_FILES:
+                engine.submit(batch_handler, batch, engine.backend)
+                batch = []
+        else:
+            engine.submit(handler, *job, engine.backend)
+
+    # If a partial batch is left #
+    if batch:
+        engine.submit(batch_handler, batch, engine.backend)
+
+
+def dir_handler(rel_dir: Path, dst_path: Path, folder: str, engine: CopyEngine,
+                manifest: Manifest = None):
+    """
+    Handles the directory copy whether it is the base path or a folder in the recursive path. The \
+    directory is created on the calling thread, so it exists before any of its files are queued.
+
+    :param rel_dir:  The path of the parent directory relative to the base path.
+    :param dst_path:  The destination path where the directory is to be created.
+    :param folder:  The name of the directory to be created.
+    :param engine:  The copy engine the result is reported through.
+    :param manifest:  The destination manifest, None if not in use.
+    :return:  Nothing
+    """
+    # Format the destination path, relative dir is '.' for the base path #
+    dir_path = dst_path / rel_dir / folder
+
+    # If the manifest in use already recorded the directory #
+    if manifest is not None and manifest.has_dir(dir_path):
+        return
+
+    start = time.perf_counter()
+    # Copy the directory #
+    engine.notify(dir_copy(dir_path))
+    engine.metrics.record('mkdir', time.perf_counter() - start)
+
+    # If the manifest is in use #
+    if manifest is not None:
+        manifest.record_dir(dir_path)
+
+
+def single_mode(src_path: Path, dest_path: Path, engine: CopyEngine, manifest: Manifest = None,
+                names: set = None, link_dest: Path = None, mirror: Mirror = None,
+                path_filter: PathFilter = None):
+    """
+    Copies contents of source path to dest path in non-recursive manner.
+
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the destination directory where the data will go.
+    :param engine:  The copy engine the file copies are queued into.
+    :param manifest:  The destination manifest, None if not in use.
+    :param names:  The names of the files to copy, None to copy every file in the directory.
+    :param link_dest:  The previous snapshot generation unchanged files are hardlinked to.
+    :param mirror:  The mirror propagating deletions and renames, None if not in use.
+    :param path_filter:  The include and exclude rules, None to copy every entry.
+    :return:  Nothing
+    """
+    handler = copy_handler if link_dest is None else link_handler
+    start = time.perf_counter()
+    src_entries = scan_files(src_path)
+
+    # If a path filter is in use, skip the excluded files #
+    if path_filter is not None:
+        file_entries = list(src_entries.values())
+        path_filter.apply([], file_entries)
+        src_entries = {entry.name: entry for entry in file_entries}
+    engine.metrics.record('walk', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    # If mirroring, diff the destination files against the source files #
+    if mirror is not None:
+        dest_entries = mirror.diff(Path('.'), None, list(src_entries.values()), engine)
+    # Get the destination files once instead of checking each file #
+    elif link_dest is None:
+        dest_entries = dest_files(dest_path, manifest)
+    else:
+        dest_entries = scan_files(link_dest)
+    engine.metrics.record('dest_scan', time.perf_counter() - start)
+
+    copy_entries = []
+
+    # Iterate through the files of the source directory #
+    for name, src_entry in src_entries.items():
+        # If the file is not one of the selected files #
+        if names is not None and name not in names:
+            continue
+
+        # If mirroring, a new file may be an extra destination file that was renamed #
+        if mirror is not None and name not in dest_entries:
+            message = mirror.rename(src_entry, dest_path / name)
+            # If the file was renamed into place #
+            if message is not None:
+                engine.notify(message)
+                continue
+
+        copy_entries.append(src_entry)
+
+    # Queue the file copies into the worker pool #
+    file_handler(Path('.'), copy_entries, dest_path, dest_entries, engine, handler)
+
+    # If mirroring, remove the extra files which were not renamed #
+    if mirror is not None:
+        mirror.finish(engine)
+
+
+def recursive_copy(src_path: Path, dest_path: Path, engine: CopyEngine,
+                   manifest: Manifest = None, scan_workers: int = 1, link_dest: Path = None,
+                   journal: Journal = None, mirror: Mirror = None,
+                   path_filter: PathFilter = None):
+    """
+    Walks the source path recursively, creating the destination directories and queuing the file \
+    copies into the copy engine. With a journal, a checkpoint is queued behind the last job of \
+    each subtree once the walk leaves it, and subtrees checkpointed by an interrupted run are \
+    skipped.
+
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the destination directory where the data will go.
+    :param engine:  The copy engine the file copies are queued into.
+    :param manifest:  The destination manifest, None if not in use.
+    :param scan_workers:  The number of threads scanning subdirectories ahead of the walk.
+    :param link_dest:  The previous snapshot generation unchanged files are hardlinked to.
+    :param journal:  The checkpoint journal, None if not in use.
+    :param mirror:  The mirror propagating deletions and renames, None if not in use.
+    :param path_filter:  The include and exclude rules, None to copy every entry.
+    :return:  Nothing
+    """
+    handler = copy_handler if link_dest is None else link_handler
+    # Stack of the subtrees the walk is inside of #
+    open_dirs = []
+    walk_start = time.perf_counter()
+
+    # Recursively walk through the file system of the source path #
+    for rel_dir, dir_entries, file_entries in walk_tree(src_path, scan_workers, path_filter):
+        # Record the time spent scanning the directory, excluding the loop body #
+        engine.metrics.record('walk', time.perf_counter() - walk_start)
+
+        # If the checkpoint journal is in use #
+        if journal is not None:
+            # The walk is depth first, so the subtrees it left are fully queued #
+            while open_dirs and open_dirs[-1] not in rel_dir.parents:
+                engine.notify(Checkpoint(open_dirs.pop().as_posix()))
+
+            open_dirs.append(rel_dir)
+
+        dir_path = str(src_path / rel_dir)
+        engine.notify(f'\nIn path: {dir_path}\n{(9 + len(dir_path)) * "*"}')
+
+        start = time.perf_counter()
+        # If mirroring, diff the destination directory against the source directory #
+        if mirror is not None:
+            dest_entries = mirror.diff(rel_dir, dir_entries, file_entries, engine)
+        # Get the destination files once instead of checking each file #
+        elif link_dest is None:
+            dest_entries = dest_files(dest_path / rel_dir, manifest)
+        # In snapshot mode the files of the previous generation are compared instead #
+        else:
+            dest_entries = scan_files(link_dest / rel_dir)
+        engine.metrics.record('dest_scan', time.perf_counter() - start)
+
+        # If the checkpoint journal is in use, skip the subtrees completed by an interrupted run #
+        if journal is not None:
+            dir_entries[:] = [entry for entry in dir_entries
+                              if not journal.is_done(rel_dir / entry.name)]
+
+        # Iterate through the directories #
+        for dir_entry in dir_entries:
+            # Call handler function to check if folder needs to be copied #
+            dir_handler(rel_dir, dest_path, dir_entry.name, engine, manifest)
+
+        copy_entries = []
+
+        # Iterate through the scanned files #
+        for src_entry in file_entries:
+            # If mirroring, a new file may be an extra destination file that was renamed #
+            if mirror is not None and src_entry.name not in dest_entries:
+                message = mirror.rename(src_entry, dest_path / rel_dir / src_entry.name)
+                # If the file was renamed into place #
+                if message is not None:
+                    engine.notify(message)
+                    continue
+
+            copy_entries.append(src_entry)
+
+        # Call handler function to check which files need to be copied #
+        file_handler(rel_dir, copy_entries, dest_path, dest_entries, engine, handler)
+
+        walk_start = time.perf_counter()
+
+    # Checkpoint the subtrees still open at the end of the walk #
+    while open_dirs:
+        engine.notify(Checkpoint(open_dirs.pop().as_posix()))
+
+    # If mirroring, remove the extra entries which were not renamed #
+    if mirror is not None:
+        mirror.finish(engine)
+
+
+def physical_offset(file_path: str) -> int:
+    """
+    Gets the physical offset of the first extent of the file with the FIEMAP ioctl.
+
+    :param file_path:  The path of the file.
+    :return:  The physical byte offset on the device, None if unavailable.
+    """
+    # If the OS does not support ioctl #
+    if fcntl is None:
+        return None
+
+    # Request the mapping of the whole file into a single extent slot #
+    request = FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size)
+
+    try:
+        with open(file_path, 'rb') as file:
+            reply = fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, request)
+
+    # If the file system does not support FIEMAP or the file is unreadable #
+    except OSError:
+        return None
+
+    # If the file has no mapped extents like empty or inline files #
+    if not FIEMAP_HEADER.unpack_from(reply)[3]:
+        return None
+
+    return FIEMAP_EXTENT.unpack_from(reply, FIEMAP_HEADER.size)[1]
+
+
+def plan_copy(src_path: Path, dest_path: Path, recursive: bool, manifest: Manifest = None,
+              scan_workers: int = 1, order: str = 'inode',
+              path_filter: PathFilter = None) -> CopyPlan:
+    """
+    Scans the whole source against the destination up front and builds the plan of directories \
+    to create and files to create or update. The file operations are sorted by source inode \
+    number, or by the physical offset of their first extent where FIEMAP is available, so the \
+    source is read in on-disk order instead of directory order.
+
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the destination directory where the data will go.
+    :param recursive:  Toggle to plan recursively instead of a single directory.
+    :param manifest:  The destination manifest, None if not in use.
+    :param scan_workers:  The number of threads scanning subdirectories ahead of the walk.
+    :param order:  The execution order of the file operations, inode or extent.
+    :param path_filter:  The include and exclude rules, None to copy every entry.
+    :return:  The copy plan.
+    """
+    dirs = []
+    ops = []
+    unchanged = 0
+
+    tree = source_tree(src_path, recursive, scan_workers, path_filter)
+
+    for rel_dir, dir_entries, file_entries in tree:
+        dest_entries = dest_files(dest_path / rel_dir, manifest)
+
+        # Iterate through the directories, the walk is top-down so parents come first #
+        for dir_entry in dir_entries:
+            dir_path = dest_path / rel_dir / dir_entry.name
+            # If the directory is missing from the destination #
+            if not (manifest is not None and manifest.has_dir(dir_path)) \
+            and not dir_path.exists():
+                dirs.append(dir_path)
+
+        # Iterate through the scanned files #
+        for src_entry in file_entries:
+            dest_entry = dest_entries.get(src_entry.name)
+            src_meta = entry_meta(src_entry)
+
+            # If the source file is unchanged since the last copy #
+            if not file_changed(src_meta, entry_meta(dest_entry) if dest_entry is not None
+                                else None):
+                unchanged += 1
+                continue
+
+            offset = physical_offset(src_entry.path) if order == 'extent' else None
+            # Files with a known offset go first in physical order, the rest by inode #
+            key = (0, offset) if offset is not None else (1, src_entry.inode())
+            ops.append(PlanOp(src_entry, dest_path / rel_dir / src_entry.name, dest_entry,
+                              src_meta.size, key))
+
+    ops.sort(key=lambda op: op.key)
+    return CopyPlan(dirs, ops, unchanged)
+
+
+def execute_plan(plan: CopyPlan, engine: CopyEngine, manifest: Manifest = None):
+    """
+    Executes the copy plan, creating every missing directory in one batch before queuing the \
+    file operations in plan order.
+
+    :param plan:  The copy plan.
+    :param engine:  The copy engine the file copies are queued into.
+    :param manifest:  The destination manifest, None if not in use.
+    :return:  Nothing
+    """
+    # The amount of work is known up front, enabling the ETA #
+    engine.reporter.set_total(len(plan.ops), sum(op.size for op in plan.ops))
+    start = time.perf_counter()
+
+    for dir_path in plan.dirs:
+        engine.notify(dir_copy(dir_path))
+        # If the manifest is in use #
+        if manifest is not None:
+            manifest.record_dir(dir_path)
+
+    engine.metrics.record('mkdir', time.perf_counter() - start)
+
+    # Tally the files found unchanged while planning #
+    for _ in range(plan.unchanged):
+        engine.report(None)
+
+    for op in plan.ops:
+        engine.submit(copy_handler, op.src_entry, op.dest_file, op.dest_entry, engine.backend)
+
+
+def print_plan(plan: CopyPlan):
+    """
+    Prints the copy plan and its total byte count for a dry run.
+
+    :param plan:  The copy plan.
+    :return:  Nothing
+    """
+    for dir_path in plan.dirs:
+        print(f'mkdir   {dir_path}')
+
+    for op in plan.ops:
+        action = 'update' if op.dest_entry is not None else 'create'
+        print(f'{action}  {op.size:>14}  {op.src_entry.path} -> {op.dest_file}')
+
+    total = sum(op.size for op in plan.ops)
+    print(f'\nPlan: {len(plan.dirs)} directories to create, {len(plan.ops)} files to copy '
+          f'({total} bytes, {total / 1024 ** 2:.1f} MB), {plan.unchanged} unchanged')
+
+
+class FanoutCopier:
+    """
+    Copies each source file to several destinations with a single read. The reading worker feeds
+    the chunks into a bounded queue per destination, drained by a writer thread of that
+    destination, so a slow destination only holds back the others once its queue is full. Each
+    destination is checked for changes separately and only the outdated copies are written.
+
+    :param dest_paths:  The paths to the destination directories.
+    :param workers:  The number of files copied concurrently, one writer per file and destination.
+    """
+    def __init__(self, dest_paths: list, workers: int):
+        self.dest_paths = dest_paths
+        self.writers = [ThreadPoolExecutor(max_workers=max(1, workers),
+                                           thread_name_prefix=f'fanout_writer_{index}')
+                        for index in range(len(dest_paths))]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def write_loop(chunks: queue.Queue, temp_file: Path):
+        """
+        Writes the queued chunks to the temporary destination file until a None sentinel is queued.
+
+        :param chunks:  The bounded queue of chunks of the destination.
+        :param temp_file:  The temporary file the destination copy is written to.
+        :return:  Nothing
+        """
+        with open(temp_file, 'wb') as file:
+            while True:
+                chunk = chunks.get()
+                # If the source file was fully read #
+                if chunk is None:
+                    break
+
+                file.write(chunk)
+
+    @staticmethod
+    def feed(chunks: queue.Queue, writer: Future, chunk: bytes):
+        """
+        Queues the chunk for the destination writer, giving up if the writer failed so a broken \
+        destination does not block the others.
+
+        :param chunks:  The bounded queue of chunks of the destination.
+        :param writer:  The future of the destination writer.
+        :param chunk:  The chunk to queue, None to signal the end of the file.
+        :return:  Nothing
+        """
+        while not writer.done():
+            try:
+                chunks.put(chunk, timeout=STATUS_INTERVAL)
+                return
+
+            # If the destination is behind, keep waiting unless its writer failed #
+            except queue.Full:
+                continue
+
+    def copy(self, src_entry: os.DirEntry, targets: list) -> CopyResult:
+        """
+        Reads the source file once and writes it to every destination where it changed, each copy \
+        is renamed into place with the source mode and modification time once complete.
+
+        :param src_entry:  The directory entry of the source file.
+        :param targets:  The (dest file, dest directory entry or None) pair of each destination.
+        :return:  The result to report if the file was copied anywhere, otherwise None.
+        """
+        src_meta = entry_meta(src_entry)
+        jobs = []
+
+        for index, (dest_file, dest_entry) in enumerate(targets):
+            # If the destination copy is up to date #
+            if not file_changed(src_meta, entry_meta(dest_entry) if dest_entry is not None
+                                else None):
+                continue
+
+            chunks = queue.Queue(maxsize=PIPELINE_DEPTH)
+            temp_file = part_path(dest_file)
+            jobs.append((dest_file, temp_file, chunks,
+                         self.writers[index].submit(self.write_loop, chunks, temp_file)))
+
+        # If every destination is up to date #
+        if not jobs:
+            return None
+
+        try:
+            with open(src_entry.path, 'rb') as src:
+                while chunk := src.read(BUFFER_SIZE):
+                    for _, _, chunks, writer in jobs:
+                        self.feed(chunks, writer, chunk)
+
+        # If the read failed or was interrupted, discard every partial copy before raising #
+        except BaseException:
+            for _, _, chunks, writer in jobs:
+                self.feed(chunks, writer, None)
+
+            for _, temp_file, _, writer in jobs:
+                # Wait on the writer so it is done with the file, its own error is superseded #
+                writer.exception()
+                temp_file.unlink(missing_ok=True)
+
+            raise
+
+        for _, _, chunks, writer in jobs:
+            self.feed(chunks, writer, None)
+
+        errors = []
+
+        for dest_file, temp_file, _, writer in jobs:
+            try:
+                writer.result()
+                shutil.copymode(src_entry.path, temp_file)
+                os.utime(temp_file, ns=(time.time_ns(), src_meta.mtime_ns))
+                os.replace(temp_file, dest_file)
+
+            # If the destination failed, finish the others before raising #
+            except OSError as write_err:
+                temp_file.unlink(missing_ok=True)
+                errors.append(write_err)
+
+        # If any destination failed #
+        if errors:
+            raise errors[0]
+
+        dest_list = ', '.join(str(dest_file) for dest_file, _, _, _ in jobs)
+        return CopyResult(f'File Copied: {src_entry.path} -> {dest_list}', jobs[0][0], src_meta)
+
+    def close(self):
+        """
+        Shuts down the writer pools of the destinations.
+
+        :return:  Nothing
+        """
+        for writer in self.writers:
+            writer.shutdown(wait=True, cancel_futures=True)
+
+
+def fanout_copy(src_path: Path, copier: FanoutCopier, engine: CopyEngine, recursive: bool,
+                scan_workers: int = 1, path_filter: PathFilter = None):
+    """
+    Walks the source path, creating the directories in every destination and queuing the single \
+    read fan-out copies into the copy engine.
+
+    :param src_path:  The path to the source directory containing data.
+    :param copier:  The fan-out copier holding the destinations.
+    :param engine:  The copy engine the file copies are queued into.
+    :param recursive:  Toggle to copy recursively instead of a single directory.
+    :param scan_workers:  The number of threads scanning subdirectories ahead of the walk.
+    :param path_filter:  The include and exclude rules, None to copy every entry.
+    :return:  Nothing
+    """
+    tree = source_tree(src_path, recursive, scan_workers, path_filter)
+
+    for rel_dir, dir_entries, file_entries in tree:
+        dir_path = str(src_path / rel_dir)
+        engine.notify(f'\nIn path: {dir_path}\n{(9 + len(dir_path)) * "*"}')
+        # Get the files of each destination once instead of checking each file #
+        dest_entries = [scan_files(dest_path / rel_dir) for dest_path in copier.dest_paths]
+
+        # Iterate through the directories #
+        for dir_entry in dir_entries:
+            for dest_path in copier.dest_paths:
+                dir_handler(rel_dir, dest_path, dir_entry.name, engine)
+
+        # Iterate through the scanned files #
+        for src_entry in file_entries:
+            targets = [(dest_path / rel_dir / src_entry.name, entries.get(src_entry.name))
+                       for dest_path, entries in zip(copier.dest_paths, dest_entries)]
+            engine.submit(copier.copy, src_entry, targets)
+
+
+class Verifier:
+    """
+    Verification pass which hashes the source and destination of every file and compares the
+    digests, tallying the matched, mismatched and missing files. Only the source digests are
+    served from the cache, the destination copies are hashed on every pass since bit rot or
+    tampering at the destination can keep the size and modification time the cache is keyed on.
+
+    :param cache:  The digest cache.
+    :param algorithm:  The hash algorithm, blake2b or sha256.
+    """
+    def __init__(self, cache: DigestCache, algorithm: str):
+        self.cache = cache
+        self.algorithm = algorithm
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def verify(self, src_entry: os.DirEntry, dest_file: Path) -> str:
+        """
+        Compares the digests of the source file and its destination copy, ran in the worker pool.
+
+        :param src_entry:  The directory entry of the source file.
+        :param dest_file:  The path of the destination copy.
+        :return:  The message to report if the copy does not match, otherwise None.
+        """
+        try:
+            dest_digest = file_digest(dest_file, self.algorithm)
+
+        # If the destination copy does not exist #
+        except FileNotFoundError:
+            outcome, message = 'missing', f'Verify Missing: {dest_file}'
+        else:
+            # If the digests match #
+            if self.cache.digest(Path(src_entry.path), self.algorithm) == dest_digest:
+                outcome, message = 'matched', None
+            else:
+                outcome, message = 'mismatched', f'Verify Mismatch: {dest_file}'
+                logging.warning('Destination %s does not match source %s', dest_file,
+                                src_entry.path)
+
+        with self.lock:
+            self.counts[outcome] += 1
+
+        return message
+
+    def summary(self) -> str:
+        """
+        Formats the tallies of the verification pass.
+
+        :return:  The formatted summary.
+        """
+        return (f'{self.counts["matched"]} matched, {self.counts["mismatched"]} mismatched, '
+                f'{self.counts["missing"]} missing ({self.cache.hits} cached digests)')
+
+
+def verify_tree(src_path: Path, dest_path: Path, engine: CopyEngine, verifier: Verifier,
+                recursive: bool, scan_workers: int = 1, path_filter: PathFilter = None):
+    """
+    Walks the source path and queues the verification of every file into the copy engine.
+
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the destination directory holding the copies.
+    :param engine:  The copy engine the verifications are queued into.
+    :param verifier:  The verification pass.
+    :param recursive:  Toggle to verify recursively instead of a single directory.
+    :param scan_workers:  The number of threads scanning subdirectories ahead of the walk.
+    :param path_filter:  The include and exclude rules, None to verify every file.
+    :return:  Nothing
+    """
+    tree = source_tree(src_path, recursive, scan_workers, path_filter)
+
+    for rel_dir, _, file_entries in tree:
+        for src_entry in file_entries:
+            engine.submit(verifier.verify, src_entry, dest_path / rel_dir / src_entry.name)
+
+
+class InotifyWatcher:
+    """
+    Minimal ctypes wrapper around the Linux inotify API which watches the directories of a source \
+    tree for written, created, moved in and touched entries.
+
+    :param recursive:  Toggle to watch every subdirectory instead of the top directory only.
+    :param path_filter:  The include and exclude rules, excluded directories are not watched.
+    """
+    def __init__(self, recursive: bool = True, path_filter: PathFilter = None):
+        self.recursive = recursive
+        self.path_filter = path_filter
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.watches = {}
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        # If the inotify instance could not be created #
+        if self.fd < 0:
+            err_num = ctypes.get_errno()
+            raise OSError(err_num, os.strerror(err_num))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_tree(self, dir_path: Path):
+        """
+        Adds watches for the directory, and its subdirectories if recursive.
+
+        :param dir_path:  The path to the directory to watch.
+        :return:  Nothing
+        """
+        self.add_watch(dir_path)
+
+        # If only the top directory is watched #
+        if not self.recursive:
+            return
+
+        for walk_path, dir_names, _ in os.walk(dir_path):
+            # If a path filter is in use, do not descend into the excluded directories #
+            if self.path_filter is not None:
+                dir_names[:] = [name for name in dir_names
+                                if self.path_filter.keep_dir(os.path.join(walk_path, name))]
+
+            self.add_watch(Path(walk_path))
+
+    def add_watch(self, dir_path: Path):
+        """
+        Adds a watch for the directory.
+
+        :param dir_path:  The path to the directory to watch.
+        :return:  Nothing
+        """
+        watch = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        # If the watch could not be added #
+        if watch < 0:
+            err_num = ctypes.get_errno()
+            # If the directory was removed before it could be watched #
+            if err_num in (errno.ENOENT, errno.ENOTDIR):
+                return
+
+            raise OSError(err_num, f'inotify_add_watch {dir_path}: {os.strerror(err_num)}')
+
+        self.watches[watch] = dir_path
+
+    def read_events(self, timeout: float) -> list:
+        """
+        Waits for and parses the queued events.
+
+        :param timeout:  The max seconds to wait for events.
+        :return:  The list of (directory path, entry name, event mask) tuples.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        # If no events arrived before the timeout #
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+
+        # If another reader drained the events #
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+
+        while offset < len(data):
+            watch, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+
+            # If the watched directory was removed #
+            if mask & IN_IGNORED:
+                self.watches.pop(watch, None)
+                continue
+
+            events.append((self.watches.get(watch), name, mask))
+
+        return events
+
+    def close(self):
+        """
+        Closes the inotify instance, removing every watch.
+
+        :return:  Nothing
+        """
+        # If the instance is open #
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch_sync(src_path: Path, dest_path: Path, engine: CopyEngine, manifest: Manifest,
+               watcher: InotifyWatcher, changes: dict, new_dirs: set,
+               path_filter: PathFilter = None):
+    """
+    Replicates a coalesced batch of watched changes into the destination.
+
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the destination directory where the data will go.
+    :param engine:  The copy engine the file copies are queued into.
+    :param manifest:  The destination manifest, None if not in use.
+    :param watcher:  The inotify watcher where new directories are added.
+    :param changes:  The source directory path to changed file names dict.
+    :param new_dirs:  The source directories created or moved in since the last batch.
+    :param path_filter:  The include and exclude rules, None to copy every entry.
+    :return:  Nothing
+    """
+    # Iterate through the new directories parents first #
+    for dir_path in sorted(new_dirs, key=lambda new_dir: len(new_dir.parts)):
+        # If the directory was removed or is inside an already synced new directory #
+        if not dir_path.is_dir() or any(parent in new_dirs for parent in dir_path.parents):
+            continue
+        # If the path filter excludes the directory #
+        if path_filter is not None and not path_filter.keep_dir(str(dir_path)):
+            continue
+
+        # Watch before syncing so entries created during the sync are not missed #
+        watcher.add_tree(dir_path)
+        rel_path = dir_path.relative_to(src_path)
+        dir_handler(rel_path.parent, dest_path, rel_path.name, engine, manifest)
+        recursive_copy(dir_path, dest_path / rel_path, engine, manifest, path_filter=path_filter)
+
+    # Iterate through the directories with changed files #
+    for dir_path, names in changes.items():
+        # If the directory was already synced in full #
+        if dir_path in new_dirs or any(parent in new_dirs for parent in dir_path.parents):
+            continue
+
+        single_mode(dir_path, dest_path / dir_path.relative_to(src_path), engine, manifest, names,
+                    path_filter=path_filter)
+
+    engine.wait()
+
+    # If the manifest is in use, persist the batch #
+    if manifest is not None:
+        manifest.commit()
+
+
+def watch_mode(src_path: Path, dest_path: Path, engine: CopyEngine, manifest: Manifest,
+               recursive: bool, debounce: float, path_filter: PathFilter = None):
+    """
+    Keeps the destination in sync after the initial copy by replicating only the paths reported \
+    by inotify. Event bursts are coalesced until the source is quiet for the debounce interval,
+    and a full rescan is ran if the kernel event queue overflows. Runs until Ctrl + C.
+
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the destination directory where the data will go.
+    :param engine:  The copy engine the file copies are queued into.
+    :param manifest:  The destination manifest, None if not in use.
+    :param recursive:  Toggle to watch the subdirectories of the source path.
+    :param debounce:  The seconds of quiet to wait before replicating a batch of changes.
+    :param path_filter:  The include and exclude rules, None to copy every entry.
+    :return:  Nothing
+    """
+    # If the OS is not Linux #
+    if not sys.platform.startswith('linux'):
+        print_err('Watch mode is only supported on Linux', None)
+        return
+
+    print(f'\nWatching {src_path} for changes .. hit Ctrl + C to stop')
+
+    with InotifyWatcher(recursive, path_filter) as watcher:
+        watcher.add_tree(src_path)
+        changes = {}
+        new_dirs = set()
+        overflow = False
+        batch_start = None
+
+        try:
+            while True:
+                events = watcher.read_events(debounce)
+
+                for dir_path, name, mask in events:
+                    # If the kernel event queue overflowed, events were lost #
+                    if mask & IN_Q_OVERFLOW:
+                        overflow = True
+                    # If a directory was created or moved in #
+                    elif mask & IN_ISDIR:
+                        # If subdirectories are watched #
+                        if recursive and dir_path is not None:
+                            new_dirs.add(dir_path / name)
+                    elif dir_path is not None:
+                        changes.setdefault(dir_path, set()).add(name)
+
+                # If this is the first event of a batch #
+                if events and batch_start is None:
+                    batch_start = time.monotonic()
+
+                # Keep coalescing until the source is quiet or the batch is too old #
+                if batch_start is None or \
+                (events and time.monotonic() - batch_start < debounce * 10):
+                    continue
+
+                # If events were lost, rescan the whole source tree #
+                if overflow:
+                    engine.notify('\nInotify queue overflowed .. rescanning source')
+                    watcher.add_tree(src_path)
+                    # If recursive copying is selected #
+                    if recursive:
+                        recursive_copy(src_path, dest_path, engine, manifest,
+                                       path_filter=path_filter)
+                    else:
+                        single_mode(src_path, dest_path, engine, manifest,
+                                    path_filter=path_filter)
+                    # Wait on the rescan and persist it #
+                    watch_sync(src_path, dest_path, engine, manifest, watcher, {}, set(),
+                               path_filter)
+                else:
+                    watch_sync(src_path, dest_path, engine, manifest, watcher, changes, new_dirs,
+                               path_filter)
+
+                changes = {}
+                new_dirs = set()
+                overflow = False
+                batch_start = None
+
+        # If Ctrl + c is detected, stop watching #
+        except KeyboardInterrupt:
+            engine.wait()
+            print('\n[!] Ctrl + C detected .. stopped watching')
+
+
+def make_compressor(fmt: str, level: int):
+    """
+    Creates the streaming compressor object of the archive format.
+
+    :param fmt:  The archive format, one of ARCHIVE_FORMATS.
+    :param level:  The compression level, None for the format default.
+    :return:  The compressor with compress() and flush() methods, None for uncompressed tar.
+    """
+    # If the archive is uncompressed #
+    if fmt == 'tar':
+        return None
+    # Gzip is deflate with a gzip header, selected by the window bits #
+    if fmt == 'gz':
+        return zlib.compressobj(level if level is not None else 6, zlib.DEFLATED, 31)
+    if fmt == 'bz2':
+        return bz2.BZ2Compressor(level if level is not None else 9)
+    if fmt == 'xz':
+        return lzma.LZMACompressor(preset=level)
+
+    # If the optional zstandard package is missing #
+    if zstandard is None:
+        raise ValueError('zst archives require the zstandard package')
+
+    return zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+
+
+class ArchiveStream:
+    """
+    File-like sink for the tarfile stream mode which pipelines the tar stream through a compressor
+    thread and a writer thread over bounded queues, so compression overlaps reading the source
+    files and writing the archive.
+
+    :param archive_path:  The path of the archive file to write.
+    :param fmt:  The archive format, one of ARCHIVE_FORMATS.
+    :param level:  The compression level, None for the format default.
+    """
+    def __init__(self, archive_path: Path, fmt: str, level: int = None):
+        self.compressor = make_compressor(fmt, level)
+        self.raw_queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+        self.out_queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+        self.buffer = bytearray()
+        self.error = None
+        self.file = open(archive_path, 'wb')
+        self.threads = [threading.Thread(target=self.compress_loop, name='archive_compress'),
+                        threading.Thread(target=self.write_loop, name='archive_write')]
+
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, data: bytes) -> int:
+        """
+        Buffers the tar stream data, handing full chunks to the compressor thread.
+
+        :param data:  The tar stream data.
+        :return:  The number of bytes written.
+        """
+        # If one of the pipeline threads failed #
+        if self.error is not None:
+            raise self.error
+
+        self.buffer += data
+
+        # If a full chunk is buffered #
+        if len(self.buffer) >= ARCHIVE_CHUNK_SIZE:
+            self.raw_queue.put(bytes(self.buffer))
+            self.buffer.clear()
+
+        return len(data)
+
+    def compress_loop(self):
+        """
+        Compresses the queued chunks until the None sentinel, passing the output to the writer.
+
+        :return:  Nothing
+        """
+        while True:
+            chunk = self.raw_queue.get()
+            # If the stream is finished #
+            if chunk is None:
+                break
+
+            # If a stage already failed, discard the chunk so the producer never blocks #
+            if self.error is not None:
+                continue
+
+            try:
+                # If the archive is compressed #
+                if self.compressor is not None:
+                    chunk = self.compressor.compress(chunk)
+
+                # If the compressor produced output #
+                if chunk:
+                    self.out_queue.put(chunk)
+
+            # If the compression failed, surface it on the next write #
+            except COMPRESS_ERRORS as comp_err:
+                self.error = comp_err
+
+        try:
+            # If the archive is compressed, flush the remaining output #
+            if self.compressor is not None and self.error is None:
+                self.out_queue.put(self.compressor.flush())
+        finally:
+            self.out_queue.put(None)
+
+    def write_loop(self):
+        """
+        Writes the compressed chunks to the archive file until the None sentinel.
+
+        :return:  Nothing
+        """
+        while True:
+            chunk = self.out_queue.get()
+            # If the stream is finished #
+            if chunk is None:
+                break
+
+            # If a stage already failed, discard the chunk so the compressor never blocks #
+            if self.error is not None:
+                continue
+
+            try:
+                self.file.write(chunk)
+
+            # If the write failed, surface it on the next write #
+            except OSError as write_err:
+                self.error = write_err
+
+    def close(self):
+        """
+        Flushes the pipeline, waits on the threads and closes the archive file.
+
+        :return:  Nothing
+        """
+        # If there is buffered data left #
+        if self.buffer:
+            self.raw_queue.put(bytes(self.buffer))
+            self.buffer.clear()
+
+        self.raw_queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.file.close()
+
+        # If one of the pipeline threads failed #
+        if self.error is not None:
+            raise self.error
+
+
+def load_archive_index(dest_path: Path) -> dict:
+    """
+    Loads the index of the most recent archive in the destination.
+
+    :param dest_path:  The path to the destination directory holding the archives.
+    :return:  The relative path to file metadata dict, empty if there is no previous archive.
+    """
+    indexes = sorted(dest_path.glob('backup_*.idx'))
+    # If there is no previous archive #
+    if not indexes:
+        return {}
+
+    index = {}
+    with open(indexes[-1], 'r', encoding='utf-8') as index_file:
+        for line in index_file:
+            rel_path, size, mtime_ns = json.loads(line)
+            index[rel_path] = FileMeta(size, mtime_ns)
+
+    return index
+
+
+def archive_backup(src_path: Path, dest_path: Path, reporter: ProgressReporter, recursive: bool,
+                   fmt: str, level: int = None, incremental: bool = False,
+                   path_filter: PathFilter = None) -> Path:
+    """
+    Streams the source tree into a single tar archive in the destination instead of mirroring \
+    it. Every archive gets an index of the archived source state, and incremental archives only \
+    contain the files changed since the index of the previous archive.
+
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the destination directory where the archive will go.
+    :param reporter:  The progress reporter the archived files are passed to.
+    :param recursive:  Toggle to archive recursively instead of a single directory.
+    :param fmt:  The archive format, one of ARCHIVE_FORMATS.
+    :param level:  The compression level, None for the format default.
+    :param incremental:  Toggle to only archive files changed since the previous archive.
+    :param path_filter:  The include and exclude rules, None to archive every entry.
+    :return:  The path of the written archive.
+    """
+    previous = load_archive_index(dest_path) if incremental else {}
+    kind = 'incr' if previous else 'full'
+    name = f'backup_{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}_{kind}{ARCHIVE_FORMATS[fmt]}'
+    archive_path = dest_path / name
+    temp_path = dest_path / f'.{name}.part'
+    index_part = dest_path / f'.{name}.idx.part'
+
+    tree = source_tree(src_path, recursive, path_filter=path_filter)
+
+    stream = ArchiveStream(temp_path, fmt, level)
+
+    try:
+        try:
+            with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT,
+                              copybufsize=BUFFER_SIZE) as tar, \
+            open(index_part, 'w', encoding='utf-8') as index_file:
+                for rel_dir, dir_entries, file_entries in tree:
+                    # If this is a full archive, keep empty directories #
+                    if kind == 'full':
+                        for dir_entry in dir_entries:
+                            tar.add(dir_entry.path, (rel_dir / dir_entry.name).as_posix(),
+                                    recursive=False)
+
+                    for entry in file_entries:
+                        rel_path = (rel_dir / entry.name).as_posix()
+                        stat = entry.stat()
+                        meta = FileMeta(stat.st_size, stat.st_mtime_ns)
+                        index_file.write(json.dumps([rel_path, meta.size, meta.mtime_ns]) + '\n')
+
+                        # If the file is unchanged since the previous archive #
+                        if not file_changed(meta, previous.get(rel_path)):
+                            reporter.report(None)
+                            continue
+
+                        # Build the header from the scanned stat instead of another stat call #
+                        info = tarfile.TarInfo(rel_path)
+                        info.size = meta.size
+                        info.mtime = stat.st_mtime
+                        info.mode = stat.st_mode & 0o7777
+
+                        with open(entry.path, 'rb') as file:
+                            tar.addfile(info, file)
+
+                        reporter.report(CopyResult(f'File Archived: {entry.path}', archive_path,
+                                                   meta))
+        finally:
+            stream.close()
+
+    # If the archive failed or was interrupted, do not leave the partial files behind #
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        index_part.unlink(missing_ok=True)
+        raise
+
+    # Publish the archive and its index only once both are complete #
+    os.replace(temp_path, archive_path)
+    os.replace(index_part, dest_path / f'{name}.idx')
+    return archive_path
+
+
+@lru_cache(maxsize=8)
+def gear_masks(count: int) -> tuple:
+    """
+    Builds the lane masks of the vectorized gear hash for a number of 32-bit lanes.
+
+    :param count:  The number of lanes.
+    :return:  The masks keeping the bits that stay in their lane per doubling step, and the \
+              mask of the boundary bits.
+    """
+    keep = tuple(int.from_bytes(((1 << (32 - shift)) - 1).to_bytes(4, 'little') * count,
+                                'little') for shift in (1, 2, 4, 8, 16))
+    return keep, int.from_bytes(CHUNK_MASK.to_bytes(4, 'little') * count, 'little')
+
+
+def gear_block(window: bytearray) -> bytes:
+    """
+    Computes the gear hash of every position of the window at once. The 32-bit hashes are packed \
+    as lanes of a single integer, so the rolling update runs as a few shifts and xors over the \
+    whole block instead of a Python loop per byte.
+
+    :param window:  The data to hash, its first positions only see a partial window.
+    :return:  The little endian 32-bit lanes holding the boundary bits of each position.
+    """
+    count = len(window)
+    lanes = bytearray(count * 4)
+
+    # Each lane starts out as the gear value of its byte #
+    for index, table in enumerate(GEAR_TABLES):
+        lanes[index::4] = window.translate(table)
+
+    hashes = int.from_bytes(lanes, 'little')
+    keep, cut_mask = gear_masks(count)
+
+    # Fold in the lanes a doubling distance back, shifted as far, until the window is covered #
+    for shift, keep_mask in zip((1, 2, 4, 8, 16), keep):
+        hashes ^= (hashes & keep_mask) << (33 * shift)
+
+    return (hashes & cut_mask).to_bytes(count * 4, 'little')
+
+
+def find_chunk_cut(data: bytearray) -> int:
+    """
+    Finds the end of the next content defined chunk with a gear rolling hash over the last \
+    CHUNK_WINDOW bytes, so boundaries move with the content and an insertion only changes the \
+    chunks around it. Positions before the minimum chunk size are skipped, the cut is forced at \
+    the maximum chunk size, and the positions in between are hashed in vectorized blocks.
+
+    :param data:  The buffered data starting at the beginning of the chunk.
+    :return:  The length of the chunk.
+    """
+    # If the remaining data is not larger than the minimum chunk #
+    if len(data) <= CHUNK_MIN:
+        return len(data)
+
+    end = min(len(data), CHUNK_MAX)
+
+    for start in range(CHUNK_MIN, end, CHUNK_SCAN_BLOCK):
+        # Hash from a window back, so the first positions of the block see their full window #
+        lanes = gear_block(data[start - CHUNK_WINDOW + 1:min(end, start + CHUNK_SCAN_BLOCK)])
+        offset = (CHUNK_WINDOW - 1) * 4
+
+        while True:
+            offset = lanes.find(bytes(4), offset)
+            # If no position of the block has all the boundary bits clear #
+            if offset < 0:
+                break
+
+            # If the zero bytes form a whole lane, cut after its position #
+            if not offset % 4:
+                return start + (offset // 4) - CHUNK_WINDOW + 2
+
+            offset += 4 - offset % 4
+
+    return end
+
+
+def iter_chunks(file):
+    """
+    Splits the open file into content defined chunks.
+
+    :param file:  The file opened in binary mode.
+    :return:  Generator of chunk bytes.
+    """
+    pending = bytearray()
+    eof = False
+
+    while pending or not eof:
+        # Keep at least a maximum sized chunk buffered until the end of the file #
+        while not eof and len(pending) < CHUNK_MAX:
+            data = file.read(BUFFER_SIZE * 4)
+            eof = not data
+            pending += data
+
+        # If the file is fully chunked #
+        if not pending:
+            break
+
+        cut = find_chunk_cut(pending)
+        yield bytes(pending[:cut])
+        del pending[:cut]
+
+
+def write_chunk(chunk_path: Path, data: bytes) -> bool:
+    """
+    Writes the chunk under its content hash unless it is already on disk.
+
+    :param chunk_path:  The path of the chunk file.
+    :param data:  The chunk data.
+    :return:  True if the chunk was written, False if it already existed.
+    """
+    # If another run or worker already stored the chunk #
+    if chunk_path.exists():
+        return False
+
+    chunk_path.parent.mkdir(exist_ok=True)
+    temp_path = chunk_path.with_name(f'{chunk_path.name}.{os.getpid()}.'
+                                     f'{threading.get_ident()}.part')
+
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+        # Flush before publishing, a chunk truncated by a crash would be deduplicated against #
+        os.fsync(temp_file.fileno())
+
+    # Publish atomically, racing writers of the same chunk write the same bytes #
+    os.replace(temp_path, chunk_path)
+    return True
+
+
+def chunk_file(file_path: str, chunk_dir: Path) -> list:
+    """
+    Splits the file into content defined chunks and writes the ones missing from the store. Ran \
+    in the chunking worker processes, since the boundary scan holds the GIL.
+
+    :param file_path:  The path of the file to chunk.
+    :param chunk_dir:  The directory of the store holding the chunks.
+    :return:  The ordered list of (hex digest, written bytes) pairs of the file chunks.
+    """
+    chunks = []
+
+    with open(file_path, 'rb') as file:
+        for chunk in iter_chunks(file):
+            digest = hashlib.blake2b(chunk, digest_size=32).hexdigest()
+            written = write_chunk(chunk_dir / digest[:2] / digest, chunk)
+            chunks.append((digest, len(chunk) if written else 0))
+
+    return chunks
+
+
+class ChunkStore:
+    """
+    Content addressed storage backend where files are split into content defined chunks that are
+    stored once under their BLAKE2 hash, and each backup run is a small snapshot manifest listing
+    the chunks of every file. Chunks already in the store are never written again. Files larger
+    than the minimum chunk are chunked in a pool of worker processes, so the boundary scan runs
+    on several cores instead of serializing the copy workers on the GIL.
+
+    :param root:  The path to the directory holding the store.
+    :param workers:  The number of chunking processes, 1 chunks in the calling thread.
+    :param readonly:  Toggle to open an existing store for restoring without writing to it.
+    """
+    def __init__(self, root: Path, workers: int = 1, readonly: bool = False):
+        self.root = root
+        self.chunk_dir = root / 'chunks'
+        self.snapshot_dir = root / 'snapshots'
+        self.lock = threading.Lock()
+        self.files = {}
+        self.written = 0
+        self.known = set()
+
+        # If the store is restored from, it has to exist since its source is never written to #
+        if readonly:
+            # If the path does not hold the layout of a chunk store #
+            if not self.exists(root):
+                raise ValueError(f'{root} is not a chunk store, it has no chunks and snapshots '
+                                 'directories')
+        else:
+            self.chunk_dir.mkdir(parents=True, exist_ok=True)
+            self.snapshot_dir.mkdir(exist_ok=True)
+            # List the stored chunks once instead of checking each chunk on disk #
+            self.known = {chunk.name for prefix in self.chunk_dir.iterdir() if prefix.is_dir()
+                          for chunk in prefix.iterdir() if not chunk.name.endswith('.part')}
+
+        workers = min(workers, os.cpu_count() or 1)
+        # Spawned instead of forked, forking a process running copy threads is unsafe #
+        self.pool = ProcessPoolExecutor(workers, mp_context=get_context('spawn')) \
+                    if workers > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def exists(root: Path) -> bool:
+        """
+        Checks whether the directory holds a chunk store.
+
+        :param root:  The path to the directory.
+        :return:  True if the directory has the chunk store layout, False otherwise.
+        """
+        return (root / 'chunks').is_dir() and (root / 'snapshots').is_dir()
+
+    def close(self):
+        """
+        Shuts down the chunking processes.
+
+        :return:  Nothing
+        """
+        # If the files are chunked in worker processes #
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def chunk_path(self, digest: str) -> Path:
+        """
+        Formats the path of the chunk, fanned out by the first two hex digits.
+
+        :param digest:  The hex digest of the chunk.
+        :return:  The path of the chunk file.
+        """
+        return self.chunk_dir / digest[:2] / digest
+
+    def put(self, data: bytes) -> str:
+        """
+        Stores the chunk unless the store already holds it.
+
+        :param data:  The chunk data.
+        :return:  The hex digest the chunk is stored under.
+        """
+        digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+
+        # If the chunk is already stored #
+        if digest in self.known:
+            return digest
+
+        written = write_chunk(self.chunk_path(digest), data)
+
+        with self.lock:
+            self.known.add(digest)
+            self.written += len(data) if written else 0
+
+        return digest
+
+    def put_file(self, file_path: str, size: int) -> list:
+        """
+        Stores the file as chunks, in a chunking process if the file spans several chunks.
+
+        :param file_path:  The path of the file.
+        :param size:  The size of the file.
+        :return:  The ordered hex digests of the file chunks.
+        """
+        # If the file fits a single chunk there is no boundary to scan for #
+        if self.pool is None or size <= CHUNK_MIN:
+            with open(file_path, 'rb') as file:
+                return [self.put(chunk) for chunk in iter_chunks(file)]
+
+        # The copy worker waits without holding the GIL while a process chunks the file #
+        chunks = self.pool.submit(chunk_file, file_path, self.chunk_dir).result()
+
+        with self.lock:
+            for digest, written in chunks:
+                self.known.add(digest)
+                self.written += written
+
+        return [digest for digest, _ in chunks]
+
+    def get(self, digest: str) -> bytes:
+        """
+        Reads the chunk, verifying its content matches the digest.
+
+        :param digest:  The hex digest of the chunk.
+        :return:  The chunk data.
+        """
+        data = self.chunk_path(digest).read_bytes()
+
+        # If the chunk is corrupted #
+        if hashlib.blake2b(data, digest_size=32).hexdigest() != digest:
+            raise ValueError(f'Chunk {digest} is corrupted')
+
+        return data
+
+    def snapshots(self) -> list:
+        """
+        Lists the snapshot manifests of the store, oldest first.
+
+        :return:  The list of snapshot paths.
+        """
+        return sorted(self.snapshot_dir.glob('*.json.gz'))
+
+    def load_snapshot(self, name: str = None) -> dict:
+        """
+        Loads the snapshot manifest.
+
+        :param name:  The name of the snapshot, None for the most recent one.
+        :return:  The snapshot manifest, empty if the store has no snapshots.
+        """
+        # If the most recent snapshot is requested #
+        if name is None:
+            snapshots = self.snapshots()
+            # If the store has no snapshots yet #
+            if not snapshots:
+                return {}
+
+            snapshot_path = snapshots[-1]
+        else:
+            snapshot_path = self.snapshot_dir / (name if name.endswith('.json.gz')
+                                                 else f'{name}.json.gz')
+
+        with gzip.open(snapshot_path, 'rt', encoding='utf-8') as snapshot:
+            return json.load(snapshot)
+
+    def record(self, rel_path: str, meta: FileMeta, mode: int, chunks: list):
+        """
+        Records the stored file for the snapshot of the current run.
+
+        :param rel_path:  The path of the file relative to the source root.
+        :param meta:  The metadata of the source file.
+        :param mode:  The permission bits of the source file.
+        :param chunks:  The ordered hex digests of the file chunks.
+        :return:  Nothing
+        """
+        with self.lock:
+            self.files[rel_path] = {'size': meta.size, 'mtime_ns': meta.mtime_ns, 'mode': mode,
+                                    'chunks': chunks}
+
+    def save_snapshot(self, src_path: Path, dirs: list) -> Path:
+        """
+        Writes the snapshot manifest of the current run.
+
+        :param src_path:  The path to the source directory that was backed up.
+        :param dirs:  The relative paths of the source directories.
+        :return:  The path of the snapshot manifest.
+        """
+        name = f'{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}.json.gz'
+        temp_path = self.snapshot_dir / f'.{name}.part'
+
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as snapshot:
+            json.dump({'source': str(src_path), 'dirs': dirs, 'files': self.files}, snapshot)
+
+        # Make the chunks and the manifest durable before the snapshot referencing them is live #
+        sync_fs(self.root)
+        os.replace(temp_path, self.snapshot_dir / name)
+        return self.snapshot_dir / name
+
+    def prune(self, keep: int = None, keep_days: float = None) -> list:
+        """
+        Applies the retention policy, deleting the snapshots beyond the newest ones to keep or \
+        older than the max age. The chunks only they referenced are freed by the next gc.
+
+        :param keep:  The number of newest snapshots to keep, None for no limit.
+        :param keep_days:  The max age in days of the snapshots to keep, None for no limit.
+        :return:  The list of deleted snapshot paths.
+        """
+        pruned = expired_backups(self.snapshots(), keep, keep_days)
+
+        for snapshot in pruned:
+            snapshot.unlink()
+
+        return pruned
+
+    def gc(self) -> tuple:
+        """
+        Deletes the chunks no snapshot references, along with leftover partial chunk files.
+
+        :return:  The number of deleted chunks and the number of freed bytes.
+        """
+        referenced = set()
+
+        for snapshot in self.snapshots():
+            with gzip.open(snapshot, 'rt', encoding='utf-8') as snapshot_file:
+                for info in json.load(snapshot_file)['files'].values():
+                    referenced.update(info['chunks'])
+
+        deleted = freed = 0
+
+        for prefix in self.chunk_dir.iterdir():
+            for chunk in prefix.iterdir():
+                # If the chunk is still referenced #
+                if chunk.name in referenced:
+                    continue
+
+                freed += chunk.stat().st_size
+                chunk.unlink()
+                deleted += 1
+                self.known.discard(chunk.name)
+
+        return deleted, freed
+
+
+def store_file(store: ChunkStore, src_entry: os.DirEntry, rel_path: str,
+               previous: dict) -> CopyResult:
+    """
+    Stores the source file as chunks, reusing the chunk list of the previous snapshot without \
+    reading the file if it is unchanged.
+
+    :param store:  The chunk store.
+    :param src_entry:  The directory entry of the source file.
+    :param rel_path:  The path of the file relative to the source root.
+    :param previous:  The entry of the file in the previous snapshot, None if it was not in it.
+    :return:  The result to report if the file was stored, otherwise None.
+    """
+    stat = src_entry.stat()
+    meta = FileMeta(stat.st_size, stat.st_mtime_ns)
+
+    # If the file is unchanged since the previous snapshot #
+    if previous is not None and not file_changed(meta, FileMeta(previous['size'],
+                                                                previous['mtime_ns'])):
+        store.record(rel_path, meta, previous['mode'], previous['chunks'])
+        return None
+
+    chunks = store.put_file(src_entry.path, meta.size)
+    store.record(rel_path, meta, stat.st_mode & 0o7777, chunks)
+    return CopyResult(f'File Stored: {src_entry.path}', store.root / rel_path, meta)
+
+
+def store_backup(src_path: Path, store: ChunkStore, engine: CopyEngine, recursive: bool,
+                 path_filter: PathFilter = None) -> Path:
+    """
+    Backs up the source tree into the chunk store as a new snapshot.
+
+    :param src_path:  The path to the source directory containing data.
+    :param store:  The chunk store.
+    :param engine:  The copy engine the file jobs are queued into.
+    :param recursive:  Toggle to back up recursively instead of a single directory.
+    :param path_filter:  The include and exclude rules, None to back up every entry.
+    :return:  The path of the snapshot manifest.
+    """
+    previous = store.load_snapshot().get('files', {})
+    dirs = []
+
+    tree = source_tree(src_path, recursive, path_filter=path_filter)
+
+    for rel_dir, dir_entries, file_entries in tree:
+        dirs.extend((rel_dir / entry.name).as_posix() for entry in dir_entries)
+
+        for entry in file_entries:
+            rel_path = (rel_dir / entry.name).as_posix()
+            engine.submit(store_file, store, entry, rel_path, previous.get(rel_path))
+
+    engine.wait()
+    return store.save_snapshot(src_path, dirs)
+
+
+class RestoreSelector:
+    """
+    Selects and orders the files of a restore. Files are selected by path prefix or gitignore \
+    style glob, a selected directory selects everything below it. The files matching the \
+    priority list are restored first in the order of the list, then the rest smallest first, so \
+    critical data and the many small files come back before the large ones.
+
+    :param patterns:  The path prefixes or globs of the files to restore, empty to restore all.
+    :param priority:  The path prefixes or globs of the files restored first, in order.
+    """
+    def __init__(self, patterns: list = (), priority: list = ()):
+        self.regex = re.compile('|'.join(map(self.compile, patterns))) if patterns else None
+        self.priority = [re.compile(self.compile(pattern)) for pattern in priority]
+
+    @staticmethod
+    def compile(pattern: str) -> str:
+        """
+        Translates the prefix or glob into a regex also matching every path below it.
+
+        :param pattern:  The path prefix or glob.
+        :return:  The regex matched against relative posix paths.
+        """
+        return f'(?:{PathFilter.glob_regex(pattern)[0]})(?:/.*)?'
+
+    def selected(self, rel_path: str) -> bool:
+        """
+        Checks whether the file is restored.
+
+        :param rel_path:  The posix path of the file relative to the backup root.
+        :return:  True if the file is restored, False otherwise.
+        """
+        return self.regex is None or self.regex.fullmatch(rel_path) is not None
+
+    def key(self, rel_path: str, size: int) -> tuple:
+        """
+        Gets the restore order sort key of the file.
+
+        :param rel_path:  The posix path of the file relative to the backup root.
+        :param size:  The size of the file.
+        :return:  The priority rank, size and path of the file.
+        """
+        rank = next((index for index, regex in enumerate(self.priority)
+                     if regex.fullmatch(rel_path)), len(self.priority))
+        return rank, size, rel_path
+
+    def dirs(self, all_dirs: list, rel_paths: list) -> list:
+        """
+        Gets the directories to create before the files are restored, parents first. A full \
+        restore creates every directory, a selective one only the parents of the files.
+
+        :param all_dirs:  The relative posix paths of every directory in the backup.
+        :param rel_paths:  The relative posix paths of the restored files.
+        :return:  The relative paths of the directories to create.
+        """
+        # If every file is restored, empty directories are restored too #
+        if self.regex is None:
+            dirs = set(all_dirs)
+        else:
+            dirs = {parent.as_posix() for rel_path in rel_paths
+                    for parent in Path(rel_path).parents if parent != Path('.')}
+
+        return sorted(dirs, key=lambda rel_dir: (rel_dir.count('/'), rel_dir))
+
+
+def restore_file(store: ChunkStore, info: dict, dest_file: Path) -> CopyResult:
     """
-    Returns time of last modification.
+    Restores a file from its chunks, publishing it atomically with its mode and mtime.
 
-    :param file:  The path to the file to check time of last modification.
-    :return:  Time of last file modification.
+    :param store:  The chunk store.
+    :param info:  The entry of the file in the snapshot.
+    :param dest_file:  The path the file is restored to.
+    :return:  The result to report.
     """
-    return datetime.fromtimestamp(file.stat().st_mtime)
+    temp_file = part_path(dest_file)
+
+    with open(temp_file, 'wb') as file:
+        for digest in info['chunks']:
+            file.write(store.get(digest))
 
+    os.chmod(temp_file, info['mode'])
+    os.utime(temp_file, ns=(time.time_ns(), info['mtime_ns']))
+    os.replace(temp_file, dest_file)
+    return CopyResult(f'File Restored: {dest_file}', dest_file,
+                      FileMeta(info['size'], info['mtime_ns']))
 
-def copy_file(src_file: Path, dest_file: Path):
+
+def store_restore(store: ChunkStore, dest_path: Path, engine: CopyEngine,
+                  snapshot: str = None, selector: RestoreSelector = None):
     """
-    Copies file in error validated wrapper.
+    Restores a snapshot of the chunk store into the destination directory.
 
-    :param src_file:  The source file to be copied.
-    :param dest_file:  The dest file where the source file will be copied to.
+    :param store:  The chunk store.
+    :param dest_path:  The path to the directory the snapshot is restored into.
+    :param engine:  The copy engine the file jobs are queued into.
+    :param snapshot:  The name of the snapshot, None for the most recent one.
+    :param selector:  The selection and order of the restored files, None to restore every file.
     :return:  Nothing
     """
-    try:
-        # Copy file from source to destination #
-        shutil.copy(src_file, dest_file)
+    selector = selector if selector is not None else RestoreSelector()
+    manifest = store.load_snapshot(snapshot)
 
-    # If unexpected same file error occurs #
-    except shutil.SameFileError:
-        pass
+    # If the store has no snapshots #
+    if not manifest:
+        raise ValueError(f'No snapshots in chunk store {store.root}')
 
+    dest_path.mkdir(parents=True, exist_ok=True)
+    files = sorted((rel_path for rel_path in manifest['files'] if selector.selected(rel_path)),
+                   key=lambda rel_path: selector.key(rel_path, manifest['files'][rel_path]['size']))
 
-def copy_handler(src_file: Path, dest_file: Path):
+    # Create the directories up front, parents before their children #
+    for rel_dir in selector.dirs(manifest['dirs'], files):
+        engine.notify(dir_copy(dest_path / rel_dir))
+
+    for rel_path in files:
+        engine.submit(restore_file, store, manifest['files'][rel_path], dest_path / rel_path)
+
+
+def list_generations(dest_path: Path) -> list:
     """
-    If file exists check if the source file has a more recent time stamp than the destination \
-    file, if so copy the file. If the file does not exist, simply copy the file.
+    Lists the completed snapshot generations in the destination, oldest first.
 
-    :param src_file:  The source file to be copied.
-    :param dest_file:  The dest file where the source file will be copied to.
-    :return:  Nothing
+    :param dest_path:  The path to the directory holding the generations.
+    :return:  The list of generation paths.
+    """
+    return sorted(path for path in dest_path.iterdir()
+                  if path.is_dir() and GENERATION_RE.fullmatch(path.name))
+
+
+def snapshot_backup(src_path: Path, dest_path: Path, engine: CopyEngine, recursive: bool,
+                    scan_workers: int = 1, path_filter: PathFilter = None) -> Path:
+    """
+    Backs up the source into a new timestamped generation in the destination. Files unchanged \
+    since the previous generation are hardlinked to it, so every generation is a full browsable \
+    copy while only the changed files are written. The generation is filled under a .partial \
+    name and renamed once complete.
+
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the directory holding the generations.
+    :param engine:  The copy engine the file jobs are queued into.
+    :param recursive:  Toggle to copy recursively instead of a single directory.
+    :param scan_workers:  The number of threads scanning subdirectories ahead of the walk.
+    :param path_filter:  The include and exclude rules, None to copy every entry.
+    :return:  The path of the new generation.
     """
-    # If the file exists #
-    if dest_file.exists():
-        # If the source file has a newer timestamp than the dest file #
-        if time_check(src_file) > time_check(dest_file):
-            # Copy the source file to the destination #
-            copy_file(src_file, dest_file)
-            print(f'File Updated: {dest_file}')
-    # If the file does not exist #
+    dest_path.mkdir(parents=True, exist_ok=True)
+    generations = list_generations(dest_path)
+    link_dest = generations[-1] if generations else None
+
+    # Remove the generations left incomplete by interrupted runs #
+    for partial in dest_path.glob('*.partial'):
+        shutil.rmtree(partial)
+
+    name = datetime.now().strftime(GENERATION_FORMAT)
+    temp_path = dest_path / f'{name}.partial'
+    temp_path.mkdir()
+
+    # If recursive copying is selected #
+    if recursive:
+        recursive_copy(src_path, temp_path, engine, scan_workers=scan_workers, link_dest=link_dest,
+                       path_filter=path_filter)
+    # If single directory copying is selected #
     else:
-        # Copy the source file to the destination #
-        copy_file(src_file, dest_file)
-        print(f'File Copied: {src_file}')
+        single_mode(src_path, temp_path, engine, link_dest=link_dest, path_filter=path_filter)
 
+    engine.wait()
+    os.replace(temp_path, dest_path / name)
+    return dest_path / name
 
-def dir_copy(dir_path: Path):
+
+def expired_backups(backups: list, keep: int = None, keep_days: float = None) -> list:
     """
-    Confirms the directory of the destination path exists. If not, the directory is created to \
-    prevent errors.
+    Applies the retention policy to the timestamped snapshots or generations, selecting the ones \
+    beyond the newest ones to keep or older than the max age. The newest backup is always kept.
 
-    :param dir_path:  The path to the directory to check.
-    :return:  Nothing
+    :param backups:  The paths of the backups named after their creation time, oldest first.
+    :param keep:  The number of newest backups to keep, None for no limit.
+    :param keep_days:  The max age in days of the backups to keep, None for no limit.
+    :return:  The list of expired backup paths.
     """
-    # If the directory does not exist #
-    if not dir_path.exists():
-        # Create the missing directory #
-        dir_path.mkdir()
-        print(f'Directory Copied: {dir_path}')
+    now = datetime.now()
+    expired = []
 
+    for rank, backup in enumerate(reversed(backups)):
+        age = now - datetime.strptime(GENERATION_RE.match(backup.name).group(0), GENERATION_FORMAT)
 
-def print_err(msg: str, seconds: int):
+        # If the backup is kept by the retention policy #
+        if rank == 0 or ((keep is None or rank < keep)
+                         and (keep_days is None or age.total_seconds() <= keep_days * 86400)):
+            continue
+
+        expired.append(backup)
+
+    return expired
+
+
+def prune_generations(dest_path: Path, keep: int = None, keep_days: float = None) -> list:
     """
-   Prints time controlled error message via stderr.
+    Applies the retention policy, deleting the generations beyond the newest ones to keep or \
+    older than the max age. The newest generation is always kept.
 
-    :param msg:  The message to be displayed.
-    :param seconds:  The time interval in seconds the message will be displayed.
-    :return:  Nothing
+    :param dest_path:  The path to the directory holding the generations.
+    :param keep:  The number of newest generations to keep, None for no limit.
+    :param keep_days:  The max age in days of the generations to keep, None for no limit.
+    :return:  The list of deleted generation paths.
     """
-    print(f'\n* [ERROR]: {msg} *\n', file=stderr)
-    # If sleep time is passed in #
-    if seconds:
-        time.sleep(seconds)
+    pruned = expired_backups(list_generations(dest_path), keep, keep_days)
+
+    for generation in pruned:
+        # Only the files no other generation links to are freed #
+        shutil.rmtree(generation)
 
+    return pruned
 
-def file_handler(ext_path: Path, iter_path: Path, dst_path: Path, filename: str):
+
+def select_point(backups: list, when: str) -> Path:
     """
-    Handles the file copy whether it is the base path or a folder in the recursive path.
+    Picks the backup of the point in time out of the timestamped snapshots or generations.
 
-    :param ext_path:  Recursive path, if exists.
-    :param iter_path:  The path to the directory of the current iteration of os.walk.
-    :param dst_path:  The destination path where the directory is to be created.
-    :param filename:  The name of the file to be copied.
-    :return:
+    :param backups:  The paths of the backups named after their creation time, oldest first.
+    :param when:  Either latest, the name of a backup or an ISO date and time picking the newest \
+                  backup at or before it.
+    :return:  The path of the selected backup.
     """
-    # Set the source path #
-    src_file = iter_path / filename
+    # If there are no backups #
+    if not backups:
+        raise ValueError('No snapshots to restore from')
+    # If the most recent backup is selected #
+    if when == 'latest':
+        return backups[-1]
 
-    # If regex failed (base path passed in) #
-    if not ext_path:
-        # Set the destination path #
-        dest_file = dst_path / filename
-    # If the path is part of recursive structure #
-    else:
-        # Set the destination recursive path #
-        dest_file = dst_path / ext_path / filename
+    for backup in backups:
+        # If the backup was selected by name #
+        if GENERATION_RE.match(backup.name).group(0) == when:
+            return backup
+
+    moment = datetime.fromisoformat(when)
+    before = [backup for backup in backups if datetime.strptime(
+              GENERATION_RE.match(backup.name).group(0), GENERATION_FORMAT) <= moment]
 
-    # Call the function to handle file copying #
-    copy_handler(src_file, dest_file)
+    # If every backup was made after the point in time #
+    if not before:
+        raise ValueError(f'No snapshot at or before {when}, the oldest is {backups[0].name}')
 
+    return before[-1]
 
-def dir_handler(ext_path: Path, dst_path: Path, folder: str):
+
+def restore_backup(src_path: Path, dest_path: Path, engine: CopyEngine, recursive: bool,
+                   when: str = 'latest', selector: RestoreSelector = None,
+                   scan_workers: int = 1) -> Path:
     """
-    Handles the directory copy whether it is the base path or a folder in the recursive path.
+    Restores a backup into the destination concurrently. The kind of backup is detected from the \
+    source path, a chunk store and a directory of snapshot generations are restored from the \
+    snapshot of the point in time, any other directory is a plain copy. Files already restored \
+    are skipped, so an interrupted restore resumes where it stopped.
 
-    :param ext_path:  Recursive path, if exists.
-    :param dst_path:  The destination path where the directory is to be created.
-    :param folder:  The name of the directory to be created.
-    :return:  Nothing
+    :param src_path:  The path to the backup.
+    :param dest_path:  The path to the directory the backup is restored into.
+    :param engine:  The copy engine the file jobs are queued into.
+    :param recursive:  Toggle to restore recursively instead of a single directory.
+    :param when:  The point in time to restore, see select_point.
+    :param selector:  The selection and order of the restored files, None to restore every file.
+    :param scan_workers:  The number of threads scanning subdirectories ahead of the walk.
+    :return:  The path of the restored backup.
     """
-    # If regex failed (base path passed in) #
-    if not ext_path:
-        # Format the destination path #
-        dir_path = dst_path / folder
-    # If the path is part of recursive structure #
+    selector = selector if selector is not None else RestoreSelector()
+
+    # If the backup is a chunk store #
+    if ChunkStore.exists(src_path):
+        store = ChunkStore(src_path, readonly=True)
+        snapshot = select_point(store.snapshots(), when)
+        store_restore(store, dest_path, engine, snapshot.name, selector)
+        return snapshot
+
+    generations = list_generations(src_path)
+    # If the backup holds snapshot generations #
+    if generations:
+        backup_path = select_point(generations, when)
+    # If a point in time was requested from a plain copy #
+    elif when != 'latest':
+        raise ValueError(f'{src_path} holds a plain copy without snapshots')
     else:
-        # Format the destination path #
-        dir_path = dst_path / ext_path / folder
+        backup_path = src_path
 
-    # Copy the directory #
-    dir_copy(dir_path)
+    dest_path.mkdir(parents=True, exist_ok=True)
+    all_dirs = []
+    files = []
+
+    for rel_dir, dir_entries, file_entries in source_tree(backup_path, recursive, scan_workers):
+        # If this is the backup root, skip the files of Backup Buddy #
+        if rel_dir == Path('.'):
+            dir_entries[:] = [entry for entry in dir_entries
+                              if not entry.name.startswith(TOOL_PREFIX)]
+            file_entries = [entry for entry in file_entries
+                            if not entry.name.startswith(TOOL_PREFIX)]
+
+        all_dirs.extend((rel_dir / entry.name).as_posix() for entry in dir_entries)
+
+        for entry in file_entries:
+            rel_path = (rel_dir / entry.name).as_posix()
+            # If the file is selected #
+            if selector.selected(rel_path):
+                files.append((selector.key(rel_path, entry_meta(entry).size), entry))
+
+    files.sort(key=lambda item: item[0])
+    rel_paths = [key[2] for key, _ in files]
+
+    # Create the directories up front, parents before their children #
+    for rel_dir in selector.dirs(all_dirs, rel_paths):
+        engine.notify(dir_copy(dest_path / rel_dir))
+
+    dest_entries = {}
+    jobs = []
+
+    for rel_path, (_, entry) in zip(rel_paths, files):
+        dest_file = dest_path / rel_path
+        # Scan each restored directory of the destination once #
+        if dest_file.parent not in dest_entries:
+            dest_entries[dest_file.parent] = scan_files(dest_file.parent)
 
+        jobs.append((entry, dest_file, dest_entries[dest_file.parent].get(entry.name)))
 
-def single_mode(src_path: Path, dest_path: Path):
+    queue_copies(jobs, engine)
+    return backup_path
+
+
+def positive_int(value: str) -> int:
     """
-    Copies contents of source path to dest path in non-recursive manner.
+    Argparse type which validates the passed in value is a positive integer.
 
-    :param src_path:  The path to the source directory containing data.
-    :param dest_path:  The path to the destination directory where the data will go.
-    :return:  Nothing
+    :param value:  The command line value to be validated.
+    :return:  The validated integer.
+    """
+    try:
+        number = int(value)
+
+    # If the value is not an integer #
+    except ValueError as conv_err:
+        raise argparse.ArgumentTypeError(f'{value} is not an integer') from conv_err
+
+    # If the number is zero or negative #
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+
+    return number
+
+
+def byte_size(value: str) -> int:
+    """
+    Argparse type which converts a size with an optional K, M, G or T suffix into bytes.
+
+    :param value:  The command line value to be converted.
+    :return:  The size in bytes.
+    """
+    match = re.fullmatch(r'(\d+)([KMGT]?)B?', value.strip().upper())
+    # If the value is not a size #
+    if not match:
+        raise argparse.ArgumentTypeError(f'{value} is not a size like 512K, 64M or 2G')
+
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def rules_file(value: str) -> list:
+    """
+    Argparse type which reads the glob rules of a gitignore style file, skipping blank lines and \
+    comments.
+
+    :param value:  The command line path of the rules file.
+    :return:  The list of rules.
+    """
+    try:
+        with open(value, encoding='utf-8') as rules:
+            lines = (line.rstrip() for line in rules)
+            return [line for line in lines if line and not line.startswith('#')]
+
+    # If the file does not exist or access was denied #
+    except OSError as file_err:
+        raise argparse.ArgumentTypeError(f'unable to read {value}: {file_err}') from file_err
+
+
+def point_in_time(value: str) -> str:
+    """
+    Argparse type which validates the passed in value is latest, the timestamp name of a \
+    snapshot or an ISO date and time.
+
+    :param value:  The command line value to be validated.
+    :return:  The validated value.
+    """
+    # If the value is latest or a snapshot name #
+    if value == 'latest' or GENERATION_RE.fullmatch(value):
+        return value
+
+    try:
+        datetime.fromisoformat(value)
+
+    # If the value is not a date #
+    except ValueError as conv_err:
+        raise argparse.ArgumentTypeError(f'{value} is not latest, a snapshot name or an ISO date '
+                                         'like 2024-05-01T13:00') from conv_err
+
+    return value
+
+
+def positive_float(value: str) -> float:
+    """
+    Argparse type which validates the passed in value is a positive number.
+
+    :param value:  The command line value to be validated.
+    :return:  The validated number.
+    """
+    try:
+        number = float(value)
+
+    # If the value is not a number #
+    except ValueError as conv_err:
+        raise argparse.ArgumentTypeError(f'{value} is not a number') from conv_err
+
+    # If the number is zero or negative #
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive number')
+
+    return number
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """
+    Parses the command line options which tune the copy operations.
+
+    :param argv:  The arguments to parse, None to parse the program command line.
+    :return:  The parsed command line options.
+    """
+    parser = argparse.ArgumentParser(description='Copies or updates data from a source path to'
+                                                 ' a destination path.')
+    parser.add_argument('-w', '--workers', type=positive_int, default=DEFAULT_WORKERS,
+                        help='Number of worker threads copying files concurrently (default: '
+                             f'{DEFAULT_WORKERS}, 1 copies serially).')
+    parser.add_argument('--queue-size', type=positive_int, default=0, dest='queue_size',
+                        help='Max number of queued copy jobs before the walker waits on the '
+                             'workers (default: 4 per worker).')
+    parser.add_argument('--scan-workers', type=positive_int, default=1, dest='scan_workers',
+                        help='Number of threads scanning source subdirectories ahead of the '
+                             'recursive walk (default: 1, scans serially).')
+    parser.add_argument('--exclude', action='append', default=[], dest='filter_rules',
+                        metavar='PATTERN',
+                        help='Gitignore style glob of the entries to skip, a trailing / only '
+                             'matches directories, which are never descended into. Repeat for '
+                             'several, the last matching rule wins.')
+    parser.add_argument('--include', type=lambda value: f'!{value}', action='append',
+                        dest='filter_rules', metavar='PATTERN',
+                        help='Gitignore style glob of the entries to copy even though an earlier '
+                             '--exclude matched them.')
+    parser.add_argument('--exclude-from', type=rules_file, action='extend', dest='filter_rules',
+                        metavar='FILE',
+                        help='Read exclude rules from a gitignore style file, with ! lines '
+                             'including entries back.')
+    parser.add_argument('--min-size', type=byte_size, default=None, dest='min_size',
+                        help='Skip the files smaller than this size.')
+    parser.add_argument('--max-size', type=byte_size, default=None, dest='max_size',
+                        help='Skip the files larger than this size.')
+    parser.add_argument('--min-age', type=positive_float, default=None, dest='min_age',
+                        help='Skip the files modified less than this many days ago.')
+    parser.add_argument('--max-age', type=positive_float, default=None, dest='max_age',
+                        help='Skip the files modified more than this many days ago.')
+    parser.add_argument('--manifest', default=False, action='store_true',
+                        help=f'Keep an index of the copied files in {MANIFEST_NAME} in the '
+                             'destination root, later runs diff against it instead of scanning '
+                             'the destination.')
+    parser.add_argument('--rebuild-manifest', default=False, action='store_true',
+                        dest='rebuild_manifest',
+                        help='Rebuild the manifest from a destination scan, use after the '
+                             'destination was modified outside of Backup Buddy.')
+    parser.add_argument('--delta', default=False, action='store_true',
+                        help='Update large modified files in place by rewriting only the changed '
+                             'blocks, with --manifest the blocks are compared against stored '
+                             'signatures instead of reading the destination.')
+    parser.add_argument('--delta-min-size', type=byte_size, default=DEFAULT_DELTA_MIN_SIZE,
+                        dest='delta_min_size', help='Minimum size of files to delta update '
+                                                    '(default: 64M).')
+    parser.add_argument('--range-workers', type=positive_int, default=DEFAULT_RANGE_WORKERS,
+                        dest='range_workers',
+                        help='Number of threads copying the byte ranges of a large file in '
+                             f'parallel (default: {DEFAULT_RANGE_WORKERS}, 1 copies every file as '
+                             'a single stream).')
+    parser.add_argument('--range-min-size', type=byte_size, default=DEFAULT_RANGE_MIN_SIZE,
+                        dest='range_min_size', help='Minimum size of files copied as parallel '
+                                                    'ranges (default: 256M).')
+    parser.add_argument('--range-size', type=byte_size, default=DEFAULT_RANGE_SIZE,
+                        dest='range_size', help='Size of the byte ranges a large file is split '
+                                                'into (default: 64M).')
+    parser.add_argument('--small-file-size', type=byte_size, default=DEFAULT_SMALL_FILE_SIZE,
+                        dest='small_file_size',
+                        help='New files up to this size are copied whole in batches with their '
+                             'metadata applied in a deferred pass (default: 64K, 0 disables the '
+                             'batches).')
+    parser.add_argument('--durability', choices=DURABILITY_LEVELS, default='none',
+                        help='none leaves writeback to the OS, run syncs the destination once at '
+                             'the end, batch also syncs each batch of files before it is reported '
+                             'and file also fsyncs every file (default: none).')
+    parser.add_argument('--watch', default=False, action='store_true',
+                        help='After the initial copy keep running and replicate source changes '
+                             'reported by inotify until Ctrl + C (Linux only).')
+    parser.add_argument('--watch-debounce', type=positive_float, default=DEFAULT_DEBOUNCE,
+                        dest='watch_debounce', help='Seconds of quiet to wait before replicating '
+                                                    'a batch of changes (default: 1.0).')
+    parser.add_argument('--jobs', type=Path, default=None, metavar='FILE',
+                        help='Run every source and destination pair of a JSON or TOML job file '
+                             'without prompting, the command line options apply to every job.')
+    parser.add_argument('-o', '--output', choices=OUTPUT_MODES, default='verbose',
+                        help='verbose prints every copied file, progress shows a live status '
+                             'line and quiet only prints the summary (default: verbose).')
+    parser.add_argument('--file-log', type=Path, default=None, dest='file_log',
+                        help='Path of a log where every copied file is written by a background '
+                             'thread.')
+    parser.add_argument('--metrics', type=Path, default=None,
+                        help='Path of a report with per-phase counters, latency histograms and '
+                             'the slowest files written at the end of the run.')
+    parser.add_argument('--metrics-format', choices=('json', 'prometheus'), default='json',
+                        dest='metrics_format', help='Format of the metrics report, prometheus '
+                                                    'writes a node exporter textfile '
+                                                    '(default: json).')
+    parser.add_argument('--profile', type=Path, default=None,
+                        help='Path where a cProfile capture of the run is saved, only the main '
+                             'thread is profiled so combine with -w 1 to profile the copies.')
+    parser.add_argument('--tracemalloc', default=False, action='store_true',
+                        help='Trace memory allocations, reporting the peak and the top '
+                             'allocation sites.')
+    parser.add_argument('--archive', choices=ARCHIVE_FORMATS, default=None,
+                        help='Stream the source into a single tar archive in the destination '
+                             'instead of mirroring it, optionally compressed (zst requires the '
+                             'zstandard package).')
+    parser.add_argument('--compress-level', type=int, default=None, dest='compress_level',
+                        help='Compression level of the archive (default: format default).')
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='Only archive the files changed since the previous archive in the '
+                             'destination.')
+    parser.add_argument('--store', default=False, action='store_true',
+                        help='Back up into a deduplicating chunk store in the destination, each '
+                             'run is saved as a snapshot and only new chunks are written.')
+    parser.add_argument('--store-restore', nargs='?', const='latest', default=None,
+                        dest='store_restore', metavar='SNAPSHOT',
+                        help='Restore a snapshot of the chunk store in the source path into the '
+                             'destination (default: the latest snapshot).')
+    parser.add_argument('--store-gc', default=False, action='store_true', dest='store_gc',
+                        help='After the store backup and the --keep and --keep-days retention '
+                             'delete the chunks no longer referenced by any snapshot.')
+    parser.add_argument('--restore', nargs='?', const='latest', default=None, type=point_in_time,
+                        metavar='WHEN',
+                        help='Restore the backup in the source path into the destination '
+                             'concurrently. Chunk stores and snapshot generations restore the '
+                             'newest snapshot at or before WHEN, an ISO date and time or a '
+                             'snapshot name (default: latest).')
+    parser.add_argument('--select', action='append', default=[], metavar='PATTERN',
+                        help='Path prefix or gitignore style glob of the files to restore, repeat '
+                             'for several (default: every file).')
+    parser.add_argument('--priority', type=rules_file, default=[], metavar='FILE',
+                        help='File listing the path prefixes or globs restored first, in order, '
+                             'the other files are restored smallest first.')
+    parser.add_argument('--mirror', nargs='?', const='delete', choices=('delete', 'quarantine'),
+                        default=None,
+                        help='Propagate source deletions to the destination, deleting the extra '
+                             'entries or moving them into the quarantine directory '
+                             f'{QUARANTINE_NAME} (default: delete). Files renamed in the source '
+                             'are renamed in the destination instead of copied again.')
+    parser.add_argument('--journal', default=False, action='store_true',
+                        help=f'Checkpoint completed subtrees of recursive runs in {JOURNAL_NAME} '
+                             'in the destination root, so an interrupted run resumes by skipping '
+                             'them.')
+    parser.add_argument('--verify', default=False, action='store_true',
+                        help='After the copy hash every source file and its destination copy in '
+                             'parallel and report the mismatches, source digests are cached in '
+                             f'{DIGEST_CACHE_NAME} so unchanged source files are not hashed again '
+                             'while the copies are always hashed.')
+    parser.add_argument('--checksum', default=False, action='store_true',
+                        help='Detect changes of same sized files by hashing their contents '
+                             'instead of comparing modification times, for file systems where '
+                             'mtimes cannot be trusted.')
+    parser.add_argument('--hash', choices=HASH_ALGORITHMS, default='blake2b',
+                        help='Hash algorithm of --verify and --checksum (default: blake2b).')
+    parser.add_argument('--bwlimit', type=byte_size, default=None,
+                        help='Max bytes per second the copies read, with an optional K, M or G '
+                             'suffix.')
+    parser.add_argument('--iops-limit', type=positive_int, default=None, dest='iops_limit',
+                        help='Max I/O calls per second of the copies.')
+    parser.add_argument('--adaptive', default=False, action='store_true',
+                        help='Watch the latency of the copy I/O calls and back off the number of '
+                             'concurrent copies while device latency is up.')
+    parser.add_argument('--io-class', choices=IOPRIO_CLASSES, default=None, dest='io_class',
+                        help='Linux I/O scheduling class of the process, idle only uses the '
+                             'disk when nothing else does.')
+    parser.add_argument('--drop-cache', default=False, action='store_true', dest='drop_cache',
+                        help='Drop the copied files from the page cache with posix_fadvise so the '
+                             'backup does not evict hot pages.')
+    parser.add_argument('--plan', nargs='?', const='inode', choices=PLAN_ORDERS, default=None,
+                        help='Scan the whole source first and copy in on-disk order, sorted by '
+                             'inode or by physical extent offset through FIEMAP (default: '
+                             'inode), creating the missing directories up front.')
+    parser.add_argument('--dry-run', default=False, action='store_true', dest='dry_run',
+                        help='Print the copy plan and its total byte count without copying.')
+    parser.add_argument('--snapshot', default=False, action='store_true',
+                        help='Back up into a new timestamped generation in the destination, files '
+                             'unchanged since the previous generation are hardlinked to it '
+                             'instead of copied.')
+    parser.add_argument('--keep', type=positive_int, default=None,
+                        help='Number of newest snapshot generations or chunk store snapshots to '
+                             'keep, older ones are deleted after the run (default: keep all).')
+    parser.add_argument('--keep-days', type=positive_float, default=None, dest='keep_days',
+                        help='Delete the snapshot generations or chunk store snapshots older than '
+                             'this many days after the run, the newest one is always kept.')
+    args = parser.parse_args(argv)
+
+    # If a job file is combined with the process wide profilers #
+    if args.jobs and (args.profile or args.tracemalloc):
+        parser.error('--jobs cannot be combined with --profile or --tracemalloc')
+    # If the ranges are empty #
+    if args.range_size < 1:
+        parser.error('--range-size must be at least one byte')
+    # If archive mode is combined with options that only apply to mirroring #
+    if args.archive and (args.watch or args.delta or args.manifest or args.rebuild_manifest):
+        parser.error('--archive cannot be combined with --watch, --delta or the manifest')
+    # If incremental is used without archive mode #
+    if args.incremental and not args.archive:
+        parser.error('--incremental requires --archive')
+    # If the chunk store is combined with another output mode or mirroring options #
+    if (args.store or args.store_restore) and (args.archive or args.watch or args.delta
+                                               or args.manifest or args.rebuild_manifest):
+        parser.error('the chunk store cannot be combined with --archive, --watch, --delta or '
+                     'the manifest')
+    # If path filters are combined with a restore, which selects files with --select instead #
+    if (args.restore or args.store_restore) and (args.filter_rules or args.min_size is not None
+                               or args.max_size is not None or args.min_age or args.max_age):
+        parser.error('--restore and --store-restore select files with --select instead of the '
+                     'include and exclude filters')
+    # If a restore is combined with options that only apply to backups #
+    if args.restore and (args.archive or args.store or args.store_restore or args.snapshot
+                         or args.plan or args.dry_run or args.watch or args.journal or args.mirror
+                         or args.manifest or args.rebuild_manifest or args.verify):
+        parser.error('--restore cannot be combined with --archive, the chunk store, --snapshot, '
+                     '--plan, --dry-run, --watch, --journal, --mirror, the manifest or --verify')
+    # If the restore selection is used without a restore #
+    if (args.select or args.priority) and not (args.restore or args.store_restore):
+        parser.error('--select and --priority require --restore or --store-restore')
+    # If both a store backup and restore are selected #
+    if args.store and args.store_restore:
+        parser.error('--store and --store-restore are mutually exclusive')
+    # If snapshot mode is combined with another output mode or in place update options #
+    if args.snapshot and (args.archive or args.store or args.store_restore or args.watch
+                          or args.delta or args.manifest or args.rebuild_manifest):
+        parser.error('--snapshot cannot be combined with --archive, the chunk store, --watch, '
+                     '--delta or the manifest')
+    # If the copy plan is combined with a mode that does not mirror the source #
+    if (args.plan or args.dry_run) and (args.archive or args.store or args.store_restore
+                                        or args.snapshot):
+        parser.error('--plan and --dry-run cannot be combined with --archive, the chunk store or '
+                     '--snapshot')
+    # If a dry run is combined with watch mode #
+    if args.dry_run and args.watch:
+        parser.error('--dry-run cannot be combined with --watch')
+    # If mirror mode is combined with a mode that does not update the destination in place #
+    if args.mirror and (args.archive or args.store or args.store_restore or args.snapshot
+                        or args.plan or args.dry_run):
+        parser.error('--mirror cannot be combined with --archive, the chunk store, --snapshot, '
+                     '--plan or --dry-run')
+    # If mirror mode is combined with the manifest, which does not list the extra entries #
+    if args.mirror and (args.manifest or args.rebuild_manifest):
+        parser.error('--mirror scans the destination and cannot be combined with the manifest')
+    # If verification or checksums are combined with a mode that does not mirror the source #
+    if (args.verify or args.checksum) and (args.archive or args.store or args.store_restore
+                                           or args.snapshot or args.dry_run):
+        parser.error('--verify and --checksum cannot be combined with --archive, the chunk '
+                     'store, --snapshot or --dry-run')
+    # If throttling is combined with a mode that does not copy through the copy backend #
+    if (args.bwlimit or args.iops_limit or args.adaptive or args.drop_cache) \
+    and (args.archive or args.store or args.store_restore):
+        parser.error('--bwlimit, --iops-limit, --adaptive and --drop-cache cannot be combined '
+                     'with --archive or the chunk store')
+    # If checksums are combined with the planner, which filters by modification time #
+    if args.checksum and args.plan:
+        parser.error('--checksum cannot be combined with --plan')
+    # If the journal is combined with a mode that does not walk the source recursively #
+    if args.journal and (args.archive or args.store or args.store_restore or args.snapshot
+                         or args.plan or args.dry_run or args.watch):
+        parser.error('--journal cannot be combined with --archive, the chunk store, --snapshot, '
+                     '--plan, --dry-run or --watch')
+    # If the journal is combined with the manifest, which is rebuilt after an interrupted run #
+    if args.journal and (args.manifest or args.rebuild_manifest):
+        parser.error('--journal cannot be combined with the manifest, an interrupted manifest '
+                     'run is rebuilt from a full destination scan')
+    # If a retention policy is used without snapshots to apply it to #
+    if (args.keep or args.keep_days) and not (args.snapshot or args.store):
+        parser.error('--keep and --keep-days require --snapshot or --store')
+    # If garbage collection is used without a store backup #
+    if args.store_gc and not args.store:
+        parser.error('--store-gc requires --store')
+    # If the zst format is selected without the zstandard package #
+    if args.archive == 'zst' and zstandard is None:
+        parser.error('--archive zst requires the zstandard package')
+
+    return args
+
+
+def make_path_filter(args: argparse.Namespace, src_path: Path) -> PathFilter:
+    """
+    Compiles the include and exclude options into a path filter of the source path.
+
+    :param args:  The parsed command line options.
+    :param src_path:  The path to the source directory the rules are relative to.
+    :return:  The path filter, None if no rules or limits were passed in.
     """
-    # Iterate through directory source directory #
-    for file in os.scandir(src_path):
-        # Format the paths to src/dest files #
-        src_file = src_path / file.name
-        dest_file = dest_path / file.name
+    # If every entry is copied #
+    if not args.filter_rules and args.min_size is None and args.max_size is None \
+    and args.min_age is None and args.max_age is None:
+        return None
 
-        # If the iteration is a file #
-        if src_file.is_file():
-            # Call the function to handle file copying #
-            copy_handler(src_file, dest_file)
+    return PathFilter(src_path, args.filter_rules, args.min_size, args.max_size, args.min_age,
+                      args.max_age)
 
 
 def mode_input() -> str:
@@ -180,10 +4679,10 @@ def mode_input() -> str:
 
 def path_input() -> tuple:
     """
-    Gets the source path where to the data is to be copied from and the destination path where the \
-    data is to be copied to.
+    Gets the source path where to the data is to be copied from and the destination paths where \
+    the data is to be copied to, several destinations are separated with a | character.
 
-    :return:  The input source and destination path.
+    :return:  The input source path and the list of destination paths.
     """
     # If OS is Windows #
     if os.name == 'nt':
@@ -205,12 +4704,15 @@ def path_input() -> tuple:
         # Prompt user for destination & source paths for backups #
         src_path = input('C:\\enter\\Windows\\path OR /enter/Linux/path OR'
                          ' hit enter to use srcDock:\n')
-        dest_path = input('\nC:\\enter\\Windows\\path OR /enter/Linux/path OR'
-                          ' hit enter to use destDock:\n')
+        dest_input = input('\nC:\\enter\\Windows\\path OR /enter/Linux/path OR'
+                           ' hit enter to use destDock (separate several with |):\n')
+        # The | character is invalid in paths, so it separates several destinations #
+        dest_paths = [dest_path.strip() for dest_path in dest_input.split('|')]
 
         # Validates input to either match the regex or detect enter to default dir #
         if (not re.search(reg_path, src_path) and src_path != '') \
-        or (not re.search(reg_path, dest_path) and dest_path != ''):
+        or any(not re.search(reg_path, dest_path) for dest_path in dest_paths
+               if dest_path != '') or (len(dest_paths) > 1 and '' in dest_paths):
             print_err('Improper format provided .. try again', 2)
             continue
 
@@ -219,12 +4721,12 @@ def path_input() -> tuple:
             src_path = src_dir
 
         # If default destination path detected #
-        if dest_path == '':
-            dest_path = dest_dir
+        if dest_paths == ['']:
+            dest_paths = [dest_dir]
 
         # Set validated input paths as pathlib objects #
         src_path = Path(src_path)
-        dest_path = Path(dest_path)
+        dest_paths = [Path(dest_path) for dest_path in dest_paths]
 
         # If the source directory does not exist #
         if not src_path.exists():
@@ -233,7 +4735,464 @@ def path_input() -> tuple:
 
         break
 
-    return src_path, dest_path
+    return src_path, dest_paths
+
+
+def run_backup(args: argparse.Namespace, src_path: Path, dest_path: Path, recursive: bool,
+               executor: ThreadPoolExecutor = None):
+    """
+    Runs the copy operations of the source path into the destination path with the passed in \
+    options, exporting the run metrics and profiles if enabled.
+
+    :param args:  The parsed command line options.
+    :param src_path:  The path to the source directory containing data.
+    :param dest_path:  The path to the destination directory where the data will go.
+    :param recursive:  Toggle to copy recursively instead of a single directory.
+    :param executor:  A worker pool shared across jobs, None to create one for the run.
+    :return:  Nothing
+    """
+    reporter = ProgressReporter(args.output, args.file_log)
+    path_filter = make_path_filter(args, src_path)
+
+    # If archive mode is selected instead of mirroring #
+    if args.archive:
+        try:
+            archive_path = archive_backup(src_path, dest_path, reporter, recursive, args.archive,
+                                          args.compress_level, args.incremental, path_filter)
+        finally:
+            reporter.finish()
+
+        print(f'\nArchive written: {archive_path}')
+        return
+
+    # If the chunk store is selected instead of mirroring #
+    if args.store or args.store_restore:
+        try:
+            with CopyEngine(args.workers, args.queue_size, reporter=reporter,
+                            executor=executor) as engine:
+                # If a snapshot is restored out of the store in the source path #
+                if args.store_restore:
+                    snapshot = None if args.store_restore == 'latest' else args.store_restore
+                    store_restore(ChunkStore(src_path, readonly=True), dest_path, engine,
+                                  snapshot, RestoreSelector(args.select, args.priority))
+                    return
+
+                with ChunkStore(dest_path, args.workers) as store:
+                    snapshot_path = store_backup(src_path, store, engine, recursive, path_filter)
+        finally:
+            reporter.finish()
+
+        print(f'\nSnapshot written: {snapshot_path} ({store.written} new chunk bytes)')
+
+        # Apply the retention policy first, so the chunks of the pruned snapshots are collected #
+        for snapshot in store.prune(args.keep, args.keep_days):
+            print(f'Snapshot pruned: {snapshot}')
+
+        # If unreferenced chunks are to be deleted #
+        if args.store_gc:
+            deleted, freed = store.gc()
+            print(f'Garbage collected {deleted} chunks ({freed} bytes)')
+        return
+
+    # If the destination manifest is enabled #
+    if args.manifest or args.rebuild_manifest:
+        manifest_context = Manifest(dest_path, rebuild=args.rebuild_manifest)
+    else:
+        manifest_context = nullcontext()
+
+    # If checkpointing is enabled, single directory runs have nothing to resume #
+    if args.journal and recursive:
+        journal_context = Journal(dest_path, src_path)
+    else:
+        journal_context = nullcontext()
+
+    mirror = Mirror(dest_path, args.mirror == 'quarantine', path_filter) if args.mirror else None
+    throttle = None
+
+    # If the copies are throttled #
+    if args.bwlimit or args.iops_limit or args.adaptive:
+        throttle = Throttle(args.bwlimit, args.iops_limit, args.workers if args.adaptive else 0)
+    metrics = Metrics(enabled=args.metrics is not None)
+    profiler = cProfile.Profile() if args.profile else None
+
+    # If memory allocation tracing is enabled #
+    if args.tracemalloc:
+        tracemalloc.start()
+    # If profiling is enabled #
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        # Set up the manifest and the worker pool for the copy operations #
+        with manifest_context as manifest, journal_context as journal, \
+        CopyEngine(args.workers, args.queue_size,
+                   CopyBackend(args.delta_min_size if args.delta else 0, manifest, metrics,
+                               args.hash if args.checksum else None, throttle,
+                               args.drop_cache, args.range_workers, args.range_min_size,
+                               args.range_size, args.small_file_size, args.durability),
+                   reporter, metrics, executor) as engine:
+            # If the manifest is in use, record the copied files #
+            if manifest is not None:
+                engine.listeners.append(manifest.record)
+            # If the journal is in use, record the completed subtrees #
+            if journal is not None:
+                engine.checkpoints.append(journal.checkpoint)
+
+            # If a backup is restored into the destination #
+            if args.restore:
+                restored = restore_backup(src_path, dest_path, engine, recursive, args.restore,
+                                          RestoreSelector(args.select, args.priority),
+                                          args.scan_workers)
+            # If a new snapshot generation is created instead of updating the destination #
+            elif args.snapshot:
+                snapshot_path = snapshot_backup(src_path, dest_path, engine, recursive,
+                                                args.scan_workers, path_filter)
+            # If the copy is planned up front #
+            elif args.plan or args.dry_run:
+                plan = plan_copy(src_path, dest_path, recursive, manifest, args.scan_workers,
+                                 args.plan or 'inode', path_filter)
+                # If only the plan is printed #
+                if args.dry_run:
+                    print_plan(plan)
+                else:
+                    execute_plan(plan, engine, manifest)
+            # If recursive copying is selected #
+            elif recursive:
+                recursive_copy(src_path, dest_path, engine, manifest, args.scan_workers,
+                               journal=journal, mirror=mirror, path_filter=path_filter)
+            # If single directory copying is selected #
+            else:
+                # Copy source to destination directory in single mode #
+                single_mode(src_path, dest_path, engine, manifest, mirror=mirror,
+                            path_filter=path_filter)
+
+            # If watch mode is enabled, keep replicating changes after the initial copy #
+            if args.watch:
+                engine.wait()
+                # If the manifest is in use, persist the initial copy #
+                if manifest is not None:
+                    manifest.commit()
+
+                watch_mode(src_path, dest_path, engine, manifest, recursive, args.watch_debounce,
+                           path_filter)
+
+    finally:
+        # If profiling is enabled, save the profile #
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+        reporter.finish()
+
+    # If the copied data is made durable, sync the destination once at the end of the run #
+    if args.durability != 'none':
+        sync_fs(dest_path)
+
+    # If any files were copied, report which copy backend tiers were used #
+    if engine.backend.summary():
+        print(f'\nCopy backend: {engine.backend.summary()}')
+    # If a path filter is in use, report what it excluded #
+    if path_filter is not None:
+        print(f'\nFilter: {path_filter.pruned_dirs} directories pruned, '
+              f'{path_filter.skipped_files} files skipped')
+
+    verifier = None
+
+    # If the copies are verified, hash them in a separate pass over the source #
+    if args.verify:
+        print(f'\n{19 * "*"} Verifying copies {48 * "*"}')
+
+        # Mismatches are always printed, matching files are only tallied #
+        with DigestCache(dest_path) as cache, \
+        CopyEngine(args.workers, args.queue_size, reporter=ProgressReporter(),
+                   executor=executor) as engine_verify:
+            verifier = Verifier(cache, args.hash)
+            verify_tree(src_path, dest_path, engine_verify, verifier, recursive, args.scan_workers,
+                        make_path_filter(args, src_path))
+
+        print(f'\nVerify: {verifier.summary()}')
+
+    counters = {'files_checked': reporter.checked, 'files_copied': reporter.copied,
+                'bytes_copied': reporter.copied_bytes}
+    # If the copies were verified, add the verification tallies #
+    if verifier is not None:
+        counters.update({f'files_verify_{outcome}': count
+                         for outcome, count in verifier.counts.items()})
+    counters.update({f'files_copied_{tier}': count
+                     for tier, count in engine.backend.counts.items()})
+
+    # If memory allocation tracing is enabled, add the peak and top allocation sites #
+    if args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        counters['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        counters['tracemalloc_top'] = [str(stat) for stat in
+                                       snapshot.statistics('lineno')[:SLOWEST_FILES]]
+        tracemalloc.stop()
+
+    # If a backup was restored, report which one #
+    if args.restore:
+        print(f'\nRestored from: {restored}')
+
+    # If mirror mode is selected, report the propagated changes #
+    if mirror is not None:
+        print(f'\nMirror: {mirror.renamed} renamed, {mirror.removed} removed')
+
+    # If snapshot mode is selected, apply the retention policy #
+    if args.snapshot:
+        print(f'\nSnapshot written: {snapshot_path}')
+
+        for generation in prune_generations(dest_path, args.keep, args.keep_days):
+            print(f'Snapshot pruned: {generation}')
+
+    # If the metrics report is enabled #
+    if args.metrics is not None:
+        metrics.export(args.metrics, args.metrics_format, counters)
+    # If memory allocation tracing is enabled without a metrics report #
+    elif args.tracemalloc:
+        print(f'\nPeak traced memory: {counters["tracemalloc_peak_bytes"]} bytes')
+        print('\n'.join(counters['tracemalloc_top']))
+
+
+def fanout_backup(args: argparse.Namespace, src_path: Path, dest_paths: list, recursive: bool,
+                  executor: ThreadPoolExecutor = None):
+    """
+    Runs the copy operations of the source path into several destination paths at once, reading \
+    each source file a single time.
+
+    :param args:  The parsed command line options.
+    :param src_path:  The path to the source directory containing data.
+    :param dest_paths:  The paths to the destination directories where the data will go.
+    :param recursive:  Toggle to copy recursively instead of a single directory.
+    :param executor:  A worker pool shared across jobs, None to create one for the run.
+    :return:  Nothing
+    """
+    reporter = ProgressReporter(args.output, args.file_log)
+
+    try:
+        # Set up the destination writers and the worker pool reading the source #
+        with FanoutCopier(dest_paths, args.workers) as copier, \
+        CopyEngine(args.workers, args.queue_size, reporter=reporter, executor=executor) as engine:
+            fanout_copy(src_path, copier, engine, recursive, args.scan_workers,
+                        make_path_filter(args, src_path))
+    finally:
+        reporter.finish()
+
+
+def fanout_conflicts(args: argparse.Namespace) -> list:
+    """
+    Gets the passed in options which are bound to a single destination. Options are compared \
+    against their defaults, as some of them such as --durability none have truthy defaults.
+
+    :param args:  The parsed command line options.
+    :return:  The list of conflicting command line flags.
+    """
+    defaults = parse_args([])
+    return [f'--{name.replace("_", "-")}' for name in FANOUT_CONFLICTS
+            if getattr(args, name) != getattr(defaults, name)]
+
+
+def job_argv(options: dict) -> list:
+    """
+    Converts the options table of a job into command line arguments, true passes a flag, false \
+    omits it and a list repeats it.
+
+    :param options:  The option name to value dict, names use the long flag without dashes.
+    :return:  The list of command line arguments.
+    """
+    argv = []
+
+    for key, value in options.items():
+        flag = f'--{key.replace("_", "-")}'
+        # If the option is a toggle #
+        if isinstance(value, bool):
+            argv.extend([flag] if value else [])
+        # If the option is repeated #
+        elif isinstance(value, list):
+            for item in value:
+                argv.extend([flag, str(item)])
+        # If the option has a value #
+        elif value is not None:
+            argv.extend([flag, str(value)])
+
+    return argv
+
+
+def load_jobs(jobs_path: Path, argv: list) -> list:
+    """
+    Loads the jobs of a JSON or TOML job file. Every job is parsed like a command line made of the \
+    program options, the defaults table of the file and the options table of the job, so later \
+    values win and repeated options add up.
+
+    :param jobs_path:  The path of the job file.
+    :param argv:  The command line arguments of the program.
+    :return:  The list of jobs.
+    """
+    # If the job file is TOML #
+    if jobs_path.suffix == '.toml':
+        # If the TOML parser is unavailable #
+        if tomllib is None:
+            raise ValueError('TOML job files require Python 3.11 or newer, use JSON instead')
+
+        with open(jobs_path, 'rb') as jobs_file:
+            spec = tomllib.load(jobs_file)
+    else:
+        with open(jobs_path, 'r', encoding='utf-8') as jobs_file:
+            spec = json.load(jobs_file)
+
+    defaults = job_argv(spec.get('defaults', {}))
+    jobs = []
+
+    for index, job in enumerate(spec.get('jobs', [])):
+        name = job.get('name', f'job_{index + 1}')
+        dest = job.get('dest')
+        mode = job.get('mode', 'recursive')
+
+        # If the job is missing a path #
+        if not job.get('src') or not dest:
+            raise ValueError(f'job {name} needs a src and a dest')
+        # If the mode is unknown #
+        if mode not in ('recursive', 'single'):
+            raise ValueError(f'job {name} mode must be recursive or single')
+        # If the source directory does not exist #
+        if not Path(job['src']).is_dir():
+            raise ValueError(f'job {name} source {job["src"]} does not exist')
+
+        try:
+            # Jobs print their summary only unless an output mode is set #
+            args = parse_args(['-o', 'quiet', *argv, *defaults,
+                               *job_argv(job.get('options', {}))])
+
+        # If argparse rejected the options of the job #
+        except SystemExit as parse_err:
+            raise ValueError(f'job {name} has invalid options') from parse_err
+
+        dest_paths = [Path(path) for path in (dest if isinstance(dest, list) else [dest])]
+        # If several destinations are combined with options bound to a single one #
+        if len(dest_paths) > 1 and fanout_conflicts(args):
+            raise ValueError(f'job {name} has several destinations, which cannot be combined '
+                             f'with {", ".join(fanout_conflicts(args))}')
+
+        jobs.append(BackupJob(name, args, Path(job['src']), dest_paths, mode == 'recursive'))
+
+    return jobs
+
+
+def physical_device(dir_path: Path):
+    """
+    Gets the physical device holding the path. On Linux partitions are mapped to their disk \
+    through sysfs, elsewhere the device id of the file system is used.
+
+    :param dir_path:  The path on the device, missing paths are resolved through their parents.
+    :return:  The name of the disk, or the device id.
+    """
+    # Missing destinations are created under their nearest existing parent #
+    while not dir_path.exists() and dir_path.parent != dir_path:
+        dir_path = dir_path.parent
+
+    device = os.stat(dir_path).st_dev
+    # If the OS does not expose block devices through sysfs #
+    if not sys.platform.startswith('linux'):
+        return device
+
+    try:
+        disk = Path(f'/sys/dev/block/{os.major(device)}:{os.minor(device)}').resolve(strict=True)
+
+    # If the file system is not backed by a block device #
+    except OSError:
+        return device
+
+    # If the device is a partition, its parent is the disk #
+    return (disk.parent if (disk / 'partition').exists() else disk).name
+
+
+def schedule_jobs(jobs: list) -> list:
+    """
+    Groups the jobs into lanes by the physical devices they read and write. Jobs sharing a device, \
+    directly or through other jobs, land in the same lane and run one after the other in job file \
+    order, while separate lanes run concurrently.
+
+    :param jobs:  The list of jobs.
+    :return:  The list of lanes, each a list of jobs.
+    """
+    # List of (device set, [(index, job)]) lanes #
+    lanes = []
+
+    for index, job in enumerate(jobs):
+        devices = {physical_device(path) for path in (job.src_path, *job.dest_paths)}
+        lane_jobs = [(index, job)]
+
+        # Merge every lane sharing a device with the job into one #
+        for lane in [lane for lane in lanes if lane[0] & devices]:
+            lanes.remove(lane)
+            devices |= lane[0]
+            lane_jobs = lane[1] + lane_jobs
+
+        lanes.append((devices, lane_jobs))
+
+    lanes = sorted(sorted(lane_jobs, key=lambda item: item[0]) for _, lane_jobs in lanes)
+    return [[job for _, job in lane_jobs] for lane_jobs in lanes]
+
+
+def run_lane(lane: list, executor: ThreadPoolExecutor) -> int:
+    """
+    Runs the jobs of a lane one after the other, a failed job does not stop the others.
+
+    :param lane:  The list of jobs sharing a device.
+    :param executor:  The worker pool shared across jobs.
+    :return:  The number of failed jobs.
+    """
+    failed = 0
+
+    for job in lane:
+        print(f'\nJob {job.name}: {job.src_path} -> {" | ".join(map(str, job.dest_paths))}')
+
+        try:
+            # Create the destinations of the job if missing #
+            for dest_path in job.dest_paths:
+                dest_path.mkdir(parents=True, exist_ok=True)
+
+            # If the job has several destinations, read the source once for all of them #
+            if len(job.dest_paths) > 1:
+                fanout_backup(job.args, job.src_path, job.dest_paths, job.recursive, executor)
+            else:
+                run_backup(job.args, job.src_path, job.dest_paths[0], job.recursive, executor)
+
+        # If the job failed, errors of other types are bugs which stop the run #
+        except (OSError, RuntimeError, sqlite3.Error, tarfile.TarError, *COMPRESS_ERRORS) \
+        as job_err:
+            print_err(f'Job {job.name} failed: {job_err}', None)
+            logging.exception('Job %s failed: %s\n', job.name, job_err)
+            failed += 1
+
+    return failed
+
+
+def run_jobs(args: argparse.Namespace) -> int:
+    """
+    Runs every job of the job file in a single process without prompting. The jobs share one \
+    worker pool, and are scheduled into lanes per physical device so jobs on separate devices \
+    run concurrently while jobs on the same device are serialized.
+
+    :param args:  The parsed command line options.
+    :return:  The number of failed jobs.
+    """
+    try:
+        jobs = load_jobs(args.jobs, sys.argv[1:])
+
+    # If the job file could not be read or is invalid #
+    except (OSError, ValueError) as load_err:
+        print_err(f'Unable to load job file {args.jobs}: {load_err}', None)
+        sys.exit(2)
+
+    lanes = schedule_jobs(jobs)
+    print(f'\n\n{19 * "*"} Running {len(jobs)} jobs in {len(lanes)} device lanes '
+          f'{(34 - len(str(len(jobs))) - len(str(len(lanes)))) * "*"}')
+
+    # Jobs on separate devices run concurrently, feeding the same copy workers #
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='copy_worker') \
+    as executor, ThreadPoolExecutor(max_workers=max(1, len(lanes)),
+                                    thread_name_prefix='job_lane') as lane_pool:
+        return sum(lane_pool.map(run_lane, lanes, repeat(executor)))
 
 
 def main():
@@ -243,53 +5202,45 @@ def main():
 
     :return:  Nothing
     """
-    # Prompt the user for the source and destination path #
-    src_path, dest_path = path_input()
-    # Prompt user for singular or recursive data copying #
-    prompt = mode_input()
+    # Parse the command line options #
+    args = parse_args()
 
-    print(f'\n\n{19 * "*"} Starting copy {51 * "*"}')
+    # If an I/O scheduling class was selected, set it before any worker thread is created #
+    if args.io_class and not set_io_priority(args.io_class):
+        print_err('Unable to set the I/O priority on this platform .. continuing without', None)
 
-    # If recursive copying is selected #
-    if prompt == 'r':
-        # Grab only the rightmost directory of path save result in other regex
-        # as anchor point for confirming recursive directories while crawling #
-        if os.name == 'nt':
-            re_edge_path = re.search(r'[^\\]{1,255}$', str(src_path))
-            # Insert path edge regex match into regex to match any path past the edge anchor point #
-            re_ext_path = re.compile(rf'(?<={re.escape(str(re_edge_path.group(0)))}\\).+$')
-        else:
-            re_edge_path = re.search(r'[^/]{1,255}$', str(src_path))
-            # Insert path edge regex match into regex to match any path past the edge anchor point #
-            re_ext_path = re.compile(rf'(?<={re.escape(str(re_edge_path.group(0)))}/).+$')
-
-        # Recursively walk through the file system of the source path #
-        for dir_path, dir_names, file_names in os.walk(src_path):
-            # Attempt to match recursive path extending beyond base dir #
-            match = re.search(re_ext_path, dir_path)
-            # If match is successful #
-            if match:
-                # Set the match as path #
-                recursive_path = Path(str(match.group(0)))
-            else:
-                recursive_path = None
+    # If a job file was passed in, run its jobs without prompting #
+    if args.jobs:
+        failed = run_jobs(args)
+        print(f'\n\n{18 * "*"} All finished!!! {50 * "*"}\n\n')
 
-            print(f'\nIn path: {dir_path}\n{(9 + len(dir_path)) * "*"}')
+        # If any of the jobs failed #
+        if failed:
+            print_err(f'{failed} jobs failed, check log', None)
+            sys.exit(1)
+        return
 
-            # Iterate through the directories #
-            for dir_name in dir_names:
-                # Call handler function to check if folder needs to be copied #
-                dir_handler(recursive_path, dest_path, dir_name)
+    # Prompt the user for the source and destination paths #
+    src_path, dest_paths = path_input()
 
-            # Iterate through files #
-            for file in file_names:
-                # Call handler function to check if file needs to be copied #
-                file_handler(recursive_path, Path(dir_path), dest_path, file)
+    # If several destinations were entered, options bound to a single destination do not apply #
+    if len(dest_paths) > 1:
+        conflicts = fanout_conflicts(args)
+        # If any of those options were passed in #
+        if conflicts:
+            print_err(f'Several destinations cannot be combined with {", ".join(conflicts)}', None)
+            sys.exit(2)
 
-    # If single directory copying is selected #
+    # Prompt user for singular or recursive data copying #
+    prompt = mode_input()
+
+    print(f'\n\n{19 * "*"} Starting copy {51 * "*"}')
+
+    # If several destinations were entered, read the source once for all of them #
+    if len(dest_paths) > 1:
+        fanout_backup(args, src_path, dest_paths, prompt == 'r')
     else:
-        # Copy source to destination directory in single mode #
-        single_mode(src_path, dest_path)
+        run_backup(args, src_path, dest_paths[0], prompt == 'r')
 
     print(f'\n\n{18 * "*"} All finished!!! {50 * "*"}\n\n')
 
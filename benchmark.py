@@ -0,0 +1,363 @@
+""" Built-in modules """
+import argparse
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+# If the OS is Windows, peak memory is not available from the resource module #
+try:
+    import resource
+except ImportError:
+    resource = None
+# Custom modules #
+from backup_buddy import ChunkStore, CopyBackend, CopyEngine, ProgressReporter, positive_int, \
+                         recursive_copy, single_mode, store_backup
+
+
+# Global variables #
+SEED = 1337
+MODIFIED_RATIO = 0.05
+
+
+def write_file(path: Path, size: int, rng: random.Random):
+    """
+    Writes a file of reproducible pseudo random content.
+
+    :param path:  The path of the file to write.
+    :param size:  The size of the file in bytes.
+    :param rng:  The seeded random generator the content is drawn from.
+    :return:  Nothing
+    """
+    with open(path, 'wb') as file:
+        while size > 0:
+            chunk = min(size, 1024 * 1024)
+            file.write(rng.randbytes(chunk))
+            size -= chunk
+
+
+def build_tiny_files(root: Path, scale: float, rng: random.Random):
+    """
+    Builds a tree of many tiny files spread across a hundred directories.
+
+    :param root:  The root directory of the tree.
+    :param scale:  The multiplier applied to the file count.
+    :param rng:  The seeded random generator.
+    :return:  Nothing
+    """
+    for index in range(int(20000 * scale)):
+        dir_path = root / f'dir_{index % 100:03d}'
+        dir_path.mkdir(exist_ok=True)
+        write_file(dir_path / f'file_{index:06d}.dat', rng.randint(1, 4096), rng)
+
+
+def build_huge_files(root: Path, scale: float, rng: random.Random):
+    """
+    Builds a tree of a few huge files.
+
+    :param root:  The root directory of the tree.
+    :param scale:  The multiplier applied to the file size.
+    :param rng:  The seeded random generator.
+    :return:  Nothing
+    """
+    for index in range(4):
+        write_file(root / f'huge_{index}.img', int(64 * 1024 * 1024 * scale), rng)
+
+
+def build_deep_nesting(root: Path, scale: float, rng: random.Random):
+    """
+    Builds a single chain of deeply nested directories holding a few files each.
+
+    :param root:  The root directory of the tree.
+    :param scale:  The multiplier applied to the nesting depth.
+    :param rng:  The seeded random generator.
+    :return:  Nothing
+    """
+    dir_path = root
+
+    for depth in range(int(100 * scale)):
+        dir_path = dir_path / f'level_{depth}'
+        dir_path.mkdir()
+
+        for index in range(5):
+            write_file(dir_path / f'file_{index}.dat', rng.randint(1, 16384), rng)
+
+
+def build_wide_dir(root: Path, scale: float, rng: random.Random):
+    """
+    Builds a single flat directory holding many files.
+
+    :param root:  The root directory of the tree.
+    :param scale:  The multiplier applied to the file count.
+    :param rng:  The seeded random generator.
+    :return:  Nothing
+    """
+    for index in range(int(20000 * scale)):
+        write_file(root / f'file_{index:06d}.dat', rng.randint(1, 8192), rng)
+
+
+# Scenario name -> (tree builder, copy modes ran against it) #
+SCENARIOS = {
+    'tiny_files': (build_tiny_files, ('recursive',)),
+    'huge_files': (build_huge_files, ('recursive',)),
+    'deep_nesting': (build_deep_nesting, ('recursive',)),
+    'wide_dir': (build_wide_dir, ('recursive', 'single')),
+    'incremental': (build_tiny_files, ('recursive',)),
+    'store': (build_huge_files, ('store',)),
+}
+
+
+def modify_tree(root: Path, rng: random.Random):
+    """
+    Rewrites a reproducible subset of the files in the tree to simulate an incremental run.
+
+    :param root:  The root directory of the tree.
+    :param rng:  The seeded random generator.
+    :return:  Nothing
+    """
+    files = sorted(path for path in root.rglob('*') if path.is_file())
+
+    for path in rng.sample(files, max(1, int(len(files) * MODIFIED_RATIO))):
+        write_file(path, path.stat().st_size + rng.randint(0, 1024), rng)
+
+
+def proc_io() -> dict:
+    """
+    Reads the read/write call and I/O counters of the current process from /proc on Linux.
+
+    :return:  The counter name to value dict, empty if unavailable.
+    """
+    try:
+        with open('/proc/self/io', encoding='utf-8') as io_file:
+            return {key: int(value) for key, value in
+                    (line.split(': ') for line in io_file.read().splitlines())}
+
+    # If the OS does not provide the counters #
+    except OSError:
+        return {}
+
+
+def copy_tree(src_path: Path, dest_path: Path, mode: str, workers: int) -> ProgressReporter:
+    """
+    Copies the source into the destination without any interactive prompts.
+
+    :param src_path:  The path to the source directory.
+    :param dest_path:  The path to the destination directory.
+    :param mode:  The copy mode, recursive, single or store.
+    :param workers:  The number of copy worker threads.
+    :return:  The reporter holding the copy tallies.
+    """
+    reporter = ProgressReporter('quiet')
+
+    with CopyEngine(workers, backend=CopyBackend(), reporter=reporter) as engine:
+        # If the deduplicating chunk store is selected #
+        if mode == 'store':
+            with ChunkStore(dest_path, workers) as store:
+                store_backup(src_path, store, engine, True)
+        # If recursive copying is selected #
+        elif mode == 'recursive':
+            recursive_copy(src_path, dest_path, engine)
+        # If single directory copying is selected #
+        else:
+            single_mode(src_path, dest_path, engine)
+
+    return reporter
+
+
+def prepare_case(mode: str, workers: int, src_path: Path, dest_path: Path):
+    """
+    Runs the initial full copy of an incremental case and modifies the source afterwards. Ran in \
+    its own child process so the full copy does not raise the peak memory of the measured run.
+
+    :param mode:  The copy mode, recursive, single or store.
+    :param workers:  The number of copy worker threads.
+    :param src_path:  The path to the generated source tree.
+    :param dest_path:  The path to the empty destination directory.
+    :return:  Nothing
+    """
+    copy_tree(src_path, dest_path, mode, workers)
+    modify_tree(src_path, random.Random(SEED + 1))
+
+
+def run_case(scenario: str, mode: str, workers: int, src_path: Path, dest_path: Path) -> dict:
+    """
+    Runs a single benchmark case, measuring only the timed copy. Ran in a fresh child process so \
+    the peak memory and counters of the cases do not mix.
+
+    :param scenario:  The name of the scenario.
+    :param mode:  The copy mode, recursive, single or store.
+    :param workers:  The number of copy worker threads.
+    :param src_path:  The path to the generated source tree.
+    :param dest_path:  The path to the empty destination directory.
+    :return:  The measurements of the case.
+    """
+    io_before = proc_io()
+    start = time.perf_counter()
+    reporter = copy_tree(src_path, dest_path, mode, workers)
+    wall = time.perf_counter() - start
+    io_after = proc_io()
+
+    result = {
+        'scenario': scenario,
+        'mode': mode,
+        'workers': workers,
+        'files_checked': reporter.checked,
+        'files_copied': reporter.copied,
+        'bytes_copied': reporter.copied_bytes,
+        'wall_s': round(wall, 6),
+        'files_per_s': round(reporter.checked / wall, 2),
+        'mb_per_s': round(reporter.copied_bytes / 1024 ** 2 / wall, 2),
+        # syscr/syscw only count the read and write family of calls, not every syscall #
+        'rw_calls': {key: io_after[key] - io_before[key] for key in ('syscr', 'syscw')
+                     if key in io_before},
+        'io_bytes': {key: io_after[key] - io_before[key] for key in ('read_bytes', 'write_bytes')
+                     if key in io_before},
+        'peak_rss_kb': None,
+    }
+
+    # If peak memory is available #
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere #
+        result['peak_rss_kb'] = usage.ru_maxrss // 1024 if sys.platform == 'darwin' \
+                                else usage.ru_maxrss
+
+    return result
+
+
+def git_commit() -> str:
+    """
+    Gets the commit of the benchmarked tree so results can be compared across versions.
+
+    :return:  The commit hash, None if unavailable.
+    """
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True,
+                                cwd=Path(__file__).parent, text=True, timeout=10)
+
+    # If git is not installed or this is not a repository #
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    return output.stdout.strip()
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """
+    Parses the benchmark command line options.
+
+    :param argv:  The arguments to parse, None to parse the program command line.
+    :return:  The parsed command line options.
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks Backup Buddy against reproducible'
+                                                 ' synthetic source trees.')
+    parser.add_argument('-s', '--scenario', choices=SCENARIOS, action='append',
+                        dest='scenarios', help='Scenario to run, repeat for several (default: '
+                                               'all).')
+    parser.add_argument('-w', '--workers', type=positive_int, action='append',
+                        help='Copy worker count to run, repeat for several (default: 1 and 8).')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplier applied to the size of every tree (default: 1.0).')
+    parser.add_argument('--work-dir', type=Path, default=None, dest='work_dir',
+                        help='Directory the trees are generated in (default: a temp dir).')
+    parser.add_argument('--output', type=Path, default=None,
+                        help='Path of the JSON results file (default: stdout).')
+    parser.add_argument('--keep', default=False, action='store_true',
+                        help='Keep the generated trees after the run.')
+    parser.add_argument('--run-case', nargs=5, default=None, dest='run_case',
+                        metavar=('SCENARIO', 'MODE', 'WORKERS', 'SRC', 'DEST'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--prepare-case', nargs=4, default=None, dest='prepare_case',
+                        metavar=('MODE', 'WORKERS', 'SRC', 'DEST'), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Generates the scenario trees, runs every case in a child process and outputs the results.
+
+    :return:  Nothing
+    """
+    args = parse_args()
+
+    # If running as a child process for a single case #
+    if args.run_case:
+        scenario, mode, workers, src_path, dest_path = args.run_case
+        print(json.dumps(run_case(scenario, mode, int(workers), Path(src_path),
+                                  Path(dest_path))))
+        return
+
+    # If running as a child process for the initial copy of an incremental case #
+    if args.prepare_case:
+        mode, workers, src_path, dest_path = args.prepare_case
+        prepare_case(mode, int(workers), Path(src_path), Path(dest_path))
+        return
+
+    work_dir = Path(tempfile.mkdtemp(prefix='bb_bench_', dir=args.work_dir))
+    results = []
+
+    try:
+        for scenario in args.scenarios or SCENARIOS:
+            builder, modes = SCENARIOS[scenario]
+            src_path = work_dir / scenario / 'src'
+            dest_path = work_dir / scenario / 'dest'
+
+            for mode in modes:
+                for workers in args.workers or (1, 8):
+                    # Build the tree once, incremental cases modify it so rebuild it per case #
+                    if not src_path.exists() or scenario == 'incremental':
+                        print(f'Generating {scenario} tree ..', file=sys.stderr)
+                        shutil.rmtree(src_path, ignore_errors=True)
+                        src_path.mkdir(parents=True)
+                        builder(src_path, args.scale, random.Random(SEED))
+
+                    # Start every case from an empty destination #
+                    shutil.rmtree(dest_path, ignore_errors=True)
+                    dest_path.mkdir()
+
+                    # If the scenario measures an incremental run, copy and modify the tree first #
+                    if scenario == 'incremental':
+                        command = [sys.executable, __file__, '--prepare-case', mode, str(workers),
+                                   str(src_path), str(dest_path)]
+                        subprocess.run(command, capture_output=True, check=True, text=True)
+
+                    print(f'Running {scenario} {mode} with {workers} workers ..', file=sys.stderr)
+                    command = [sys.executable, __file__, '--run-case', scenario, mode,
+                               str(workers), str(src_path), str(dest_path)]
+                    output = subprocess.run(command, capture_output=True, check=True, text=True)
+                    results.append(json.loads(output.stdout))
+    finally:
+        # If the generated trees are not kept #
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = json.dumps({'commit': git_commit(), 'python': platform.python_version(),
+                         'platform': platform.platform(), 'scale': args.scale,
+                         'results': results}, indent=2)
+
+    # If a results file was passed in #
+    if args.output:
+        args.output.write_text(f'{report}\n', encoding='utf-8')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    RET = 0
+    try:
+        main()
+
+    # If Ctrl + c is detected #
+    except KeyboardInterrupt:
+        print('\n[!] Ctrl + C detected .. exiting')
+
+    # If a benchmark case failed #
+    except subprocess.CalledProcessError as proc_err:
+        print(f'\n* [ERROR]: Benchmark case failed:\n{proc_err.stderr} *\n', file=sys.stderr)
+        RET = 1
+
+    sys.exit(RET)
@@ -1,45 +1,72 @@
-# pylint: disable=W0106
 """ Built-in modules """
 import argparse
 import os
+import shutil
 import sys
+import time
 import venv
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 from subprocess import Popen, PIPE, TimeoutExpired
-from threading import Thread
+from threading import Lock, Thread
 from urllib.parse import urlparse
 from urllib.request import urlretrieve
 
 
 # Global variables #
 PACKAGE_FILENAME = 'packages.txt'
+BOOTSTRAP_PACKAGES = ('pip', 'setuptools', 'wheel')
+# Serializes the bootstrap script downloads of concurrently created environments #
+CACHE_LOCK = Lock()
 
 
-def system_cmd(cmd: list, exec_time):
+@contextmanager
+def step_timer(env_dir: str, step: str):
     """
-    Executes system shell command and returns the output. If improper data type is in command syntax
-    list or error occurs during command execution, the error is displayed via stderr and logged,
-    and False is returned to indicated failed operation.
+    Times a provisioning step, printing its duration once it finishes or fails.
+
+    :param env_dir:  The environment directory the step provisions.
+    :param step:  The name of the step.
+    :return:  Nothing
+    """
+    start = time.perf_counter()
+    try:
+        yield
+
+    # If the step failed, mark it before the error propagates #
+    except BaseException:
+        print(f'[{env_dir}] {step} FAILED after {time.perf_counter() - start:.2f}s', flush=True)
+        raise
+
+    print(f'[{env_dir}] {step} took {time.perf_counter() - start:.2f}s', flush=True)
+
+
+def system_cmd(cmd: list, exec_time, env: dict = None):
+    """
+    Executes system shell command with its output passed through. If the command times out or \
+    exits with an error, a RuntimeError is raised so the failing step is not mistaken for done.
 
     :param cmd:  The command to be executed.
     :param exec_time:  The execution timeout to prevent process hangs.
+    :param env:  The environment variables of the process, None inherits the current ones.
     :return:  Nothing
     """
-    try:
-        # Set up child process in context manager, piping output & errors to return variables #
-        with Popen(cmd, stdout=sys.stdout, stderr=sys.stderr) as command:
+    # Set up child process in context manager, passing output & errors through #
+    with Popen(cmd, stdout=sys.stdout, stderr=sys.stderr, env=env) as command:
+        try:
             # Execute process for passed in timeout (None=blocking) #
             command.communicate(timeout=exec_time)
 
-    # If the process times out #
-    except TimeoutExpired:
-        # Print error and log #
-        print_err(f'Process for {cmd} timed out before finishing execution')
+        # If the process times out #
+        except TimeoutExpired as timeout_err:
+            command.kill()
+            raise RuntimeError(f'Process for {cmd} timed out before finishing execution') \
+                from timeout_err
 
-    # If the input command has data other than string #
-    except TypeError:
-        # Print error and log #
-        print_err(f'Input in {cmd} contains data type other than string')
+    # If the command failed #
+    if command.returncode:
+        raise RuntimeError(f'Process for {cmd} exited with code {command.returncode}')
 
 
 class ExtendedEnvBuilder(venv.EnvBuilder):
@@ -58,31 +85,73 @@ class ExtendedEnvBuilder(venv.EnvBuilder):
                       'stdout' and 'stderr', which are obtained by reading lines from the output
                       streams of a subprocess which is used to install the app. If a callable is
                       not specified, default progress information is output to sys.stderr.
+    :param cache_dir:  The directory caching the bootstrap scripts and the wheelhouse, once the
+                       wheelhouse is seeded packages are installed from it without network access.
     """
     def __init__(self, *args, **kwargs):
         self.nodist = kwargs.pop('nodist', False)
         self.nopip = kwargs.pop('nopip', False)
         self.progress = kwargs.pop('progress', None)
         self.verbose = kwargs.pop('verbose', False)
+        self.cache_dir = kwargs.pop('cache_dir', Path.cwd() / 'setup_cache')
         super().__init__(*args, **kwargs)
 
+    @property
+    def wheelhouse(self) -> Path:
+        """
+        The directory holding the seeded wheels.
+        """
+        return self.cache_dir / 'wheels'
+
+    def index_args(self) -> list:
+        """
+        Gets the pip arguments selecting where packages are installed from.
+
+        :return:  The offline wheelhouse arguments if it is seeded, otherwise an empty list.
+        """
+        # If the wheelhouse is seeded, install from it without touching the network #
+        if self.wheelhouse.is_dir() and any(self.wheelhouse.iterdir()):
+            return ['--no-index', '--find-links', str(self.wheelhouse)]
+
+        return []
+
+    def create(self, env_dir):
+        """
+        Create a virtual environment in a directory, timing the whole provisioning.
+
+        :param env_dir:  The target directory to create an environment in.
+        :return:  Nothing
+        """
+        with step_timer(os.path.abspath(env_dir), 'total'):
+            super().create(env_dir)
+
+    def setup_python(self, context):
+        """
+        Set up a Python executable in the environment, timing the step.
+
+        :param context:  The information for the virtual environment creation request.
+        :return:  Nothing
+        """
+        with step_timer(context.env_dir, 'python'):
+            super().setup_python(context)
+
     def install_setuptools(self, context):
         """
-        Install setuptools in the virtual environment.
+        Install setuptools in the virtual environment with pip, from the wheelhouse once seeded. \
+        Without pip in the environment, the pip of this interpreter installs into it (pip 22.3+).
 
         :param context: The information for the virtual environment creation request.
         """
-        url = 'https://github.com/abadger/setuptools/blob/master/ez_setup.py'
-        self.install_script(context, 'setuptools', url)
+        # If pip is not installed in the environment, target it from the running interpreter #
+        if self.nopip:
+            command = [sys.executable, '-m', 'pip', '--python', context.env_exe, 'install']
+        else:
+            command = [context.env_exe, '-m', 'pip', 'install']
 
-        # Clear up the setuptools archive which gets downloaded #
-        pred = lambda o: o.startswith('setuptools-') and o.endswith('.tar.gz')
-        files = filter(pred, os.listdir(context.bin_path))
+        env = dict(os.environ, VIRTUAL_ENV=context.env_dir)
 
-        # Iterate through files in bin path and delete #
-        for file in files:
-            file = os.path.join(context.bin_path, file)
-            os.unlink(file)
+        with step_timer(context.env_dir, 'setuptools'):
+            system_cmd([*command, *self.index_args(), 'setuptools'], 300, env)
 
     def install_pip(self, context):
         """
@@ -91,7 +160,8 @@ class ExtendedEnvBuilder(venv.EnvBuilder):
         :param context: The information for the virtual environment creation request.
         """
         url = 'https://bootstrap.pypa.io/get-pip.py'
-        self.install_script(context, 'pip', url)
+        with step_timer(context.env_dir, 'pip'):
+            self.install_script(context, 'pip', url)
 
     def post_setup(self, context):
         """
@@ -101,17 +171,17 @@ class ExtendedEnvBuilder(venv.EnvBuilder):
         :param context:  The information for the virtual environment creation request.
         :return:  Nothing
         """
-        os.environ['VIRTUAL_ENV'] = context.env_dir
+        # If pip is installed, it goes first since setuptools is installed with it #
+        if not self.nopip and not self.nodist:
+            self.install_pip(context)
 
-        # If no setup tools #
+        # If setuptools is installed #
         if not self.nodist:
-            # Install setup tools #
             self.install_setuptools(context)
 
-        # If no pip and setuptools #
-        if not self.nopip and not self.nodist:
-            # Install them #
-            self.install_pip(context)
+        # If there is no pip in the environment to install packages with #
+        if self.nopip or self.nodist:
+            return
 
         # Get the current working dir #
         path = Path.cwd()
@@ -128,15 +198,20 @@ class ExtendedEnvBuilder(venv.EnvBuilder):
             # Format path for pip installation in venv #
             pip_path = venv_path / 'bin' / 'pip'
 
+        # Set per process since several environments can be created concurrently #
+        env = dict(os.environ, VIRTUAL_ENV=context.env_dir)
+
         # Execute the pip upgrade command as child process #
-        command = [str(pip_path), 'install', '--upgrade', 'pip']
-        system_cmd(command, 60)
+        command = [str(pip_path), 'install', '--upgrade', *self.index_args(), 'pip']
+        with step_timer(context.env_dir, 'pip upgrade'):
+            system_cmd(command, 60, env)
 
         # If the package list file exists #
         if package_path.exists():
             # Execute pip -r into venv based on package list #
-            command = [str(pip_path), 'install', '-r', str(package_path)]
-            system_cmd(command, 300)
+            command = [str(pip_path), 'install', *self.index_args(), '-r', str(package_path)]
+            with step_timer(context.env_dir, 'packages'):
+                system_cmd(command, 300, env)
 
     def reader(self, stream, context):
         """
@@ -173,28 +248,68 @@ class ExtendedEnvBuilder(venv.EnvBuilder):
 
         stream.close()
 
+    def cached_script(self, url) -> Path:
+        """
+        Gets the bootstrap script of the url from the cache, downloading it on first use.
+
+        :param url:  The url where the script can be retrieved from the internet.
+        :return:  The path of the cached script.
+        """
+        _, _, path, _, _, _ = urlparse(url)
+        script_path = self.cache_dir / 'bootstrap' / os.path.split(path)[-1]
+
+        with CACHE_LOCK:
+            # If the script is already cached #
+            if script_path.exists():
+                return script_path
+
+            # If the URL does not start with http #
+            if not url.lower().startswith('http'):
+                print_err('Improper URL format attempted to be passed into urlretrieve')
+                sys.exit(2)
+
+            script_path.parent.mkdir(parents=True, exist_ok=True)
+            # Download into a temp name so an interrupted download is not cached #
+            urlretrieve(url, f'{script_path}.part')
+            os.replace(f'{script_path}.part', script_path)
+
+        return script_path
+
+    def seed(self):
+        """
+        Seeds the cache with the bootstrap scripts and the wheels of the bootstrap and listed \
+        packages, so later runs install without network access.
+
+        :return:  Nothing
+        """
+        with step_timer(str(self.cache_dir), 'seed'):
+            # If pip is bootstrapped, download its installer script #
+            if not self.nopip and not self.nodist:
+                self.cached_script('https://bootstrap.pypa.io/get-pip.py')
+
+            command = [sys.executable, '-m', 'pip', 'download', '--dest', str(self.wheelhouse),
+                       *BOOTSTRAP_PACKAGES]
+            package_path = Path.cwd() / PACKAGE_FILENAME
+
+            # If the package list file exists #
+            if package_path.exists():
+                command += ['-r', str(package_path)]
+
+            self.wheelhouse.mkdir(parents=True, exist_ok=True)
+            system_cmd(command, 600)
+
     def install_script(self, context, name, url):
         """
-        Retrieve content from passed in url and install into the virtual env.
+        Install the bootstrap script of the passed in url into the virtual env, the script is \
+        retrieved once and then served from the cache.
 
         :param context:  The information for the virtual environment creation request.
         :param name:  Utility name to be installed into environment.
         :param url:  The url where the utility can be retrieved from the internet.
         :return:  Nothing
         """
-        _, _, path, _, _, _ = urlparse(url)
-        file_name = os.path.split(path)[-1]
+        script_path = self.cached_script(url)
         binpath = context.bin_path
-        distpath = os.path.join(binpath, file_name)
-
-        # If the URL starts with http #
-        if url.lower().startswith('http'):
-            # Download script into the virtual environment's binaries folder #
-            urlretrieve(url, distpath)
-        # Unusual URL detected #
-        else:
-            print_err('Improper URL format attempted to be passed into urlretrieve')
-            sys.exit(2)
 
         progress = self.progress
 
@@ -211,10 +326,12 @@ class ExtendedEnvBuilder(venv.EnvBuilder):
             sys.stderr.write(f'Installing {name} .. {term}')
             sys.stderr.flush()
 
-        args = [context.env_exe, file_name]
+        # The bootstrap script takes pip install arguments, so it reads the seeded wheelhouse #
+        args = [context.env_exe, str(script_path), *self.index_args()]
+        env = dict(os.environ, VIRTUAL_ENV=context.env_dir)
 
         # Install in the virtual environment #
-        with Popen(args, stdout=PIPE, stderr=PIPE, cwd=binpath) as proc:
+        with Popen(args, stdout=PIPE, stderr=PIPE, cwd=binpath, env=env) as proc:
             thread_1 = Thread(target=self.reader, args=(proc.stdout, 'stdout'))
             thread_1.start()
             thread_2 = Thread(target=self.reader, args=(proc.stderr, 'stderr'))
@@ -224,13 +341,16 @@ class ExtendedEnvBuilder(venv.EnvBuilder):
             thread_1.join()
             thread_2.join()
 
+        result = 'failed.' if proc.returncode else 'done.'
+
         if progress is not None:
-            progress('done.', 'main')
+            progress(result, 'main')
         else:
-            sys.stderr.write('done.\n')
+            sys.stderr.write(f'{result}\n')
 
-        # Clean up - no longer needed
-        os.unlink(distpath)
+        # If the bootstrap script failed #
+        if proc.returncode:
+            raise RuntimeError(f'Installing {name} failed with exit code {proc.returncode}')
 
 
 def print_err(msg: str):
@@ -283,17 +403,51 @@ def main(args=None):
     parser.add_argument('--verbose', default=False, action='store_true', dest='verbose',
                         help='Display the output from the scripts which install setuptools and '
                              'pip.')
+    parser.add_argument('--cache-dir', type=Path, default=Path.cwd() / 'setup_cache',
+                        dest='cache_dir', help='Directory caching the bootstrap scripts and the '
+                                               'wheelhouse (default: ./setup_cache).')
+    parser.add_argument('--seed', default=False, action='store_true', dest='seed',
+                        help='Download the bootstrap scripts and the wheels of the packages into '
+                             'the cache first, once seeded every environment is installed from '
+                             'the cache with --no-index.')
+    parser.add_argument('--parallel', type=int, default=None, dest='parallel',
+                        help='Number of environments created concurrently (default: all).')
     options = parser.parse_args(args)
 
     if options.upgrade and options.clear:
         raise ValueError('you cannot supply --upgrade and --clear together.')
 
+    if options.parallel is not None and options.parallel < 1:
+        raise ValueError('--parallel must be at least 1.')
+
     builder = ExtendedEnvBuilder(system_site_packages=options.system_site, clear=options.clear,
                                  symlinks=options.symlinks, upgrade=options.upgrade,
                                  nodist=options.nodist, nopip=options.nopip,
-                                 verbose=options.verbose)
-
-    [builder.create(d) for d in options.dirs]
+                                 verbose=options.verbose, cache_dir=options.cache_dir)
+
+    # If the cache is to be seeded #
+    if options.seed:
+        # Refresh the wheelhouse so packages removed from the list are not kept around #
+        shutil.rmtree(builder.wheelhouse, ignore_errors=True)
+        builder.seed()
+
+    failed = []
+
+    # Create the environments concurrently, the builder keeps no per environment state #
+    with ThreadPoolExecutor(max_workers=options.parallel or len(options.dirs),
+                            thread_name_prefix='env_builder') as executor:
+        futures = {executor.submit(builder.create, env_dir): env_dir for env_dir in options.dirs}
+
+        for future, env_dir in futures.items():
+            err = future.exception()
+            # If creating the environment failed #
+            if err is not None:
+                print_err(f'Creating environment {env_dir} failed: {err}')
+                failed.append(env_dir)
+
+    # If any of the environments failed #
+    if failed:
+        raise ValueError(f'{len(failed)} of {len(options.dirs)} environments failed')
 
 
 if __name__ == '__main__':
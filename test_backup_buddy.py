@@ -0,0 +1,1766 @@
+""" Built-in modules """
+import contextlib
+import errno
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+# Custom modules #
+import backup_buddy
+import benchmark
+import setup
+from backup_buddy import ADAPT_INTERVAL, ARCHIVE_FORMATS, BUFFER_SIZE, CHUNK_MASK, CHUNK_MAX, \
+                         CHUNK_MIN, CHUNK_SCAN_BLOCK, DELTA_BLOCK_SIZE, GEAR, GENERATION_FORMAT, \
+                         JOURNAL_NAME, MANIFEST_NAME, METRIC_PHASES, QUARANTINE_NAME, BackupJob, \
+                         ChunkStore, CopyBackend, CopyEngine, CopyResult, DigestCache, \
+                         FanoutCopier, FileMeta, InotifyWatcher, Manifest, Mirror, PathFilter, \
+                         ProgressReporter, RestoreSelector, Throttle, TokenBucket, Verifier, \
+                         expired_backups, fanout_backup, fanout_conflicts, find_chunk_cut, \
+                         iter_chunks, list_generations, load_jobs, parse_args, plan_copy, \
+                         recursive_copy, restore_backup, run_backup, run_jobs, schedule_jobs, \
+                         single_mode, store_backup, verify_tree, walk_tree, watch_mode
+
+
+def write_file(path: Path, data: bytes, mtime_ns: int = None):
+    """
+    Writes the file, optionally setting its modification time.
+
+    :param path:  The path of the file to write.
+    :param data:  The content of the file.
+    :param mtime_ns:  The modification time in nanoseconds, None to keep the current one.
+    :return:  Nothing
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+    # If the modification time is set #
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def tree_files(root: Path) -> dict:
+    """
+    Reads every file below the directory.
+
+    :param root:  The path to the directory.
+    :return:  The file contents keyed by their path relative to the directory.
+    """
+    return {path.relative_to(root).as_posix(): path.read_bytes()
+            for path in root.rglob('*') if path.is_file()}
+
+
+def scalar_chunk_cut(data: bytes) -> int:
+    """
+    Reference of find_chunk_cut rolling the gear hash one byte at a time.
+
+    :param data:  The buffered data starting at the beginning of the chunk.
+    :return:  The length of the chunk.
+    """
+    # If the remaining data is not larger than the minimum chunk #
+    if len(data) <= CHUNK_MIN:
+        return len(data)
+
+    end = min(len(data), CHUNK_MAX)
+    rolling = 0
+
+    for index in range(end):
+        rolling = ((rolling << 1) ^ GEAR[data[index]]) & 0xFFFFFFFF
+        # If the position is past the minimum chunk and all the boundary bits are clear #
+        if index >= CHUNK_MIN and not rolling & CHUNK_MASK:
+            return index + 1
+
+    return end
+
+
+def scalar_chunks(data: bytes) -> list:
+    """
+    Splits the data into the chunk lengths of the scalar reference.
+
+    :param data:  The data to split.
+    :return:  The ordered list of chunk lengths.
+    """
+    lengths = []
+
+    while data:
+        cut = scalar_chunk_cut(data)
+        lengths.append(cut)
+        data = data[cut:]
+
+    return lengths
+
+
+class TreeTestCase(unittest.TestCase):
+    """
+    Provides a temporary source and destination directory per test.
+    """
+    def setUp(self):
+        temp_path = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, temp_path)
+        self.src_path = temp_path / 'src'
+        self.dest_path = temp_path / 'dest'
+        self.src_path.mkdir()
+        self.dest_path.mkdir()
+
+
+class MirrorTest(TreeTestCase):
+    """
+    Tests the deletion and rename propagation of mirror runs.
+    """
+    def mirror(self) -> Mirror:
+        """
+        Runs a recursive mirror copy of the source into the destination.
+
+        :return:  The mirror of the run holding its tallies.
+        """
+        mirror = Mirror(self.dest_path)
+
+        with CopyEngine(2, reporter=ProgressReporter('quiet')) as engine:
+            recursive_copy(self.src_path, self.dest_path, engine, mirror=mirror)
+
+        return mirror
+
+    def test_rename_moves_same_file(self):
+        """
+        A new file with the same size, mtime and content as an extra file is moved into place.
+        """
+        write_file(self.src_path / 'new.txt', b'AAAA', 1_600_000_000_000_000_000)
+        write_file(self.dest_path / 'old.txt', b'AAAA', 1_600_000_000_000_000_000)
+
+        mirror = self.mirror()
+
+        self.assertEqual(mirror.renamed, 1)
+        self.assertEqual((self.dest_path / 'new.txt').read_bytes(), b'AAAA')
+        self.assertFalse((self.dest_path / 'old.txt').exists())
+
+    def test_rename_same_size_and_mtime_different_content(self):
+        """
+        An unrelated file with the same size and modification time is not moved into place.
+        """
+        write_file(self.src_path / 'new.txt', b'BBBB', 1_600_000_000_000_000_000)
+        write_file(self.dest_path / 'old.txt', b'AAAA', 1_600_000_000_000_000_000)
+
+        mirror = self.mirror()
+
+        self.assertEqual(mirror.renamed, 0)
+        self.assertEqual((self.dest_path / 'new.txt').read_bytes(), b'BBBB')
+        self.assertFalse((self.dest_path / 'old.txt').exists())
+
+    def test_deletions_propagated(self):
+        """
+        Files and directories removed from the source are deleted from the destination, or \
+        moved into the quarantine, while excluded entries are left alone.
+        """
+        write_file(self.src_path / 'kept.txt', b'kept')
+        write_file(self.dest_path / 'kept.txt', b'kept')
+        write_file(self.dest_path / 'gone.txt', b'gone')
+        write_file(self.dest_path / 'old_dir' / 'nested' / 'file.txt', b'file')
+        write_file(self.dest_path / 'cache.tmp', b'excluded')
+
+        for mode in ('quarantine', 'delete'):
+            run_backup(parse_args(['--mirror', mode, '--exclude', '*.tmp', '-o', 'quiet']),
+                       self.src_path, self.dest_path, True)
+
+            with self.subTest(mode=mode):
+                self.assertEqual(set(tree_files(self.dest_path)) - {'kept.txt', 'cache.tmp'},
+                                 {f'{QUARANTINE_NAME}/{generation.name}/{rel_path}'
+                                  for generation in (self.dest_path / QUARANTINE_NAME).iterdir()
+                                  for rel_path in ('gone.txt', 'old_dir/nested/file.txt')})
+                self.assertFalse((self.dest_path / 'old_dir').exists())
+
+
+class FailingReader(io.BytesIO):
+    """
+    Source file stand-in whose reads fail after the first chunk.
+    """
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        # If the first chunk was already read #
+        if self.reads > 1:
+            raise OSError('injected read error')
+
+        return b'x' * size
+
+
+class FanoutTest(TreeTestCase):
+    """
+    Tests the single read copies into several destinations.
+    """
+    def test_read_error_removes_partial_copies(self):
+        """
+        A failed source read removes the temporary files of every destination.
+        """
+        write_file(self.src_path / 'file.bin', b'data')
+        dest_paths = [self.dest_path / 'one', self.dest_path / 'two']
+
+        for dest_path in dest_paths:
+            dest_path.mkdir()
+
+        src_entry = next(os.scandir(self.src_path))
+        targets = [(dest_path / 'file.bin', None) for dest_path in dest_paths]
+
+        def fake_open(path, mode='r', encoding=None, **kwargs):
+            # If the source file is opened, hand out the failing reader #
+            if mode == 'rb' and Path(path) == Path(src_entry.path):
+                return FailingReader()
+
+            return open(path, mode, encoding=encoding, **kwargs)
+
+        with FanoutCopier(dest_paths, 1) as copier, \
+        mock.patch('backup_buddy.open', fake_open, create=True):
+            with self.assertRaises(OSError):
+                copier.copy(src_entry, targets)
+
+        for dest_path in dest_paths:
+            self.assertEqual(list(dest_path.iterdir()), [])
+
+    def test_single_read_to_outdated_destinations(self):
+        """
+        Each source file is read once and only written to the destinations where it changed.
+        """
+        write_file(self.src_path / 'file.bin', os.urandom(3 * 1024 * 1024),
+                   1_600_000_000_000_000_000)
+        write_file(self.src_path / 'sub' / 'small.txt', b'small', 1_600_000_000_000_000_000)
+        dest_paths = [self.dest_path / 'one', self.dest_path / 'two']
+        dest_paths[0].mkdir()
+        # The second destination already holds an up to date copy of the small file #
+        write_file(dest_paths[1] / 'sub' / 'small.txt', b'small', 1_600_000_000_000_000_000)
+        src_open = mock.Mock(wraps=open)
+
+        with mock.patch('backup_buddy.open', src_open, create=True):
+            fanout_backup(parse_args(['-o', 'quiet']), self.src_path, dest_paths, True)
+
+        read_paths = [Path(call.args[0]) for call in src_open.call_args_list
+                      if call.args[1:2] == ('rb',)]
+        self.assertEqual(sorted(read_paths), [self.src_path / 'file.bin',
+                                              self.src_path / 'sub' / 'small.txt'])
+
+        for dest_path in dest_paths:
+            self.assertEqual(tree_files(dest_path), tree_files(self.src_path))
+
+    def test_backend_options_rejected(self):
+        """
+        Options the fan-out copies would ignore are rejected unless left at their defaults.
+        """
+        self.assertEqual(fanout_conflicts(parse_args(['--durability', 'none', '-w', '2'])), [])
+        self.assertEqual(fanout_conflicts(parse_args(['--durability', 'file', '--small-file-size',
+                                                      '0', '--range-workers', '2'])),
+                         ['--durability', '--small-file-size', '--range-workers'])
+
+        jobs_path = self.src_path.parent / 'jobs.json'
+        jobs_path.write_text(json.dumps({'jobs': [{
+            'src': str(self.src_path), 'options': {'durability': 'file'},
+            'dest': [str(self.dest_path / 'one'), str(self.dest_path / 'two')]}]}), 'utf-8')
+
+        with self.assertRaises(ValueError):
+            load_jobs(jobs_path, [])
+
+
+class TrackingBackend(CopyBackend):
+    """
+    Copy backend recording the peak number of whole file copies running at once.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def copy(self, src_file: Path, dest_file: Path):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+        try:
+            # Hold the copy long enough for the other workers to start theirs #
+            time.sleep(0.05)
+            super().copy(src_file, dest_file)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class SmallBatchTest(TreeTestCase):
+    """
+    Tests the batching of small file copies.
+    """
+    def test_large_files_copied_concurrently(self):
+        """
+        Files larger than the small file size keep a job each and are copied concurrently.
+        """
+        for index in range(8):
+            write_file(self.src_path / f'large_{index}.bin', os.urandom(256 * 1024))
+        for index in range(5):
+            write_file(self.src_path / f'small_{index}.txt', os.urandom(512))
+
+        backend = TrackingBackend(small_size=64 * 1024)
+
+        with CopyEngine(4, backend=backend, reporter=ProgressReporter('quiet')) as engine:
+            recursive_copy(self.src_path, self.dest_path, engine)
+
+        self.assertGreater(backend.peak, 1)
+
+        for src_file in self.src_path.iterdir():
+            self.assertEqual((self.dest_path / src_file.name).read_bytes(), src_file.read_bytes())
+
+    @unittest.skipIf(os.name == 'nt', 'permission bits are not kept on Windows')
+    def test_deferred_metadata_and_batch_sync(self):
+        """
+        Small files copied in a batch get the source mode and modification time in the deferred \
+        pass, and batch durability syncs the destination after each batch.
+        """
+        for index in range(5):
+            write_file(self.src_path / f'small_{index}.txt', b'x' * index,
+                       1_600_000_000_000_000_000 + index)
+            (self.src_path / f'small_{index}.txt').chmod(0o600 + index)
+
+        args = parse_args(['--durability', 'batch', '-w', '2', '-o', 'quiet'])
+
+        with mock.patch('backup_buddy.sync_fs') as sync_fs:
+            run_backup(args, self.src_path, self.dest_path, True)
+
+        # Once for the single batch and once at the end of the run #
+        self.assertEqual(sync_fs.call_args_list, [mock.call(self.dest_path)] * 2)
+        self.assertEqual(tree_files(self.dest_path), tree_files(self.src_path))
+
+        for src_file in self.src_path.iterdir():
+            src_stat = src_file.stat()
+            dest_stat = (self.dest_path / src_file.name).stat()
+            self.assertEqual((dest_stat.st_mode, dest_stat.st_mtime_ns),
+                             (src_stat.st_mode, src_stat.st_mtime_ns))
+
+
+class ChunkBoundaryTest(unittest.TestCase):
+    """
+    Tests the vectorized chunk boundary scan against the scalar gear hash.
+    """
+    def assert_chunks(self, data: bytes):
+        """
+        Checks the chunks of the data match the scalar reference and join back into the data.
+
+        :param data:  The data to split.
+        :return:  Nothing
+        """
+        chunks = list(iter_chunks(io.BytesIO(data)))
+
+        self.assertEqual([len(chunk) for chunk in chunks], scalar_chunks(data))
+        self.assertEqual(b''.join(chunks), data)
+
+    def test_random_data(self):
+        """
+        Random data is cut at the same positions, including cuts across the scan blocks.
+        """
+        for seed in range(2):
+            self.assert_chunks(random.Random(seed).randbytes(2 * CHUNK_MAX))
+
+    def test_low_entropy_data(self):
+        """
+        Data of two symbols, whose hashes repeat often, is cut at the same positions.
+        """
+        self.assert_chunks(bytes(random.Random(2).choices(b'ab', k=2 * CHUNK_MAX)))
+
+    def test_empty_input(self):
+        """
+        Empty data has no chunks.
+        """
+        self.assertEqual(find_chunk_cut(bytearray()), 0)
+        self.assertEqual(list(iter_chunks(io.BytesIO())), [])
+
+    def test_shorter_than_minimum(self):
+        """
+        Data up to the minimum chunk size is a single chunk.
+        """
+        for size in (1, CHUNK_MIN - 1, CHUNK_MIN):
+            data = random.Random(size).randbytes(size)
+
+            self.assertEqual(find_chunk_cut(bytearray(data)), size)
+            self.assertEqual(list(iter_chunks(io.BytesIO(data))), [data])
+
+    def test_just_above_minimum(self):
+        """
+        Data ending within the first scan block past the minimum chunk matches the reference.
+        """
+        for size in (CHUNK_MIN + 1, CHUNK_MIN + 31, CHUNK_MIN + CHUNK_SCAN_BLOCK + 1):
+            data = bytearray(random.Random(size).randbytes(size))
+
+            self.assertEqual(find_chunk_cut(data), scalar_chunk_cut(data))
+
+    def test_no_cut_point(self):
+        """
+        Data without a boundary is cut at the maximum chunk size.
+        """
+        data = bytes(2 * CHUNK_MAX + 10)
+
+        self.assertEqual(scalar_chunk_cut(data), CHUNK_MAX)
+        self.assertEqual(find_chunk_cut(bytearray(data)), CHUNK_MAX)
+        self.assertEqual([len(chunk) for chunk in iter_chunks(io.BytesIO(data))],
+                         [CHUNK_MAX, CHUNK_MAX, 10])
+
+
+class VerifyTest(TreeTestCase):
+    """
+    Tests the hash verification pass of the copies.
+    """
+    def verify(self) -> Verifier:
+        """
+        Runs a verification pass of the destination against the source.
+
+        :return:  The verifier holding the tallies of the pass.
+        """
+        with DigestCache(self.dest_path) as cache, \
+        CopyEngine(2, reporter=ProgressReporter('quiet')) as engine:
+            verifier = Verifier(cache, 'blake2b')
+            verify_tree(self.src_path, self.dest_path, engine, verifier, True)
+
+        return verifier
+
+    def test_corrupted_copy_detected_with_cached_digests(self):
+        """
+        A copy corrupted without changing its size and mtime is detected on a later pass.
+        """
+        write_file(self.src_path / 'file.bin', b'A' * 1024, 1_600_000_000_000_000_000)
+        write_file(self.dest_path / 'file.bin', b'A' * 1024, 1_600_000_000_000_000_000)
+
+        self.assertEqual(self.verify().counts['matched'], 1)
+
+        write_file(self.dest_path / 'file.bin', b'A' * 1023 + b'B', 1_600_000_000_000_000_000)
+        verifier = self.verify()
+
+        self.assertEqual(verifier.counts['mismatched'], 1)
+        # Only the unchanged source digest was served from the cache #
+        self.assertEqual(verifier.cache.hits, 1)
+
+    def test_checksum_detects_same_size_and_mtime(self):
+        """
+        With --checksum, same sized files are compared by content instead of modification time.
+        """
+        write_file(self.src_path / 'same.bin', b'AAAA', 1_600_000_000_000_000_000)
+        write_file(self.src_path / 'differs.bin', b'BBBB', 1_600_000_000_000_000_000)
+        write_file(self.src_path / 'touched.bin', b'CCCC', 1_600_000_000_000_000_001)
+
+        for name, data in (('same.bin', b'AAAA'), ('differs.bin', b'XXXX'),
+                           ('touched.bin', b'CCCC')):
+            write_file(self.dest_path / name, data, 1_600_000_000_000_000_000)
+
+        run_backup(parse_args(['--checksum', '-o', 'quiet']), self.src_path, self.dest_path, True)
+
+        self.assertEqual(tree_files(self.dest_path), tree_files(self.src_path))
+        self.assertEqual((self.dest_path / 'touched.bin').stat().st_mtime_ns,
+                         1_600_000_000_000_000_000)
+
+    def test_missing_copy(self):
+        """
+        A source file without a destination copy is reported missing.
+        """
+        write_file(self.src_path / 'sub' / 'file.bin', b'data')
+
+        self.assertEqual(self.verify().counts['missing'], 1)
+
+
+class PathFilterTest(TreeTestCase):
+    """
+    Tests the gitignore style include and exclude rules.
+    """
+    def assert_rules(self, rules: list, excluded: tuple, kept: tuple, is_dir: bool = False):
+        """
+        Checks which relative paths the rules exclude.
+
+        :param rules:  The ordered glob rules, prefixed with ! to include.
+        :param excluded:  The relative paths the rules have to exclude.
+        :param kept:  The relative paths the rules have to keep.
+        :param is_dir:  Toggle to match the paths as directories.
+        :return:  Nothing
+        """
+        path_filter = PathFilter(self.src_path, rules)
+
+        for rel_path in excluded:
+            self.assertTrue(path_filter.excluded(rel_path, is_dir), f'{rules} keeps {rel_path}')
+        for rel_path in kept:
+            self.assertFalse(path_filter.excluded(rel_path, is_dir), f'{rules} drops {rel_path}')
+
+    def test_name_matches_at_any_depth(self):
+        """
+        A pattern without a slash matches the name in every directory.
+        """
+        self.assert_rules(['*.log'], ('a.log', 'x/y/a.log'), ('a.txt', 'a.log.txt'))
+
+    def test_leading_slash_anchors(self):
+        """
+        A leading slash anchors the pattern to the root.
+        """
+        self.assert_rules(['/build'], ('build',), ('src/build', 'builds'))
+
+    def test_middle_slash_anchors(self):
+        """
+        A slash in the middle anchors the pattern to the root, and * does not cross directories.
+        """
+        self.assert_rules(['doc/*.txt'], ('doc/a.txt',), ('x/doc/a.txt', 'doc/sub/a.txt'))
+
+    def test_leading_double_star(self):
+        """
+        A leading **/ matches in every directory.
+        """
+        self.assert_rules(['**/cache'], ('cache', 'a/b/cache'), ('cached', 'a/cache/b'))
+
+    def test_middle_double_star(self):
+        """
+        A /**/ in the middle matches zero or more directories.
+        """
+        self.assert_rules(['a/**/b'], ('a/b', 'a/x/b', 'a/x/y/b'), ('x/a/b', 'a/bb'))
+
+    def test_trailing_double_star(self):
+        """
+        A trailing /** matches everything inside the directory but not the directory itself.
+        """
+        self.assert_rules(['out/**'], ('out/x', 'out/x/y'), ('out', 'x/out/y'))
+        self.assert_rules(['out/**'], ('out/x',), ('out',), is_dir=True)
+
+    def test_directory_only(self):
+        """
+        A trailing slash only matches directories.
+        """
+        self.assert_rules(['tmp/'], ('tmp', 'a/tmp'), ('tmpx',), is_dir=True)
+        self.assert_rules(['tmp/'], (), ('tmp', 'a/tmp'))
+
+    def test_wildcards_and_classes(self):
+        """
+        ? matches one character, classes match ranges or a negated set and \\ escapes.
+        """
+        self.assert_rules(['file[0-9].txt', 'x?.bin', '[!a]*.dat', '\\*.md'],
+                          ('file1.txt', 'xy.bin', 'b.dat', '*.md'),
+                          ('filea.txt', 'x/y.bin', 'xyz.bin', 'a.dat', 'readme.md'))
+
+    def test_last_matching_rule_wins(self):
+        """
+        A negated rule includes back what an earlier rule excluded, but not what a later one does.
+        """
+        self.assert_rules(['*.log', '!keep.log'], ('other.log',), ('keep.log', 'a/keep.log'))
+        self.assert_rules(['!keep.log', '*.log'], ('keep.log', 'other.log'), ())
+
+    def test_excluded_directory_is_pruned(self):
+        """
+        Like git, a file cannot be included back once its parent directory is excluded, and the \
+        excluded directory is never scanned.
+        """
+        write_file(self.src_path / 'build' / 'keep.txt', b'keep')
+        write_file(self.src_path / 'build' / 'sub' / 'keep.txt', b'keep')
+        write_file(self.src_path / 'src' / 'keep.txt', b'keep')
+        args = parse_args(['--exclude', 'build/', '--include', 'build/keep.txt', '--include',
+                           'keep.txt', '-o', 'quiet'])
+
+        with mock.patch('backup_buddy.scan_tree_dir', wraps=backup_buddy.scan_tree_dir) as scan:
+            run_backup(args, self.src_path, self.dest_path, True)
+
+        self.assertEqual(set(tree_files(self.dest_path)), {'src/keep.txt'})
+        self.assertFalse((self.dest_path / 'build').exists())
+        self.assertNotIn(str(self.src_path / 'build'), [call.args[0] for call in scan.mock_calls])
+
+    def test_size_limits(self):
+        """
+        Files outside of the size limits are skipped.
+        """
+        write_file(self.src_path / 'small.bin', b'x')
+        write_file(self.src_path / 'medium.bin', b'x' * 100)
+        write_file(self.src_path / 'large.bin', b'x' * 10000)
+        args = parse_args(['--min-size', '10', '--max-size', '1000', '-o', 'quiet'])
+
+        run_backup(args, self.src_path, self.dest_path, True)
+
+        self.assertEqual(set(tree_files(self.dest_path)), {'medium.bin'})
+
+
+class JournalTest(TreeTestCase):
+    """
+    Tests resuming an interrupted recursive run from the checkpoint journal.
+    """
+    def test_resume_skips_checkpointed_subtrees(self):
+        """
+        A resumed run skips the subtrees checkpointed before the interruption and repairs the \
+        file the interruption left partially written.
+        """
+        for name in ('one', 'two'):
+            write_file(self.src_path / name / 'done.txt', b'done')
+            write_file(self.src_path / name / 'partial.txt', b'partial' * 100)
+
+        # The subtree walked last is interrupted, the one walked before it is checkpointed #
+        first, last = [rel_dir for rel_dir, _, _ in walk_tree(self.src_path)][1:]
+        interrupted = self.dest_path / last / 'partial.txt'
+        copy_small = CopyBackend.copy_small
+
+        def crashing_copy(backend, src_file, dest_file):
+            # If this is the interrupted file, write half of it before crashing #
+            if dest_file == interrupted:
+                dest_file.write_bytes(src_file.read_bytes()[:350])
+                raise KeyboardInterrupt
+
+            return copy_small(backend, src_file, dest_file)
+
+        args = parse_args(['--journal', '-w', '1', '-o', 'quiet'])
+
+        with mock.patch.object(CopyBackend, 'copy_small', crashing_copy), \
+        mock.patch('backup_buddy.sync_fs', wraps=backup_buddy.sync_fs) as sync_fs:
+            with self.assertRaises(KeyboardInterrupt):
+                run_backup(args, self.src_path, self.dest_path, True)
+
+        # Only the destination file system is flushed before the checkpoint is written #
+        sync_fs.assert_called_once_with(self.dest_path)
+        self.assertEqual(len(interrupted.read_bytes()), 350)
+        self.assertIn(first.as_posix(), (self.dest_path / JOURNAL_NAME).read_text('utf-8'))
+
+        # A file removed from a checkpointed subtree is not copied again by the resumed run #
+        (self.dest_path / first / 'done.txt').unlink()
+        run_backup(args, self.src_path, self.dest_path, True)
+
+        self.assertFalse((self.dest_path / first / 'done.txt').exists())
+        self.assertEqual(interrupted.read_bytes(), b'partial' * 100)
+        self.assertEqual((self.dest_path / last / 'done.txt').read_bytes(), b'done')
+        self.assertFalse((self.dest_path / JOURNAL_NAME).exists())
+
+
+class StoreTest(TreeTestCase):
+    """
+    Tests the backups into and restores out of the chunk store.
+    """
+    def make_tree(self):
+        """
+        Writes a source tree with a file spanning several chunks and a few small files.
+
+        :return:  Nothing
+        """
+        write_file(self.src_path / 'large.bin', random.Random(0).randbytes(3 * CHUNK_MAX))
+        write_file(self.src_path / 'sub' / 'small.txt', b'small')
+        write_file(self.src_path / 'sub' / 'deeper' / 'empty.txt', b'')
+
+    def round_trip(self, workers: int):
+        """
+        Backs the source tree up into the store twice and restores it.
+
+        :param workers:  The number of copy workers and chunking processes.
+        :return:  Nothing
+        """
+        self.make_tree()
+        store_path = self.dest_path / 'store'
+        restore_path = self.dest_path / 'restore'
+        run_backup(parse_args(['--store', '-w', str(workers), '-o', 'quiet']), self.src_path,
+                   store_path, True)
+
+        # A file touched since the first run is chunked again but its chunks are not rewritten #
+        os.utime(self.src_path / 'large.bin', ns=(time.time_ns(), time.time_ns()))
+
+        with ChunkStore(store_path, workers) as store, \
+        CopyEngine(workers, reporter=ProgressReporter('quiet')) as engine:
+            self.assertEqual(store.pool is not None, workers > 1)
+            store_backup(self.src_path, store, engine, True)
+
+        self.assertEqual(store.written, 0)
+
+        run_backup(parse_args(['--store-restore', '-o', 'quiet']), store_path, restore_path, True)
+
+        self.assertEqual(tree_files(restore_path), tree_files(self.src_path))
+        self.assertEqual(len(list((store_path / 'snapshots').iterdir())), 2)
+
+    def test_round_trip(self):
+        """
+        A tree backed up into the store is restored unchanged.
+        """
+        self.round_trip(1)
+
+    def test_round_trip_chunking_processes(self):
+        """
+        A tree chunked in worker processes is restored unchanged.
+        """
+        with mock.patch('backup_buddy.os.cpu_count', return_value=2):
+            self.round_trip(2)
+
+    def test_restore_leaves_non_store_untouched(self):
+        """
+        Restoring out of a directory that is not a chunk store fails without writing to it.
+        """
+        write_file(self.src_path / 'file.txt', b'data')
+
+        with self.assertRaises(ValueError):
+            run_backup(parse_args(['--store-restore', '-o', 'quiet']), self.src_path,
+                       self.dest_path, True)
+
+        self.assertEqual([path.name for path in self.src_path.iterdir()], ['file.txt'])
+
+    def test_keep_prunes_snapshots_before_gc(self):
+        """
+        The retention policy deletes the old snapshots so gc frees the chunks only they used.
+        """
+        for version in (b'first', b'second'):
+            write_file(self.src_path / 'file.txt', version * 1000)
+            run_backup(parse_args(['--store', '--keep', '1', '--store-gc', '-o', 'quiet']),
+                       self.src_path, self.dest_path, True)
+
+        snapshots = list((self.dest_path / 'snapshots').iterdir())
+        chunks = list((self.dest_path / 'chunks').glob('*/*'))
+
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0].read_bytes(), b'second' * 1000)
+
+
+class BenchmarkTest(TreeTestCase):
+    """
+    Tests the benchmark cases.
+    """
+    def test_incremental_case(self):
+        """
+        The measured run of an incremental case only copies the files modified after the initial \
+        copy, which runs beforehand in prepare_case.
+        """
+        benchmark.build_tiny_files(self.src_path, 0.005, random.Random(benchmark.SEED))
+        benchmark.prepare_case('recursive', 2, self.src_path, self.dest_path)
+        result = benchmark.run_case('incremental', 'recursive', 2, self.src_path,
+                                    self.dest_path)
+
+        self.assertEqual(result['files_checked'], 100)
+        self.assertEqual(result['files_copied'], int(100 * benchmark.MODIFIED_RATIO))
+        self.assertNotIn('syscalls', result)
+        self.assertEqual(tree_files(self.src_path), tree_files(self.dest_path))
+
+    def test_trees_are_reproducible(self):
+        """
+        Building a scenario tree twice from the same seed produces identical trees.
+        """
+        benchmark.build_deep_nesting(self.src_path, 0.05, random.Random(benchmark.SEED))
+        benchmark.build_deep_nesting(self.dest_path, 0.05, random.Random(benchmark.SEED))
+
+        self.assertEqual(len(tree_files(self.src_path)), 25)
+        self.assertEqual(tree_files(self.src_path), tree_files(self.dest_path))
+
+
+
+class EngineTest(TreeTestCase):
+    """
+    Tests the concurrent copy engine.
+    """
+    def test_results_reported_in_submission_order(self):
+        """
+        Results are reported in the order the jobs were submitted, not the order they finish in.
+        """
+        reporter = mock.Mock()
+
+        def job(index: int) -> str:
+            # Make the jobs submitted first finish last #
+            time.sleep((8 - index) * 0.01)
+            return f'job {index}'
+
+        with CopyEngine(4, reporter=reporter) as engine:
+            for index in range(8):
+                engine.submit(job, index)
+
+        self.assertEqual([call.args[0] for call in reporter.report.call_args_list],
+                         [f'job {index}' for index in range(8)])
+
+    def test_parallel_copy_matches_source(self):
+        """
+        A recursive copy with several workers reproduces the source tree and its modification \
+        times.
+        """
+        for index in range(20):
+            write_file(self.src_path / f'dir_{index % 4}' / f'file_{index}.bin', os.urandom(index),
+                       1_600_000_000_000_000_000 + index)
+
+        reporter = ProgressReporter('quiet')
+
+        with CopyEngine(4, queue_size=2, reporter=reporter) as engine:
+            recursive_copy(self.src_path, self.dest_path, engine)
+
+        self.assertEqual(reporter.copied, 20)
+        self.assertEqual(tree_files(self.dest_path), tree_files(self.src_path))
+
+        for src_file in self.src_path.rglob('*.bin'):
+            dest_file = self.dest_path / src_file.relative_to(self.src_path)
+            self.assertEqual(dest_file.stat().st_mtime_ns, src_file.stat().st_mtime_ns)
+
+
+
+class ChangeDetectionTest(TreeTestCase):
+    """
+    Tests detecting changed files from their size and nanosecond modification time.
+    """
+    def copy(self) -> ProgressReporter:
+        """
+        Runs a single directory copy of the source into the destination.
+
+        :return:  The reporter of the run holding its tallies.
+        """
+        reporter = ProgressReporter('quiet')
+
+        with CopyEngine(1, reporter=reporter) as engine:
+            single_mode(self.src_path, self.dest_path, engine)
+
+        return reporter
+
+    def test_unchanged_files_skipped(self):
+        """
+        Files matching the size and modification time of their copies are not copied again.
+        """
+        write_file(self.src_path / 'one.txt', b'one', 1_600_000_000_000_000_000)
+        write_file(self.src_path / 'two.txt', b'two', 1_600_000_000_000_000_001)
+
+        self.assertEqual(self.copy().copied, 2)
+
+        reporter = self.copy()
+
+        self.assertEqual((reporter.checked, reporter.copied), (2, 0))
+
+    def test_changed_files_copied(self):
+        """
+        A differing size or nanosecond modification time, older or newer, recopies the file.
+        """
+        for name in ('mtime.txt', 'size.txt', 'older.txt', 'same.txt'):
+            write_file(self.src_path / name, b'data', 1_600_000_000_000_000_000)
+
+        self.copy()
+        write_file(self.src_path / 'mtime.txt', b'DATA', 1_600_000_000_000_000_001)
+        write_file(self.src_path / 'size.txt', b'data!', 1_600_000_000_000_000_000)
+        write_file(self.src_path / 'older.txt', b'ATAD', 1_500_000_000_000_000_000)
+
+        reporter = self.copy()
+
+        self.assertEqual(reporter.copied, 3)
+        self.assertEqual(tree_files(self.dest_path), tree_files(self.src_path))
+        self.assertEqual((self.dest_path / 'older.txt').stat().st_mtime_ns,
+                         1_500_000_000_000_000_000)
+
+
+
+class ManifestTest(TreeTestCase):
+    """
+    Tests the incremental runs diffing the source against the destination manifest.
+    """
+    def backup(self, *options: str) -> ProgressReporter:
+        """
+        Runs a recursive copy of the source into the destination with the manifest options.
+
+        :param options:  The manifest command line options.
+        :return:  The reporter of the run holding its tallies.
+        """
+        reporter = ProgressReporter('quiet')
+
+        with mock.patch('backup_buddy.ProgressReporter', return_value=reporter):
+            run_backup(parse_args([*options, '-o', 'quiet']), self.src_path, self.dest_path,
+                       True)
+
+        return reporter
+
+    def test_trusted_manifest_replaces_dest_scan(self):
+        """
+        Once a run completed, the next run trusts the manifest instead of scanning the \
+        destination, until the manifest is rebuilt.
+        """
+        write_file(self.src_path / 'sub' / 'file.txt', b'data')
+        write_file(self.src_path / 'root.txt', b'root')
+
+        self.assertEqual(self.backup('--manifest').copied, 2)
+
+        # A file deleted behind the back of the manifest is not noticed by a trusted run #
+        (self.dest_path / 'sub' / 'file.txt').unlink()
+
+        with mock.patch('backup_buddy.scan_files', wraps=backup_buddy.scan_files) as scan:
+            reporter = self.backup('--manifest')
+
+        self.assertEqual((reporter.checked, reporter.copied), (2, 0))
+        scan.assert_not_called()
+
+        self.assertEqual(self.backup('--rebuild-manifest').copied, 1)
+        self.assertEqual(tree_files(self.dest_path)['sub/file.txt'], b'data')
+
+    def test_interrupted_run_untrusted(self):
+        """
+        A manifest left by a run that did not finish is rebuilt from a destination scan.
+        """
+        write_file(self.src_path / 'file.txt', b'data')
+
+        with Manifest(self.dest_path):
+            pass
+
+        with self.assertRaises(KeyboardInterrupt), Manifest(self.dest_path):
+            raise KeyboardInterrupt
+
+        with Manifest(self.dest_path) as manifest:
+            self.assertFalse(manifest.trusted)
+
+
+
+class CopyTierTest(TreeTestCase):
+    """
+    Tests the tiers of the copy backend.
+    """
+    def test_tiers_copy_identical_content(self):
+        """
+        Every tier available on the platform copies the file unchanged.
+        """
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        write_file(self.src_path / 'file.bin', data)
+
+        for tier in ('copy_file_range', 'sendfile', 'buffered'):
+            backend = CopyBackend()
+            dest_file = self.dest_path / f'{tier}.bin'
+
+            # Only allow the tier under test, the buffered copy is always allowed #
+            with mock.patch.object(backend, 'available', lambda name, *_, tier=tier:
+                                   name in (tier, 'buffered')):
+                used = backend.copy(self.src_path / 'file.bin', dest_file)
+
+            self.assertEqual(dest_file.read_bytes(), data)
+            self.assertIn(used, (tier, 'buffered'))
+
+    def test_unsupported_tier_disabled(self):
+        """
+        A tier failing as unsupported falls through to the next one and is skipped afterwards.
+        """
+        write_file(self.src_path / 'one.bin', b'one' * 1000)
+        write_file(self.src_path / 'two.bin', b'two' * 1000)
+        backend = CopyBackend()
+        unsupported = mock.Mock(side_effect=OSError(errno.EXDEV, 'cross device'))
+
+        with mock.patch.object(backend, 'reflink_copy', unsupported), \
+        mock.patch.object(backend, 'copy_file_range_copy', unsupported), \
+        mock.patch.object(backend, 'sendfile_copy', unsupported):
+            for name in ('one.bin', 'two.bin'):
+                self.assertEqual(backend.copy(self.src_path / name, self.dest_path / name),
+                                 'buffered')
+
+        self.assertEqual(unsupported.call_count, len(backend.disabled))
+        self.assertEqual(backend.counts['buffered'], 2)
+        self.assertEqual(tree_files(self.dest_path), tree_files(self.src_path))
+
+    def test_other_errors_raised(self):
+        """
+        A tier failing with an error other than unsupported fails the copy.
+        """
+        write_file(self.src_path / 'file.bin', b'data')
+        backend = CopyBackend()
+
+        with mock.patch.object(backend, 'available', return_value=True), \
+        mock.patch.object(backend, 'reflink_copy', side_effect=OSError(errno.EIO, 'io error')):
+            with self.assertRaises(OSError):
+                backend.copy(self.src_path / 'file.bin', self.dest_path / 'file.bin')
+
+
+
+class DeltaTest(TreeTestCase):
+    """
+    Tests the block-level delta updates of large modified files.
+    """
+    def update(self, data: bytes, mtime_ns: int, manifest: Manifest = None) -> CopyBackend:
+        """
+        Writes the source file and runs a recursive copy delta updating files of at least a block.
+
+        :param data:  The content of the source file.
+        :param mtime_ns:  The modification time of the source file.
+        :param manifest:  The destination manifest storing the block signatures, None to compare \
+                          against the destination contents.
+        :return:  The backend of the run holding the delta tallies.
+        """
+        write_file(self.src_path / 'large.bin', data, mtime_ns)
+        backend = CopyBackend(DELTA_BLOCK_SIZE, manifest)
+
+        with CopyEngine(1, backend=backend, reporter=ProgressReporter('quiet')) as engine:
+            # If the manifest is in use, record the copied files and their signatures #
+            if manifest is not None:
+                engine.listeners.append(manifest.record)
+            recursive_copy(self.src_path, self.dest_path, engine, manifest)
+
+        return backend
+
+    def test_only_changed_block_rewritten(self):
+        """
+        Only the block holding the changed byte is rewritten, compared against the destination.
+        """
+        data = bytearray(random.Random(0).randbytes(4 * DELTA_BLOCK_SIZE + 100))
+        self.assertEqual(self.update(data, 1_600_000_000_000_000_000).counts['delta'], 0)
+
+        data[2 * DELTA_BLOCK_SIZE + 5] ^= 0xFF
+        backend = self.update(data, 1_600_000_000_000_000_001)
+
+        self.assertEqual((backend.counts['delta'], backend.delta_written), (1, DELTA_BLOCK_SIZE))
+        self.assertEqual((self.dest_path / 'large.bin').read_bytes(), data)
+        self.assertEqual((self.dest_path / 'large.bin').stat().st_mtime_ns,
+                         1_600_000_000_000_000_001)
+
+    def test_stored_signature_used(self):
+        """
+        With the manifest, the blocks are compared against the signature stored by the last \
+        delta update instead of the destination contents, and a shrunk file is truncated.
+        """
+        data = bytearray(random.Random(0).randbytes(4 * DELTA_BLOCK_SIZE + 100))
+        dest_file = self.dest_path / 'large.bin'
+
+        for mtime_ns in (1_600_000_000_000_000_000, 1_600_000_000_000_000_001):
+            data[2 * DELTA_BLOCK_SIZE] ^= 0xFF
+            with Manifest(self.dest_path) as manifest:
+                self.update(data, mtime_ns, manifest)
+
+        # Corrupt the first block, the stored signature no longer matches the destination #
+        with open(dest_file, 'r+b') as dest:
+            dest.write(b'corrupt')
+        os.utime(dest_file, ns=(1_600_000_000_000_000_001, 1_600_000_000_000_000_001))
+
+        data[DELTA_BLOCK_SIZE] ^= 0xFF
+        data = data[:3 * DELTA_BLOCK_SIZE + 50]
+
+        with Manifest(self.dest_path) as manifest:
+            backend = self.update(data, 1_600_000_000_000_000_002, manifest)
+
+        self.assertEqual(backend.delta_written, DELTA_BLOCK_SIZE + 50)
+        self.assertEqual(dest_file.read_bytes(), b'corrupt' + data[7:])
+
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on Linux')
+class WatchTest(TreeTestCase):
+    """
+    Tests replicating the changes reported by inotify.
+    """
+    def test_changes_replicated(self):
+        """
+        Files written and directories created after the initial copy are replicated once the \
+        source is quiet, and the new directories are watched.
+        """
+        write_file(self.src_path / 'old.txt', b'old')
+        write_file(self.src_path / 'sub' / 'keep.txt', b'keep')
+        read_events = InotifyWatcher.read_events
+        calls = []
+
+        def fake_read_events(watcher, timeout):
+            calls.append(timeout)
+            # If this is the first wait, change the source while it is watched #
+            if len(calls) == 1:
+                write_file(self.src_path / 'old.txt', b'changed')
+                write_file(self.src_path / 'sub' / 'new.txt', b'new')
+                write_file(self.src_path / 'made' / 'deeper' / 'file.txt', b'file')
+                return read_events(watcher, timeout)
+            # If the batch was synced, stop watching #
+            if len(calls) == 3:
+                self.assertIn(self.src_path / 'made' / 'deeper', watcher.watches.values())
+                raise KeyboardInterrupt
+
+            return read_events(watcher, timeout)
+
+        with CopyEngine(1, reporter=ProgressReporter('quiet')) as engine:
+            recursive_copy(self.src_path, self.dest_path, engine)
+            engine.wait()
+
+            with mock.patch.object(InotifyWatcher, 'read_events', fake_read_events):
+                watch_mode(self.src_path, self.dest_path, engine, None, True, 0.05)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(tree_files(self.dest_path), tree_files(self.src_path))
+
+
+
+class WalkTreeTest(TreeTestCase):
+    """
+    Tests the scandir tree walker.
+    """
+    def make_tree(self):
+        """
+        Writes a source tree holding a directory named like the source root.
+
+        :return:  Nothing
+        """
+        for rel_path in ('root.txt', 'a/one.txt', 'a/src/two.txt', 'a/src/src/three.txt',
+                         'b/four.txt', 'b/c/five.txt'):
+            write_file(self.src_path / rel_path, rel_path.encode())
+
+    def walk(self, scan_workers: int, prune: str = None) -> list:
+        """
+        Walks the source tree.
+
+        :param scan_workers:  The number of threads scanning directories.
+        :param prune:  The name of the directories removed from the walk, None to walk every one.
+        :return:  The list of (relative dir, sorted file names) tuples in walk order.
+        """
+        walked = []
+
+        for rel_dir, dir_entries, file_entries in walk_tree(self.src_path, scan_workers):
+            dir_entries[:] = [entry for entry in dir_entries if entry.name != prune]
+            walked.append((rel_dir.as_posix(), sorted(entry.name for entry in file_entries)))
+
+        return walked
+
+    def test_relative_dirs_match_os_walk(self):
+        """
+        The relative directories and files match os.walk, including nested directories named \
+        like the source root.
+        """
+        self.make_tree()
+        expected = sorted((Path(dir_path).relative_to(self.src_path).as_posix(),
+                           sorted(file_names))
+                          for dir_path, _, file_names in os.walk(self.src_path))
+
+        self.assertEqual(sorted(self.walk(1)), expected)
+        self.assertIn(('a/src/src', ['three.txt']), expected)
+
+    def test_scan_workers_keep_order(self):
+        """
+        Scanning the subdirectories concurrently yields the same walk in the same order, and \
+        pruned directories are not walked.
+        """
+        self.make_tree()
+
+        self.assertEqual(self.walk(3), self.walk(1))
+        self.assertEqual(sorted(rel_dir for rel_dir, _ in self.walk(3, prune='src')),
+                         ['.', 'a', 'b', 'b/c'])
+
+    @unittest.skipIf(os.name == 'nt', 'symlinks need privileges on Windows')
+    def test_symlinked_dirs_not_descended(self):
+        """
+        A symlinked directory is yielded as an entry but not descended into.
+        """
+        write_file(self.src_path / 'real' / 'file.txt', b'file')
+        (self.src_path / 'link').symlink_to(self.src_path / 'real', target_is_directory=True)
+
+        self.assertEqual([rel_dir for rel_dir, _ in self.walk(1)], ['.', 'real'])
+
+
+
+class ReporterTest(TreeTestCase):
+    """
+    Tests the output modes and per-file log of the progress reporter.
+    """
+    def report(self, mode: str, log_path: Path = None) -> str:
+        """
+        Reports a directory banner, an unchanged file and two copied files.
+
+        :param mode:  The output mode, one of verbose, progress or quiet.
+        :param log_path:  The path of the per-file log, None to disable it.
+        :return:  The printed output.
+        """
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            reporter = ProgressReporter(mode, log_path)
+            reporter.report('\nIn path: src')
+            reporter.report(None)
+
+            for name in ('one.txt', 'two.txt'):
+                reporter.report(CopyResult(f'File Copied: {name}', self.dest_path / name,
+                                           FileMeta(1024, 0)))
+            reporter.finish()
+
+        self.assertEqual((reporter.checked, reporter.copied, reporter.copied_bytes), (3, 2, 2048))
+        return output.getvalue()
+
+    def test_verbose_prints_every_message(self):
+        """
+        Verbose mode prints the banners and every copied file before the summary.
+        """
+        output = self.report('verbose')
+
+        self.assertIn('In path: src\nFile Copied: one.txt\nFile Copied: two.txt\n', output)
+        self.assertIn('Checked 3 files, copied 2', output)
+
+    def test_quiet_prints_summary_only(self):
+        """
+        Quiet mode only prints the summary, while the per-file log still gets every copied file.
+        """
+        log_path = self.dest_path / 'copy.log'
+        output = self.report('quiet', log_path)
+
+        self.assertNotIn('File Copied', output)
+        self.assertEqual(output.strip().splitlines(), [output.strip()])
+        self.assertEqual(log_path.read_text('utf-8'), 'File Copied: one.txt\n'
+                                                      'File Copied: two.txt\n')
+
+    def test_progress_line_rate_limited(self):
+        """
+        Progress mode redraws a single status line at most once per status interval.
+        """
+        with mock.patch('backup_buddy.time.monotonic', return_value=1000.0):
+            output = self.report('progress')
+
+        self.assertEqual(output.count('\r'), 3)
+        self.assertNotIn('File Copied', output)
+
+
+
+class MetricsTest(TreeTestCase):
+    """
+    Tests the phase metrics exported by a run.
+    """
+    def backup(self, fmt: str) -> str:
+        """
+        Copies a small tree with the metrics report enabled.
+
+        :param fmt:  The format of the report, json or prometheus.
+        :return:  The content of the report.
+        """
+        for index in range(3):
+            write_file(self.src_path / 'sub' / f'file_{index}.txt', b'x' * (index + 1))
+
+        metrics_path = self.dest_path.parent / 'metrics.out'
+        run_backup(parse_args(['--metrics', str(metrics_path), '--metrics-format', fmt, '-o',
+                               'quiet']), self.src_path, self.dest_path, True)
+
+        return metrics_path.read_text('utf-8')
+
+    def test_json_report(self):
+        """
+        The JSON report holds the run counters, a histogram per phase and the slowest files.
+        """
+        report = json.loads(self.backup('json'))
+
+        self.assertEqual(report['counters']['files_copied'], 3)
+        self.assertEqual(report['counters']['bytes_copied'], 6)
+        self.assertEqual(set(report['phases']), set(METRIC_PHASES))
+        self.assertEqual(report['phases']['copy']['count'], 3)
+        self.assertEqual(sum(report['phases']['copy']['histogram'].values()), 3)
+        self.assertEqual(len(report['slowest_files']), 3)
+
+    def test_prometheus_report(self):
+        """
+        The Prometheus report has cumulative buckets ending in the phase count.
+        """
+        lines = self.backup('prometheus').splitlines()
+
+        self.assertIn('backup_buddy_files_copied 3', lines)
+        self.assertIn('backup_buddy_phase_seconds_bucket{phase="copy",le="+Inf"} 3', lines)
+        self.assertIn('backup_buddy_phase_seconds_count{phase="copy"} 3', lines)
+
+        buckets = [int(line.split()[-1]) for line in lines
+                   if line.startswith('backup_buddy_phase_seconds_bucket{phase="copy"')]
+        self.assertEqual(buckets, sorted(buckets))
+
+
+
+class ArchiveTest(TreeTestCase):
+    """
+    Tests the streaming compressed archives.
+    """
+    def archive(self, fmt: str, incremental: bool = False) -> dict:
+        """
+        Archives the source tree and reads the archive back.
+
+        :param fmt:  The archive format, one of ARCHIVE_FORMATS.
+        :param incremental:  Toggle to only archive files changed since the previous archive.
+        :return:  The archived file contents keyed by their path.
+        """
+        args = ['--archive', fmt, '-o', 'quiet'] + (['--incremental'] if incremental else [])
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            run_backup(parse_args(args), self.src_path, self.dest_path, True)
+
+        archive_path = Path(output.getvalue().split('Archive written: ')[1].strip())
+        # tarfile cannot read zstd, decompress it first #
+        if fmt == 'zst':
+            with open(archive_path, 'rb') as archive:
+                data = backup_buddy.zstandard.ZstdDecompressor().stream_reader(archive).read()
+            archive_path = archive_path.with_suffix('')
+            archive_path.write_bytes(data)
+
+        with tarfile.open(archive_path) as tar:
+            return {member.name: tar.extractfile(member).read() for member in tar
+                    if member.isfile()}
+
+    def test_formats_round_trip(self):
+        """
+        Every archive format holds the whole source tree.
+        """
+        write_file(self.src_path / 'file.txt', b'file' * 1000)
+        write_file(self.src_path / 'sub' / 'deeper' / 'nested.bin', os.urandom(1000))
+
+        for fmt in ARCHIVE_FORMATS:
+            # If the optional zstandard package is not installed #
+            if fmt == 'zst' and backup_buddy.zstandard is None:
+                continue
+
+            with self.subTest(fmt=fmt):
+                self.assertEqual(self.archive(fmt), tree_files(self.src_path))
+
+    def test_incremental_holds_changed_files(self):
+        """
+        An incremental archive only holds the files changed since the index of the previous \
+        archive, and the first one is a full archive.
+        """
+        write_file(self.src_path / 'same.txt', b'same', 1_600_000_000_000_000_000)
+        write_file(self.src_path / 'sub' / 'changed.txt', b'old', 1_600_000_000_000_000_000)
+
+        self.assertEqual(set(self.archive('gz', incremental=True)),
+                         {'same.txt', 'sub/changed.txt'})
+
+        write_file(self.src_path / 'sub' / 'changed.txt', b'new', 1_600_000_000_000_000_001)
+        write_file(self.src_path / 'added.txt', b'added')
+
+        self.assertEqual(self.archive('gz', incremental=True),
+                         {'sub/changed.txt': b'new', 'added.txt': b'added'})
+        self.assertEqual(len(list(self.dest_path.glob('backup_*_full.tar.gz'))), 1)
+        self.assertEqual(len(list(self.dest_path.glob('backup_*_incr.tar.gz'))), 1)
+        self.assertEqual(len(list(self.dest_path.glob('backup_*.idx'))), 2)
+
+    def test_failed_archive_removed(self):
+        """
+        An archive failing part way leaves no partial archive or index behind.
+        """
+        write_file(self.src_path / 'file.txt', b'data')
+
+        with mock.patch('backup_buddy.tarfile.TarFile.addfile', side_effect=OSError('failed')):
+            with self.assertRaises(OSError):
+                self.archive('xz')
+
+        self.assertEqual(list(self.dest_path.iterdir()), [])
+
+
+
+class SnapshotTest(TreeTestCase):
+    """
+    Tests the hardlinked snapshot generations and their retention.
+    """
+    def snapshot(self, *options: str) -> list:
+        """
+        Backs the source up into a new snapshot generation.
+
+        :param options:  Additional command line options.
+        :return:  The list of generation paths, oldest first.
+        """
+        run_backup(parse_args(['--snapshot', *options, '-o', 'quiet']), self.src_path,
+                   self.dest_path, True)
+        return list_generations(self.dest_path)
+
+    def test_unchanged_files_hardlinked(self):
+        """
+        Files unchanged since the previous generation are hardlinked to it, changed files are \
+        copied, and every generation is a full copy of the source at the time.
+        """
+        write_file(self.src_path / 'same.txt', b'same')
+        write_file(self.src_path / 'sub' / 'changed.txt', b'old')
+        first_tree = tree_files(self.src_path)
+        self.snapshot()
+        (self.dest_path / 'leftover.partial').mkdir()
+
+        write_file(self.src_path / 'sub' / 'changed.txt', b'new!')
+        first, second = self.snapshot()
+
+        self.assertEqual(tree_files(first), first_tree)
+        self.assertEqual(tree_files(second), tree_files(self.src_path))
+        self.assertEqual((first / 'same.txt').stat().st_ino, (second / 'same.txt').stat().st_ino)
+        self.assertNotEqual((first / 'sub' / 'changed.txt').stat().st_ino,
+                            (second / 'sub' / 'changed.txt').stat().st_ino)
+        self.assertFalse((self.dest_path / 'leftover.partial').exists())
+
+    def test_keep_prunes_oldest(self):
+        """
+        Only the newest generations are kept, files shared with a pruned generation survive.
+        """
+        write_file(self.src_path / 'file.txt', b'data')
+
+        for _ in range(3):
+            generations = self.snapshot('--keep', '2')
+
+        self.assertEqual(len(generations), 2)
+        self.assertEqual((generations[-1] / 'file.txt').read_bytes(), b'data')
+        self.assertEqual((generations[-1] / 'file.txt').stat().st_nlink, 2)
+
+    def test_keep_days(self):
+        """
+        Backups older than the max age expire, except the newest which is always kept.
+        """
+        now = datetime.now()
+        backups = [Path((now - timedelta(days=days)).strftime(GENERATION_FORMAT))
+                   for days in (10, 5, 1)]
+
+        self.assertEqual(expired_backups(backups, keep_days=7), backups[:1])
+        self.assertEqual(sorted(expired_backups(backups, keep=1, keep_days=7)), backups[:2])
+        self.assertEqual(expired_backups(backups[:1], keep_days=1), [])
+
+
+
+class PlanTest(TreeTestCase):
+    """
+    Tests the locality aware copy planner and dry runs.
+    """
+    def make_tree(self):
+        """
+        Writes a source tree with an unchanged, a changed and new files, partly copied already.
+
+        :return:  Nothing
+        """
+        for rel_path in ('same.txt', 'changed.txt', 'new/one.txt', 'new/deeper/two.txt'):
+            write_file(self.src_path / rel_path, rel_path.encode(), 1_600_000_000_000_000_000)
+
+        write_file(self.dest_path / 'same.txt', b'same.txt', 1_600_000_000_000_000_000)
+        write_file(self.dest_path / 'changed.txt', b'old', 1_500_000_000_000_000_000)
+
+    def test_plan_ordered_by_inode(self):
+        """
+        The plan holds the missing directories parents first and the changed files by inode.
+        """
+        self.make_tree()
+        plan = plan_copy(self.src_path, self.dest_path, True)
+
+        self.assertEqual(plan.dirs, [self.dest_path / 'new', self.dest_path / 'new' / 'deeper'])
+        self.assertEqual(plan.unchanged, 1)
+        self.assertEqual(sorted(op.dest_file.name for op in plan.ops),
+                         ['changed.txt', 'one.txt', 'two.txt'])
+        self.assertEqual([op.key for op in plan.ops],
+                         sorted((1, op.src_entry.inode()) for op in plan.ops))
+
+    def test_extent_order_falls_back_to_inode(self):
+        """
+        Files with a known physical offset go first in offset order, the rest follow by inode.
+        """
+        self.make_tree()
+        offsets = {'changed.txt': 8192, 'two.txt': 4096}
+
+        with mock.patch('backup_buddy.physical_offset',
+                        side_effect=lambda path: offsets.get(os.path.basename(path))):
+            plan = plan_copy(self.src_path, self.dest_path, True, order='extent')
+
+        self.assertEqual([op.dest_file.name for op in plan.ops],
+                         ['two.txt', 'changed.txt', 'one.txt'])
+
+    def test_dry_run_copies_nothing(self):
+        """
+        A dry run prints the plan without touching the destination, and the planned run copies \
+        the tree.
+        """
+        self.make_tree()
+        before = tree_files(self.dest_path)
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            run_backup(parse_args(['--dry-run', '-o', 'quiet']), self.src_path, self.dest_path,
+                       True)
+
+        self.assertEqual(tree_files(self.dest_path), before)
+        self.assertFalse((self.dest_path / 'new').exists())
+        self.assertIn('Plan: 2 directories to create, 3 files to copy', output.getvalue())
+        self.assertIn('update', output.getvalue())
+
+        run_backup(parse_args(['--plan', 'extent', '-o', 'quiet']), self.src_path,
+                   self.dest_path, True)
+
+        self.assertEqual(tree_files(self.dest_path), tree_files(self.src_path))
+
+
+
+class ThrottleTest(TreeTestCase):
+    """
+    Tests the token bucket limits and the adaptive concurrency of the throttle.
+    """
+    def test_token_bucket_debt(self):
+        """
+        Takes within the burst do not wait, larger ones wait off the debt at the refill rate.
+        """
+        clock = mock.Mock(return_value=100.0)
+
+        with mock.patch('backup_buddy.time.monotonic', clock), \
+        mock.patch('backup_buddy.time.sleep') as sleep:
+            bucket = TokenBucket(10, 10)
+            bucket.take(10)
+            sleep.assert_not_called()
+
+            bucket.take(5)
+            sleep.assert_called_once_with(0.5)
+
+            # After a second the debt is paid and the bucket holds five tokens #
+            clock.return_value = 101.0
+            bucket.take(5)
+            sleep.assert_called_once_with(0.5)
+
+    def test_bandwidth_limit(self):
+        """
+        The copies are slowed down to the bandwidth limit, past the burst of a second.
+        """
+        write_file(self.src_path / 'file.bin', os.urandom(4 * BUFFER_SIZE))
+
+        for tier in ('copy_file_range', 'buffered'):
+            # Sleeping advances the clock the token buckets are refilled by #
+            clock = [0.0]
+
+            with mock.patch('backup_buddy.time.monotonic', lambda clock=clock: clock[0]), \
+            mock.patch('backup_buddy.time.sleep',
+                       lambda seconds, clock=clock: clock.append(clock.pop() + seconds)):
+                backend = CopyBackend(throttle=Throttle(BUFFER_SIZE))
+
+                with mock.patch.object(backend, 'available',
+                                       lambda name, *_, tier=tier: name == tier):
+                    backend.copy(self.src_path / 'file.bin', self.dest_path / f'{tier}.bin')
+
+            with self.subTest(tier=tier):
+                # Four seconds of data with a second of burst #
+                self.assertAlmostEqual(clock[0], 3.0)
+                self.assertEqual((self.dest_path / f'{tier}.bin').read_bytes(),
+                                 (self.src_path / 'file.bin').read_bytes())
+
+    def test_adaptive_concurrency(self):
+        """
+        The concurrent copy limit is halved when the latency rises past the baseline and grows \
+        back one copy at a time once it is normal again.
+        """
+        clock = mock.Mock(return_value=0.0)
+
+        with mock.patch('backup_buddy.time.monotonic', clock):
+            throttle = Throttle(workers=8)
+
+            def record(seconds: float):
+                clock.return_value += ADAPT_INTERVAL
+                throttle.record(seconds)
+
+            record(0.01)
+            self.assertEqual(throttle.limit, 8)
+
+            record(0.1)
+            self.assertEqual(throttle.limit, 4)
+
+            limits = []
+            for _ in range(20):
+                record(0.01)
+                limits.append(throttle.limit)
+
+        self.assertEqual(limits[-1], 8)
+        self.assertEqual(limits, sorted(limits))
+
+
+
+class RangedCopyTest(TreeTestCase):
+    """
+    Tests the parallel byte range copies of large files.
+    """
+    def copy(self, size: int) -> str:
+        """
+        Copies a file with two range workers and 64 KiB ranges, past 256 KiB, without reflinks.
+
+        :param size:  The size of the file.
+        :return:  The name of the tier which copied the file.
+        """
+        write_file(self.src_path / 'file.bin', os.urandom(size))
+        backend = CopyBackend(range_workers=2, range_min_size=256 * 1024, range_size=64 * 1024)
+
+        try:
+            with mock.patch.object(backend, 'reflink_copy',
+                                   side_effect=OSError(errno.EOPNOTSUPP, 'no reflinks')):
+                tier = backend.copy(self.src_path / 'file.bin', self.dest_path / 'file.bin')
+        finally:
+            backend.close()
+
+        self.assertEqual(tree_files(self.dest_path), tree_files(self.src_path))
+        return tier
+
+    def test_large_file_copied_as_ranges(self):
+        """
+        A file past the minimum size is copied as ranges, including a partial last range.
+        """
+        self.assertEqual(self.copy(10 * 64 * 1024 + 123), 'ranged')
+
+    def test_ranges_without_copy_file_range(self):
+        """
+        The ranges are copied with pread and pwrite where copy_file_range is unsupported.
+        """
+        with mock.patch('backup_buddy.os.copy_file_range',
+                        side_effect=OSError(errno.ENOSYS, 'unsupported')):
+            self.assertEqual(self.copy(5 * 64 * 1024), 'ranged')
+
+    def test_small_file_not_ranged(self):
+        """
+        Files below the minimum size or within a single range use the regular tiers.
+        """
+        self.assertNotEqual(self.copy(200 * 1024), 'ranged')
+
+
+
+class RestoreTest(TreeTestCase):
+    """
+    Tests the selective, prioritized and point in time restores.
+    """
+    def restore(self, *options: str) -> dict:
+        """
+        Restores the backup in the source path into an empty directory.
+
+        :param options:  The restore command line options.
+        :return:  The restored file contents keyed by their path.
+        """
+        restore_path = self.dest_path / 'restore'
+        shutil.rmtree(restore_path, ignore_errors=True)
+        run_backup(parse_args([*options, '-o', 'quiet']), self.src_path, restore_path, True)
+        return tree_files(restore_path)
+
+    def test_point_in_time(self):
+        """
+        The newest generation at or before the point in time is restored, selected by date or \
+        name, and a point before every generation fails.
+        """
+        for day, version in ((1, b'first'), (3, b'second'), (5, b'third')):
+            name = datetime(2024, 5, day, 12).strftime(GENERATION_FORMAT)
+            write_file(self.src_path / name / 'file.txt', version)
+
+        self.assertEqual(self.restore('--restore'), {'file.txt': b'third'})
+        self.assertEqual(self.restore('--restore', '2024-05-04T00:00'), {'file.txt': b'second'})
+        self.assertEqual(self.restore('--restore', '2024-05-03T12:00'), {'file.txt': b'second'})
+        self.assertEqual(self.restore('--restore', '20240501_120000_000000'),
+                         {'file.txt': b'first'})
+
+        with self.assertRaises(ValueError):
+            self.restore('--restore', '2024-04-30')
+
+    def test_select_and_priority(self):
+        """
+        Only the selected files and their parent directories are restored, the prioritized ones \
+        first and the rest smallest first.
+        """
+        for rel_path, size in (('docs/big.txt', 300), ('docs/small.txt', 10),
+                               ('docs/sub/mid.txt', 100), ('app.cfg', 200), ('skip/app.txt', 1),
+                               ('other.txt', 1)):
+            write_file(self.src_path / rel_path, b'x' * size)
+        (self.src_path / 'empty').mkdir()
+        restored = []
+
+        with CopyEngine(1, reporter=ProgressReporter('quiet')) as engine:
+            engine.listeners.append(lambda result: restored.append(
+                                    result.dest_file.relative_to(self.dest_path).as_posix()))
+            restore_backup(self.src_path, self.dest_path, engine, True,
+                           selector=RestoreSelector(['docs', '*.cfg'], ['docs/big.txt']))
+
+        self.assertEqual(restored, ['docs/big.txt', 'docs/small.txt', 'docs/sub/mid.txt',
+                                    'app.cfg'])
+        self.assertEqual(sorted(path.relative_to(self.dest_path).as_posix()
+                                for path in self.dest_path.rglob('*') if path.is_dir()),
+                         ['docs', 'docs/sub'])
+
+
+
+class JobRunnerTest(TreeTestCase):
+    """
+    Tests the job file runner and its device lanes.
+    """
+    def test_lanes_group_shared_devices(self):
+        """
+        Jobs sharing a device, directly or through another job, share a lane in job file order.
+        """
+        specs = {'one': ('a', 'x'), 'two': ('b', 'y'), 'three': ('c', 'x'), 'four': ('d', 'e'),
+                 'five': ('e', 'y')}
+        jobs = [BackupJob(name, None, Path(src), [Path(dest)], True)
+                for name, (src, dest) in specs.items()]
+
+        # Each path is on the device named like it #
+        with mock.patch('backup_buddy.physical_device', lambda path: path.name):
+            lanes = schedule_jobs(jobs)
+
+        self.assertEqual([[job.name for job in lane] for lane in lanes],
+                         [['one', 'three'], ['two', 'four', 'five']])
+
+    def test_failed_job_does_not_stop_others(self):
+        """
+        The jobs run with the defaults and options of the job file, a failing job is counted \
+        while the others still run.
+        """
+        write_file(self.src_path / 'file.txt', b'data')
+        write_file(self.src_path / 'cache.tmp', b'excluded')
+        # A destination which is a file cannot be created #
+        write_file(self.dest_path / 'blocked', b'file')
+        jobs_path = self.src_path.parent / 'jobs.json'
+        jobs_path.write_text(json.dumps({
+            'defaults': {'exclude': ['*.tmp']},
+            'jobs': [{'name': 'broken', 'src': str(self.src_path),
+                      'dest': str(self.dest_path / 'blocked' / 'sub')},
+                     {'name': 'single', 'src': str(self.src_path), 'mode': 'single',
+                      'dest': str(self.dest_path / 'copy'), 'options': {'manifest': True}}]}),
+            'utf-8')
+
+        with mock.patch('sys.argv', ['backup_buddy.py', '--jobs', str(jobs_path)]), \
+        mock.patch('backup_buddy.print_err') as print_err:
+            failed = run_jobs(parse_args(['--jobs', str(jobs_path)]))
+
+        self.assertEqual(failed, 1)
+        print_err.assert_called_once()
+        self.assertEqual(set(tree_files(self.dest_path / 'copy')), {'file.txt', MANIFEST_NAME})
+
+
+
+class SetupTest(TreeTestCase):
+    """
+    Tests the offline wheel cache and the parallel environment creation of setup.py.
+    """
+    def test_index_args_use_seeded_wheelhouse(self):
+        """
+        Packages are installed from the wheelhouse without the index only once it is seeded.
+        """
+        builder = setup.ExtendedEnvBuilder(cache_dir=self.dest_path)
+
+        self.assertEqual(builder.index_args(), [])
+
+        write_file(builder.wheelhouse / 'pip-24.0-py3-none-any.whl', b'wheel')
+
+        self.assertEqual(builder.index_args(),
+                         ['--no-index', '--find-links', str(self.dest_path / 'wheels')])
+
+    def test_install_setuptools_with_host_pip(self):
+        """
+        Without pip in the environment, setuptools is installed by the host pip targeting it.
+        """
+        builder = setup.ExtendedEnvBuilder(cache_dir=self.dest_path, nopip=True)
+        context = SimpleNamespace(env_exe='/env/bin/python', env_dir='/env')
+
+        with mock.patch('setup.system_cmd') as system_cmd, \
+        contextlib.redirect_stdout(io.StringIO()):
+            builder.install_setuptools(context)
+
+        command, _, env = system_cmd.call_args.args
+        self.assertEqual(command, [sys.executable, '-m', 'pip', '--python', '/env/bin/python',
+                                   'install', 'setuptools'])
+        self.assertEqual(env['VIRTUAL_ENV'], '/env')
+
+    def test_cached_script_not_downloaded(self):
+        """
+        A bootstrap script already in the cache is served without downloading it.
+        """
+        builder = setup.ExtendedEnvBuilder(cache_dir=self.dest_path)
+        write_file(self.dest_path / 'bootstrap' / 'get-pip.py', b'# cached')
+
+        with mock.patch('setup.urlretrieve') as urlretrieve:
+            script_path = builder.cached_script('https://bootstrap.pypa.io/get-pip.py')
+
+        urlretrieve.assert_not_called()
+        self.assertEqual(script_path, self.dest_path / 'bootstrap' / 'get-pip.py')
+
+    def test_failed_command_raises(self):
+        """
+        A command exiting with an error fails its step.
+        """
+        setup.system_cmd([sys.executable, '-c', 'pass'], 60)
+
+        with self.assertRaises(RuntimeError):
+            setup.system_cmd([sys.executable, '-c', 'raise SystemExit(3)'], 60)
+
+    def test_failed_environment_does_not_stop_others(self):
+        """
+        Every environment is created even if one fails, and the run fails afterwards.
+        """
+        env_dirs = [str(self.dest_path / name) for name in ('one', 'two', 'three')]
+        created = []
+
+        def create(env_dir):
+            # If this is the failing environment #
+            if env_dir == env_dirs[1]:
+                raise RuntimeError('pip failed')
+            created.append(env_dir)
+
+        with mock.patch.object(setup.ExtendedEnvBuilder, 'create', side_effect=create), \
+        mock.patch('setup.print_err') as print_err:
+            with self.assertRaisesRegex(ValueError, '1 of 3 environments failed'):
+                setup.main([*env_dirs, '--parallel', '2', '--cache-dir', str(self.src_path)])
+
+        self.assertEqual(sorted(created), sorted([env_dirs[0], env_dirs[2]]))
+        print_err.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()